@@ -4,4 +4,6 @@ dircrypt
 A utility for creating encrypted copies of unix directories and windows
 folders.
 """
-__all__ = ["routines", "cryptor", "ioutils", "aux"]
+__all__ = ["routines", "cryptor", "ioutils", "aux", "manifest", "chunkstore",
+           "compression", "ciphers", "kdf", "archive", "stats", "scheduler",
+           "progress", "verify", "journal", "reader", "benchmarks"]
@@ -2,99 +2,987 @@
 dircrypt
 
 Usage:
-    dircrypt (-e | -d) <target>
-    dircrypt (--encrypt | --decrypt) <target>
-    dircrypt (-e | --encrypt) <target> [--gen] [--as=<output>]
-    dircrypt (-d | --decrypt) <target> [--with=<psw_file>] [--as=<output>]
+    dircrypt (-e | --encrypt) <target> [options]
+    dircrypt (-e | --encrypt) <target> --update=<output> [options]
+    dircrypt (-d | --decrypt) <target> [options]
+    dircrypt (-e | --encrypt) <target> --resume=<output> [options]
+    dircrypt --verify <target> [options]
+    dircrypt bench-chunks [--bench-size=<bytes>]
 
 Options:
-    -e --encrypt    encrypt the target directory/file
-    -d --decrypt    decrypt the target directory/file
+    -e --encrypt    encrypt the target directory/file, or STDIN to STDOUT if
+                    the target is `-` (which needs --gen or --with)
+    -d --decrypt    decrypt the target directory/file, or STDIN to STDOUT if
+                    the target is `-` (which needs --with)
+    --verify    authenticate every name and chunk of the encrypted target
+                directory/file (or packed archive), without writing any
+                plaintext, and report the bad ones as JSON
+    --report=<file>     write the --verify report to the given file, instead
+                        of STDOUT
     --as=<output>     name of the output directory, where (en|de)crypted
                       file(s) are stored
+    --update=<output>   update an existing output directory, only encrypting
+                        new or changed files, and removing deleted ones
+    --resume=<output>   resume an interrupted encryption into its output
+                        directory, skipping the files it finished, and
+                        redoing the rest
     --gen   use securely generated password, instead of a user generated
             password
     --with=<psw_file>   read the password from the given file, instead of STDIN
-                        (useful for long, securely generated passwords)
+                        (useful for long, securely generated passwords, and
+                        also usable with --update, --resume, or a `-`
+                        target)
+    --mmap  memory map large files, instead of reading them in chunks
+    --chunk-size=<bytes>    size of the chunks file contents are encrypted in,
+                            e.g. 16K or 4M. Recorded in each encrypted file,
+                            so it is never needed for decryption [default: 16K]
+    --dedup     store identical chunks only once, in a chunk store next to the
+                encrypted target. Needs a --chunk-size of at least 4K, that's
+                a multiple of 32
+    --compress=<codec>  compress chunks before encrypting them, with zlib or
+                        lzma. Chunks that don't compress are stored as is
+    --cipher=<cipher>   cipher to encrypt file contents with:
+                        chacha20-poly1305, aes-256-gcm, or auto (the
+                        default), which picks AES-256-GCM if the cpu has AES
+                        instructions, and ChaCha20-Poly1305 otherwise.
+                        Recorded in each encrypted file, so it is never
+                        needed for decryption
+    --kdf=<kdf>     key derivation function to stretch the password with:
+                    pbkdf2 (the default), or scrypt, which is memory hard.
+                    Recorded in each encrypted file (and name), along with
+                    its parameters, so it is never needed for decryption
+    --kdf-target-ms=<ms>    pick the --kdf parameters (PBKDF2's iterations,
+                            or scrypt's N) that stretch the password in
+                            about this many milliseconds on this machine,
+                            instead of the defaults
+    --archive   encrypt into a single packed archive file, instead of a
+                directory tree. Packed archives are detected when decrypting
+    --extract=<path>    only decrypt the given file, or directory, from a
+                        packed archive (e.g. --extract=target/docs)
+    --only=<glob>   only decrypt the files (or directories) matching the given
+                    glob, e.g. 'target/docs/**/*.md'. Directories that can't
+                    hold a match are skipped entirely
+    --progress  show a live progress line on STDERR (MB/s, files/s and the
+                time left), instead of the output of each file
+    --quiet     print no output for each file, only that of the whole run
+    --stats     print how long each phase (key derivation, name and chunk
+                (en|de)cryption, reads, writes, syncs, directory creation)
+                took, across every worker
+    --stats-json=<file>     write the --stats breakdown to the given file, as
+                            JSON, instead of printing it
+    --workers=<n>   number of worker processes, or threads (by default, one
+                    per available cpu)
+    --max-in-flight=<n>     maximum number of tasks (or batches of small
+                            files) handed to the workers at once, beyond
+                            which walking the target waits for results (by
+                            default, 4 per worker)
+    --engine=<engine>   run workers as processes, or as threads sharing
+                        dircrypt's process (skipping process startup, and the
+                        copying of tasks), or run every task inline, without
+                        any workers (skipping starting a pool at all), or
+                        pick one from the size of the target: process,
+                        thread, inline or auto [default: auto]
+    --bench-size=<bytes>    amount of data to benchmark each chunk size over,
+                            for `bench-chunks` [default: 64M]
 """
+import os
 import sys
-from pathlib import Path
-from typing import Tuple, List
-from multiprocessing import Pool, Manager
+import json
+from functools import partial
+from pathlib import Path, PurePosixPath
+from typing import (Tuple, List, Dict, Any, Optional, BinaryIO, Callable,
+                    Iterator)
 
 from docopt import docopt
 from cryptography.exceptions import InvalidTag, UnsupportedAlgorithm
 
-from dircrypt.cryptor import Cryptor, Encryptor, Decryptor
-from dircrypt.aux import implies, bench, num_available_cpus
-from dircrypt.ioutils import force_create_dir_or_exit, dir_walk
-from dircrypt.routines import DirectoryBuilder, crypt_path_and_contents
+from dircrypt.cryptor import (Cryptor, Encryptor, Decryptor, MAX_CHUNK_SIZE,
+                              REF_SIZE)
+from dircrypt.aux import (implies, bench, num_available_cpus, parse_size,
+                          set_quiet, is_quiet)
+from dircrypt.ioutils import (force_create_dir_or_exit, force_create_file,
+                              walk_files, FileEntry, PathPattern)
+from dircrypt.routines import (DirectoryBuilder, crypt_path_and_contents,
+                               start_split_file, crypt_chunk_range,
+                               finish_split_file, crypt_stream,
+                               SPLIT_FILE_SIZE)
+from dircrypt.manifest import Manifest, MANIFEST_NAME
+from dircrypt.journal import (Journal, remove_unfinished, JOURNAL_NAME,
+                              METADATA_NAMES)
+from dircrypt.chunkstore import ChunkStore, CHUNK_STORE_NAME
+from dircrypt.compression import CODECS
+from dircrypt.ciphers import parse_cipher, CIPHER_NAMES, AUTO_CIPHER
+from dircrypt.kdf import (KdfSpec, KDF_NAMES, DEFAULT_SPECS, calibrate,
+                          describe)
+from dircrypt.archive import (is_archive, record_size, start_archive,
+                              pack_file, finish_archive, read_archive_index,
+                              select_sources, unpack_file, ArchiveIndex,
+                              ARCHIVE_SUFFIX)
+from dircrypt.scheduler import Scheduler, InlinePool, init_worker
+from dircrypt.progress import Progress
+from dircrypt.stats import (enable_stats, stats_enabled, take_stats,
+                            PERCENTILES)
+
+ENGINES = ("process", "thread", "inline", "auto")
+
+# The target standing for STDIN (and STDOUT)
+STREAM_TARGET = "-"
+# Options that need a target on disk
+UNSTREAMABLE_ARGS = ("--update", "--resume", "--as", "--archive", "--dedup",
+                     "--extract", "--only", "--verify", "--progress")
+
+# Every deduplicated chunk is a file of its own in the chunk store, so
+# smaller chunks would spend far more time creating (and opening) files than
+# encrypting them
+MIN_DEDUP_CHUNK_SIZE = 2**12 # 4KiB
+
+# --engine=auto samples this many files of the target, to size it up
+AUTO_SAMPLE_SIZE = 256
+# ... and picks threads if their mean size is at least this (chunks are
+# (en|de)crypted without holding the GIL, so large files keep threads busy)
+AUTO_THREAD_FILE_SIZE = 2**20 # 1MiB
+# ... or runs every task inline, if they're all of its files, and add up to at
+# most this (less than starting a pool, and importing multiprocessing, costs)
+AUTO_INLINE_SIZE = 2**20 # 1MiB
 
 # -----------------------------------------------------------------------------
 
-def parse_args(arg_list: List[str]=sys.argv[1:]) -> Tuple[Cryptor, Path, str]:
-    # pylint: disable=invalid-sequence-index
-    # Not sure why pylint goofs up on this one
+def parse_args(arg_list: List[str]=sys.argv[1:]) -> Dict[str, Any]:
     """
     Parses the command line arguments, according to the given usage string.
-    Returns the associated `Cryptor`, target directory/file, and output
-    directory/file name, in that order. Exits on malformed args.
+    Sizes are converted to ints. Exits on malformed args.
     """
     args = docopt(__doc__, argv=arg_list, version="dircrypt 1.0")
 
-    assert(args["--decrypt"] ^ args["--encrypt"])
+    if args["--gen"] and not args["--encrypt"]:
+        sys.exit("--gen can only be used for encryption")
+    if args["--with"] is not None and \
+       not (args["--decrypt"] or args["--verify"] or
+            args["--update"] is not None or args["--resume"] is not None or
+            args["<target>"] == STREAM_TARGET):
+        sys.exit("--with can only be used for decryption or --verify, or "\
+                 "with --update, --resume or '{}'".format(STREAM_TARGET))
+    if args["--report"] is not None and not args["--verify"]:
+        sys.exit("--report can only be used with --verify")
+    if args["--verify"] and args["--as"] is not None:
+        sys.exit("--verify writes no output, so can't be used with --as")
+    if args["--update"] is not None and (args["--gen"] or args["--as"]):
+        sys.exit("--update can't be used with --gen or --as")
+    if args["--resume"] is not None and \
+       (args["--gen"] or args["--as"] or args["--update"] is not None):
+        sys.exit("--resume can't be used with --gen, --as or --update")
+    if args["--resume"] is not None and not args["--encrypt"]:
+        sys.exit("--resume can only be used for encryption")
+    if args["--dedup"] and not args["--encrypt"]:
+        sys.exit("--dedup can only be used for encryption")
+    if args["--compress"] is not None:
+        if not args["--encrypt"]:
+            sys.exit("--compress can only be used for encryption")
+        if args["--dedup"]:
+            sys.exit("--compress can't be used with --dedup")
+        if args["--compress"] not in CODECS:
+            sys.exit("Unknown codec '{}' for --compress. Must be one of {}"\
+                     .format(args["--compress"], ", ".join(CODECS)))
+    if args["--cipher"] is None:
+        args["--cipher"] = AUTO_CIPHER
+    elif not args["--encrypt"]:
+        sys.exit("--cipher can only be used for encryption")
+    elif args["--cipher"] not in (AUTO_CIPHER, *CIPHER_NAMES):
+        sys.exit("Unknown cipher '{}' for --cipher. Must be one of {}"\
+                 .format(args["--cipher"],
+                         ", ".join((AUTO_CIPHER, *CIPHER_NAMES))))
+    for kdf_arg in ("--kdf", "--kdf-target-ms"):
+        if args[kdf_arg] is None:
+            continue
+        if not args["--encrypt"]:
+            sys.exit("{} can only be used for encryption".format(kdf_arg))
+        if args["--update"] is not None or args["--resume"] is not None:
+            sys.exit("{} can't be used with --update or --resume, which "\
+                     "keep the archive's".format(kdf_arg))
+    if args["--kdf"] is None:
+        args["--kdf"] = "pbkdf2"
+    elif args["--kdf"] not in KDF_NAMES:
+        sys.exit("Unknown KDF '{}' for --kdf. Must be one of {}"\
+                 .format(args["--kdf"], ", ".join(KDF_NAMES)))
+    if args["--kdf-target-ms"] is not None:
+        try:
+            args["--kdf-target-ms"] = float(args["--kdf-target-ms"])
+        except ValueError:
+            sys.exit("Malformed number '{}' for --kdf-target-ms"\
+                     .format(args["--kdf-target-ms"]))
+        if not args["--kdf-target-ms"] > 0:
+            sys.exit("--kdf-target-ms must be positive")
+    if args["--archive"]:
+        if not args["--encrypt"]:
+            sys.exit("--archive can only be used for encryption")
+        if args["--update"] is not None or args["--resume"] is not None or \
+           args["--dedup"] or args["--compress"] is not None or \
+           args["--progress"]:
+            sys.exit("--archive can't be used with --update, --resume, "\
+                     "--dedup, --compress or --progress")
+    if args["<target>"] == STREAM_TARGET:
+        for arg in UNSTREAMABLE_ARGS:
+            if args[arg] not in (None, False):
+                sys.exit("{} can't be used with '{}'".format(arg,
+                                                             STREAM_TARGET))
+        # STDIN holds the contents, so the password can't be queried there
+        if not args["--gen"] and args["--with"] is None:
+            sys.exit("'{}' needs --gen or --with".format(STREAM_TARGET))
+    if args["--engine"] not in ENGINES:
+        sys.exit("Unknown engine '{}' for --engine. Must be one of {}"\
+                 .format(args["--engine"], ", ".join(ENGINES)))
+    for arg in ("--extract", "--only"):
+        if args[arg] is not None and not args["--decrypt"]:
+            sys.exit("{} can only be used for decryption".format(arg))
+
+    for size_arg in ("--chunk-size", "--bench-size"):
+        try:
+            args[size_arg] = parse_size(args[size_arg])
+        except ValueError:
+            sys.exit("Malformed size '{}' for {}".format(args[size_arg],
+                                                         size_arg))
+        if args[size_arg] <= 0:
+            sys.exit("{} must be positive".format(size_arg))
+
+    for count_arg in ("--workers", "--max-in-flight"):
+        if args[count_arg] is None:
+            continue
+        try:
+            args[count_arg] = int(args[count_arg])
+        except ValueError:
+            sys.exit("Malformed number '{}' for {}".format(args[count_arg],
+                                                           count_arg))
+        if args[count_arg] <= 0:
+            sys.exit("{} must be positive".format(count_arg))
+    if args["--workers"] is None:
+        args["--workers"] = num_available_cpus()
+
+    if args["--chunk-size"] > MAX_CHUNK_SIZE:
+        sys.exit("--chunk-size must be at most {}".format(MAX_CHUNK_SIZE))
+    if args["--dedup"] and args["--chunk-size"] < MIN_DEDUP_CHUNK_SIZE:
+        sys.exit("--chunk-size must be at least {} for --dedup"\
+                 .format(MIN_DEDUP_CHUNK_SIZE))
+    if args["--dedup"] and args["--chunk-size"] % REF_SIZE != 0:
+        sys.exit("--chunk-size must be a multiple of {} for --dedup"\
+                 .format(REF_SIZE))
+
+    return args
+
+def parse_crypt_args(args: Dict[str, Any]) -> Tuple[Cryptor, Path, str]:
+    # pylint: disable=invalid-sequence-index
+    # Not sure why pylint goofs up on this one
+    """
+    Returns the `Cryptor`, target directory/file, and output directory/file
+    name associated with the parsed args, in that order. Exits on malformed
+    args.
+    """
+    assert(args["--decrypt"] + args["--encrypt"] + args["--verify"] == 1)
     assert(args["<target>"] is not None)
     assert(implies(args["--gen"], args["--encrypt"]))
-    assert(implies(args["--with"] is not None, args["--decrypt"]))
+    assert(implies(args["--with"] is not None,
+                   args["--decrypt"] or args["--verify"] or
+                   args["--update"] is not None or
+                   args["--resume"] is not None or
+                   args["<target>"] == STREAM_TARGET))
 
     (mode, target, new_dir) = (None, None, None)
 
     try:
         target = Path(args["<target>"])
-        if not (target.is_dir() or target.is_file()):
+        if args["<target>"] != STREAM_TARGET and \
+           not (target.is_dir() or target.is_file()):
             sys.exit("'{}' must be a file or directory".format(target))
     except TypeError as e:
         sys.exit("Cannot read '{}' with '{}'".format(target, e))
 
+    (archive_salt, kdf) = (None, None)
+    if args["--update"] is not None:
+        archive = Manifest.read_archive_kdf(Path(args["--update"]))
+        if archive is None:
+            sys.exit("'{}' has no readable {}".format(args["--update"],
+                                                      MANIFEST_NAME))
+        (archive_salt, kdf) = archive
+    elif args["--resume"] is not None:
+        # encrypted names (and keys) must match those of the interrupted run
+        archive = Journal.read_archive_kdf(Path(args["--resume"]))
+        if archive is None:
+            sys.exit("'{}' has no readable {}".format(args["--resume"],
+                                                      JOURNAL_NAME))
+        (archive_salt, kdf) = archive
+    elif args["--encrypt"]:
+        kdf = choose_kdf(args)
+
     try:
-        mode = Encryptor(args["--gen"]) if args["--encrypt"] else \
-               Decryptor(args["--with"])
+        mode = Encryptor(args["--gen"], args["--chunk-size"], args["--with"],
+                         archive_salt, args["--dedup"],
+                         CODECS.get(args["--compress"], None),
+                         parse_cipher(args["--cipher"]), kdf) \
+               if args["--encrypt"] else Decryptor(args["--with"])
     except (OSError, InvalidTag, UnsupportedAlgorithm) as e:
         sys.exit(str(e))
 
-    new_dir = mode.output_dirname if args["--as"] is None else args["--as"]
+    new_dir = args["--update"] or args["--resume"] or args["--as"] or \
+              mode.output_dirname
 
     assert(None not in (mode, target, new_dir))
 
     return (mode, target, new_dir)
 
-# -----------------------------------------------------------------------------
+def choose_kdf(args: Dict[str, Any]) -> KdfSpec:
+    """
+    The spec of the --kdf to stretch a new archive's password with: the
+    default one, or the one calibrated to --kdf-target-ms
+    """
+    kdf = KDF_NAMES[args["--kdf"]]
+    if args["--kdf-target-ms"] is None:
+        return DEFAULT_SPECS[kdf]
+
+    spec = calibrate(kdf, args["--kdf-target-ms"])
+    print("Stretching the password with {}".format(describe(spec)))
+    return spec
+
+def parse_only(args: Dict[str, Any]) -> Optional[PathPattern]:
+    """The `PathPattern` given with --only, if any"""
+    return None if args["--only"] is None else PathPattern(args["--only"])
 
-def main():
+def is_output_dir(target: Path) -> bool:
     """
-    1) Parses command line arguments
-    2) Runs the Dircrypt protocol
+    Whether `target` is an output directory (i.e. holds dircrypt's own files),
+    rather than the encrypted target within one. Its name was never
+    encrypted, so its contents are decrypted (and verified) as if they were
+    the targets.
     """
-    mode, target, new_dir = parse_args()
+    return any(target.joinpath(name).exists()
+               for name in (*METADATA_NAMES, CHUNK_STORE_NAME))
 
+def walk_target(
+        target: Path,
+        output_dir: bool=False,
+        include_dir: Optional[Callable[[Path], bool]]=None
+    ) -> Iterator[FileEntry]:
+    """
+    `walk_files` over `target`, skipping dircrypt's own files (and the chunk
+    store) if it's an output directory (see `is_output_dir`), since they're
+    never outputs. Encrypted names never have a `.`, so they can't be
+    mistaken for them.
+    """
+    chunk_store = target.joinpath(CHUNK_STORE_NAME)
+
+    def include(directory: Path) -> bool:
+        """Walks every directory `include_dir` does, but the chunk store"""
+        if output_dir and directory == chunk_store:
+            return False
+        return include_dir is None or include_dir(directory)
+
+    for file_entry in walk_files(target, include):
+        if not (output_dir and file_entry.path.parent == target and
+                file_entry.path.name in METADATA_NAMES):
+            yield file_entry
+
+def choose_engine(sizes: List[int], complete: bool, workers: int) -> str:
+    """
+    Picks the engine for --engine=auto, given the sizes of (a sample of) the
+    files to (en|de)crypt, and whether that's all of them. Threads avoid
+    starting workers and pickling tasks, which dominates small targets, and
+    scale with large files, whose chunks are (en|de)crypted without holding
+    the GIL. Many small files spend most of their time in python, though,
+    and need a process per cpu. Tiny targets don't need a pool at all.
+    """
+    if complete and sum(sizes) <= AUTO_INLINE_SIZE:
+        return "inline"
+    if workers == 1 or complete:
+        return "thread"
+    if sum(sizes) >= AUTO_THREAD_FILE_SIZE * len(sizes):
+        return "thread"
+    return "process"
+
+def sample_sizes(files: Iterator[FileEntry]) -> Tuple[List[int], bool]:
+    """
+    The sizes of (up to `AUTO_SAMPLE_SIZE`) `files` (e.g. a walk of the
+    target), and whether they're all of them.
+    """
+    sizes = []
+    try:
+        for file_entry in files:
+            if len(sizes) == AUTO_SAMPLE_SIZE:
+                return (sizes, False)
+            sizes.append(file_entry.size)
+    except OSError:
+        pass # sized up from the files read so far
+    return (sizes, True)
+
+def resolve_engine(args: Dict[str, Any], sizes: List[int],
+                   complete: bool) -> None:
+    """Replaces --engine=auto with the engine picked by `choose_engine`"""
+    if args["--engine"] == "auto":
+        args["--engine"] = choose_engine(sizes, complete, args["--workers"])
+
+def create_pool(workers: int, engine: str, progress: Optional[Progress]=None):
+    """
+    A pool of `workers` processes (or threads, if `engine` is "thread", or an
+    `InlinePool`, if "inline"), recording --stats if enabled, quiet if
+    --quiet, and counting towards `progress`, if given
+    """
+    assert(engine in ("process", "thread", "inline"))
+    initargs = (engine != "process", stats_enabled(), is_quiet(),
+                None if progress is None else progress.worker_args)
+    if engine == "inline":
+        return InlinePool(initializer=init_worker, initargs=initargs)
+
+    # imported here, since starting up multiprocessing isn't free, and small
+    # runs never need it
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    if engine == "thread":
+        return ThreadPool(processes=workers, initializer=init_worker,
+                          initargs=initargs)
+    return Pool(processes=workers, initializer=init_worker, initargs=initargs)
+
+def start_progress(args: Dict[str, Any]) -> Optional[Progress]:
+    """
+    Starts showing the progress of the run, if --progress is given. Totals are
+    found as the run walks the target.
+    """
+    if not args["--progress"]:
+        return None
+    progress = Progress(args["--workers"])
+    progress.start()
+    return progress
+
+def report_stats(stats_json: Optional[str]) -> None:
+    """
+    Prints the --stats breakdown, or writes it to `stats_json`, if events were
+    recorded. `OSError`'s are logged to the end user.
+    """
+    stats = take_stats()
+    if stats is None:
+        return
+
+    if stats_json is not None:
+        try:
+            Path(stats_json).write_text(json.dumps(stats.to_dict(), indent=4))
+        except OSError as e:
+            print("Error writing '{}'. Failed with '{}'".format(stats_json, e))
+        return
+
+    columns = ["phase", "count", "total s", "MB"] + \
+              ["p{} ms".format(percentile) for percentile in PERCENTILES]
+    print(("{:<6}" + " {:>10}" * (len(columns) - 1)).format(*columns))
+    for (phase, phase_stats) in sorted(stats.phases.items()):
+        percentiles = [phase_stats.percentile_ns(percentile) / 10**6
+                       for percentile in PERCENTILES]
+        print(("{:<6} {:>10} {:>10.3f} {:>10.1f}" +
+               " {:>10.3f}" * len(percentiles))\
+              .format(phase, phase_stats.count, phase_stats.total_ns / 10**9,
+                      phase_stats.num_bytes / 10**6, *percentiles))
+
+def load_manifest_or_exit(output_dir: Path, mode: Encryptor) -> Manifest:
+    """Wrapper over `Manifest.load`. Exits on failure."""
+    try:
+        manifest = Manifest.load(output_dir, mode)
+    except OSError as e:
+        sys.exit("Cannot read the manifest in '{}' with '{}'"\
+                 .format(output_dir, e))
+    if manifest is None:
+        sys.exit("Cannot decrypt the manifest in '{}'. Wrong password?"\
+                 .format(output_dir))
+    return manifest
+
+def save_manifest(manifest: Manifest, output_dir: Path,
+                  mode: Encryptor) -> None:
+    """Wrapper over `Manifest.save`. `OSError`'s are logged to the end user."""
+    try:
+        manifest.save(output_dir, mode)
+    except OSError as e:
+        print("Error saving the manifest in '{}'. Failed with '{}'"\
+              .format(output_dir, e))
+
+def create_journal_or_exit(output_dir: Path, mode: Encryptor) -> Journal:
+    """Wrapper over `Journal.create`. Exits on failure."""
+    try:
+        return Journal.create(output_dir, mode)
+    except OSError as e:
+        sys.exit("Cannot create the journal in '{}' with '{}'"\
+                 .format(output_dir, e))
+
+def resume_journal_or_exit(output_dir: Path,
+                           mode: Encryptor) -> Tuple[Journal, Manifest]:
+    # pylint: disable=invalid-sequence-index
+    """
+    Wrapper over `Journal.resume`, which also removes the files left
+    unfinished in `output_dir`. Exits on failure.
+    """
+    try:
+        resumed = Journal.resume(output_dir, mode)
+    except OSError as e:
+        sys.exit("Cannot read the journal in '{}' with '{}'"\
+                 .format(output_dir, e))
+    if resumed is None:
+        sys.exit("Cannot resume from the journal in '{}'. Wrong password?"\
+                 .format(output_dir))
+
+    (_, finished) = resumed
+    num_removed = remove_unfinished(output_dir, finished)
+    print("Resuming '{}', with {} files finished, and {} unfinished files "\
+          "removed".format(output_dir, len(finished.files), num_removed))
+    return resumed
+
+def finish_journal(journal: Journal, output_dir: Path,
+                   num_failed: int) -> None:
+    """
+    Closes `journal`, and removes it if every file was finished. Otherwise, it
+    is kept for --resume to retry the failed files. `OSError`'s are logged to
+    the end user.
+    """
+    try:
+        journal.close()
+    except OSError as e:
+        print("Error closing the journal in '{}'. Failed with '{}'"\
+              .format(output_dir, e))
+        return
+    if num_failed == 0:
+        Journal.remove(output_dir)
+    else:
+        print("{} files failed. Retry them with --resume='{}'"\
+              .format(num_failed, output_dir))
+
+def pack_archive(mode: Encryptor, target: Path, archive: Path,
+                 workers: int, engine: str,
+                 max_in_flight: Optional[int]=None) -> None:
+    """
+    Packs `target` into `archive`, over a pool of `workers` processes (or
+    threads, as per `engine`), with at most `max_in_flight` tasks submitted
+    at once. Every record's offset is known up front, from the size of its
+    file, so workers write their records in place.
+    """
     path_to_target = Path(*target.parts[:-1])
+    sizing_cryptor = mode.file_cryptor(mode.new_file_header())
+    try:
+        offset = start_archive(archive)
+    except OSError as e:
+        sys.exit("Cannot write '{}' with '{}'".format(archive, e))
+
+    index = {}
 
-    output_dir = force_create_dir_or_exit(new_dir)
+    def finish_record(source: str, record_offset: int, length: int,
+                      file_salt: Optional[bytes]) -> None:
+        """Indexes a packed record, unless its file failed"""
+        if file_salt is not None:
+            index[source] = (record_offset, length, file_salt)
 
-    manager = Manager()
-    dir_builder = DirectoryBuilder(path_to_target, output_dir, mode, manager)
+    with create_pool(workers, engine) as pool:
+        scheduler = Scheduler(pool, workers, max_in_flight)
+        for file_entry in walk_files(target):
+            (path_to_file, size) = (file_entry.path, file_entry.size)
+            source = path_to_file.relative_to(path_to_target).as_posix()
+            length = record_size(sizing_cryptor, size)
+            scheduler.add(pack_file,
+                          (mode, path_to_file, archive, offset, size), size,
+                          partial(finish_record, source, offset, length))
+            offset += length
+        scheduler.finish()
+
+    try:
+        finish_archive(archive, offset, index, mode)
+    except OSError as e:
+        print("Error writing the index of '{}'. Failed with '{}'"\
+              .format(archive, e))
+
+def load_archive_index_or_exit(
+        archive: Path,
+        mode: Decryptor,
+        extract: Optional[str],
+        only: Optional[PathPattern]
+    ) -> ArchiveIndex:
+    """
+    Wrapper over `read_archive_index`, narrowed down to `extract` and `only`,
+    if given. Exits on failure.
+    """
+    try:
+        index = read_archive_index(archive, mode)
+    except OSError as e:
+        sys.exit("Cannot read '{}' with '{}'".format(archive, e))
+    if index is None:
+        sys.exit("Cannot decrypt the index of '{}'. Wrong password?"\
+                 .format(archive))
+
+    if extract is not None:
+        index = select_sources(index, extract)
+        if len(index) == 0:
+            sys.exit("'{}' is not in '{}'".format(extract, archive))
+    if only is not None:
+        index = {source: entry for (source, entry) in index.items()
+                 if only.matches(PurePosixPath(source).parts)}
+    return index
+
+def unpack_archive(mode: Decryptor, archive: Path, index: ArchiveIndex,
+                   output_dir: Path, workers: int, engine: str,
+                   max_in_flight: Optional[int]=None) -> None:
+    """
+    Unpacks the records of `index` into `output_dir`, over a pool of `workers`
+    processes (or threads, as per `engine`), with at most `max_in_flight`
+    tasks submitted at once.
+    """
+    # in record order, so that the archive is read (a window at a time)
+    # roughly sequentially
+    records = sorted(index.items(), key=lambda item: item[1][0])
+    with create_pool(workers, engine) as pool:
+        scheduler = Scheduler(pool, workers, max_in_flight)
+        for (source, (offset, length, file_salt)) in records:
+            scheduler.add(unpack_file,
+                          (mode, archive, source, offset, length, file_salt,
+                           output_dir),
+                          length, lambda _: None)
+        scheduler.finish()
+
+def run_archive(args: Dict[str, Any], mode: Cryptor, target: Path,
+                new_dir: str) -> None:
+    """Packs `target` into, or unpacks `target` from, a packed archive"""
+    if args["--encrypt"]:
+        suffix = ARCHIVE_SUFFIX if args["--as"] is None else ""
+        try:
+            output = force_create_file(new_dir, suffix)
+        except OSError as e:
+            sys.exit("Cannot create '{}' with '{}'".format(new_dir, e))
+        resolve_engine(args, *sample_sizes(walk_files(target)))
+    else:
+        index = load_archive_index_or_exit(target, mode, args["--extract"],
+                                           parse_only(args))
+        output = force_create_dir_or_exit(new_dir)
+        resolve_engine(args, [length for (_, length, _) in index.values()],
+                       True)
+
+    def run_dircrypt() -> None:
+        """Runs dircrypt over a packed archive"""
+        if args["--encrypt"]:
+            pack_archive(mode, target, output, args["--workers"],
+                         args["--engine"], args["--max-in-flight"])
+        else:
+            unpack_archive(mode, target, index, output, args["--workers"],
+                           args["--engine"], args["--max-in-flight"])
+
+    print("{} '{}'".format(mode.verb, target))
+    if __debug__:
+        bench(dircrypt=run_dircrypt)
+    else:
+        run_dircrypt()
+    print("Finished {} '{}'".format(mode.verb, target))
+    report_stats(args["--stats-json"])
+
+def run_stream(args: Dict[str, Any], mode: Cryptor, output: BinaryIO) -> None:
+    """
+    (En|De)crypts STDIN to `output` (i.e. STDOUT), in a single pass. Exits
+    with an error if decryption fails.
+    """
+    success = False
+
+    def run_dircrypt() -> None:
+        """Runs dircrypt over STDIN"""
+        nonlocal success
+        success = crypt_stream(mode, sys.stdin.buffer, output)
+        output.flush()
+
+    print("{} STDIN".format(mode.verb))
+    try:
+        if __debug__:
+            bench(dircrypt=run_dircrypt)
+        else:
+            run_dircrypt()
+    except OSError as e:
+        sys.exit("{} STDIN failed with '{}'".format(mode.verb, e))
+    if not success:
+        sys.exit("Decrypting STDIN failed. Its output is incomplete.")
+    print("Finished {} STDIN".format(mode.verb))
+    report_stats(args["--stats-json"])
+
+def run_verify(args: Dict[str, Any], mode: Decryptor, target: Path) -> None:
+    """
+    Verifies every name and chunk of `target` (a directory tree, file, or
+    packed archive), and reports the results. Exits with an error if any of
+    them are malformed.
+    """
+    # imported here, since only --verify needs it
+    from dircrypt.verify import verify_file, verify_record, Summary
+    output_dir = is_output_dir(target)
+    path_to_target = target if output_dir else Path(*target.parts[:-1])
+    (num_dirs, malformed_dirs, summary) = (0, [], Summary())
+
+    def check_dir(directory: Path) -> bool:
+        """Verifies the name of `directory`, which is always walked"""
+        nonlocal num_dirs
+        if directory == path_to_target:
+            return True # an output directory, whose name isn't encrypted
+        num_dirs += 1
+        if mode.crypt_path_name(directory.name) is None:
+            malformed_dirs.append(
+                directory.relative_to(path_to_target).as_posix())
+        return True
+
+    def run_dircrypt() -> None:
+        """Runs the verification over a process (or thread) pool"""
+        progress = start_progress(args)
+        with create_pool(args["--workers"], args["--engine"],
+                         progress) as pool:
+            scheduler = Scheduler(pool, args["--workers"],
+                                  args["--max-in-flight"], progress)
+            if packed:
+                for (source, (offset, length, file_salt)) in index.items():
+                    scheduler.add(verify_record,
+                                  (mode, target, source, offset, length,
+                                   file_salt),
+                                  length, summary.add)
+            else:
+                chunk_store = ChunkStore.find(target)
+                for file_entry in walk_target(target, output_dir,
+                                              check_dir):
+                    source = file_entry.path.relative_to(path_to_target)
+                    scheduler.add(verify_file,
+                                  (mode, file_entry.path, source.as_posix(),
+                                   chunk_store),
+                                  file_entry.size, summary.add)
+            scheduler.finish()
+        if progress is not None:
+            progress.finish()
+
+    try:
+        packed = is_archive(target)
+    except OSError as e:
+        sys.exit("Cannot read '{}' with '{}'".format(target, e))
+    if packed:
+        index = load_archive_index_or_exit(target, mode, None, None)
+        resolve_engine(args, [length for (_, length, _) in index.values()],
+                       True)
+    else:
+        resolve_engine(args, *sample_sizes(walk_target(target, output_dir)))
+
+    print("Verifying '{}'".format(target))
+    if __debug__:
+        bench(dircrypt=run_dircrypt)
+    else:
+        run_dircrypt()
+    report = summary.report(target, num_dirs, malformed_dirs)
+    print("Finished Verifying '{}'".format(target))
+    report_stats(args["--stats-json"])
+
+    report_json = json.dumps(report, indent=4)
+    if args["--report"] is None:
+        print(report_json)
+    else:
+        try:
+            Path(args["--report"]).write_text(report_json + "\n")
+        except OSError as e:
+            print("Error writing '{}'. Failed with '{}'"\
+                  .format(args["--report"], e))
+    if not report["ok"]:
+        sys.exit("'{}' has {} malformed names, and {} bad files"\
+                 .format(target, len(report["malformed_names"]),
+                         len(report["bad_files"])))
+
+# -----------------------------------------------------------------------------
+
+def main(arg_list: List[str]=sys.argv[1:]):
+    """
+    1) Parses command line arguments (`arg_list`)
+    2) Runs the Dircrypt protocol (or the chunk size benchmark)
+    """
+    args = parse_args(arg_list)
+    if args["bench-chunks"]:
+        from dircrypt.benchmarks import chunk_sizes
+        chunk_sizes.main(args["--bench-size"])
+        return
+    if args["--stats"] or args["--stats-json"] is not None:
+        enable_stats()
+    # per file output would garble the progress line
+    if args["--quiet"] or args["--progress"]:
+        set_quiet()
+
+    streaming = args["<target>"] == STREAM_TARGET
+    if streaming:
+        # STDOUT carries the (en|de)crypted stream, so messages go to STDERR
+        (output, sys.stdout) = (sys.stdout.buffer, sys.stderr)
+
+    mode, target, new_dir = parse_crypt_args(args)
+    if streaming:
+        run_stream(args, mode, output)
+        return
+    if args["--verify"]:
+        run_verify(args, mode, target)
+        return
+
+    try:
+        packed = args["--archive"] or is_archive(target)
+    except OSError as e:
+        sys.exit("Cannot read '{}' with '{}'".format(target, e))
+    if packed:
+        for arg in ("--resume", "--progress"):
+            if args[arg] not in (None, False):
+                sys.exit("{} can't be used with packed archives".format(arg))
+        run_archive(args, mode, target, new_dir)
+        return
+    if args["--extract"] is not None:
+        sys.exit("--extract can only be used with packed archives")
+
+    # Decrypting an output directory decrypts everything in it (but
+    # dircrypt's own files)
+    output_root = bool(args["--decrypt"]) and is_output_dir(target)
+    path_to_target = target if output_root else Path(*target.parts[:-1])
+
+    # Only encrypted outputs have a manifest, which is updated with --update.
+    # New (and resumed) encrypted outputs are journaled as they're finished,
+    # and resumed runs skip the files in the journal, as --update skips those
+    # in the manifest. Decryption is never resumed, so isn't journaled. Only
+    # journaled outputs need to survive a crash of the machine, so only they
+    # are flushed to disk as they're finished
+    (old_manifest, manifest, journal) = (Manifest(), None, None)
+    if args["--resume"] is not None:
+        output_dir = Path(new_dir)
+        (journal, old_manifest) = resume_journal_or_exit(output_dir, mode)
+    elif args["--update"] is None:
+        output_dir = force_create_dir_or_exit(new_dir)
+        if args["--encrypt"]:
+            journal = create_journal_or_exit(output_dir, mode)
+    else:
+        output_dir = Path(new_dir)
+        old_manifest = load_manifest_or_exit(output_dir, mode)
+    if args["--encrypt"]:
+        manifest = Manifest()
+
+    # Deduplicated chunks are stored next to the encrypted target, and found
+    # again by searching the target (if it's the output directory), and its
+    # parents, when decrypting
+    chunk_store = None
+    if args["--dedup"]:
+        chunk_store = ChunkStore(output_dir.joinpath(CHUNK_STORE_NAME))
+    elif args["--decrypt"]:
+        chunk_store = ChunkStore.find(target)
+
+    dir_builder = DirectoryBuilder(path_to_target, output_dir, mode,
+                                   use_mmap=args["--mmap"],
+                                   visited_dirs=\
+                                        old_manifest.visited_dirs(output_dir),
+                                   chunk_store=chunk_store,
+                                   durable=journal is not None)
+
+    only = parse_only(args)
+
+    def include_dir(directory: Path) -> bool:
+        """Whether `directory` may hold any files selected by --only"""
+        crypted_dir = dir_builder.build_subdir_path(directory)
+        return only.may_match_under(crypted_dir.relative_to(output_dir).parts)
+
+    # Deduplicated and compressed chunks vary in size, so the offsets of their
+    # outputs aren't known until every chunk before them is encrypted
+    splittable = not (args["--dedup"] or args["--compress"] is not None)
+
+    resolve_engine(args, *sample_sizes(walk_target(target, output_root)))
 
     def run_dircrypt() -> None:
-        """Runs dircrypt over process pool"""
-        crypting_tasks = []
-        with Pool(processes=num_available_cpus()) as pool:
-            # manually apply_async() to avoid chunking overhead from pool.map()
-            for path_to_file in dir_walk(target):
-                crypt_task = pool.apply_async(func=crypt_path_and_contents,
-                                              args=(dir_builder, path_to_file))
-                crypting_tasks.append(crypt_task)
+        """Runs dircrypt over a process (or thread) pool"""
+        num_failed = 0
+
+        def finish_file(source: Path, stat: os.stat_result,
+                        crypted_file: Optional[Path]) -> None:
+            """
+            Records (and journals) the output of a finished file, then
+            removes the output it replaces. A file that failed keeps its
+            previous output, and its record, so that --update retries it.
+            """
+            nonlocal num_failed
+            if crypted_file is None:
+                num_failed += 1
+                if manifest is not None and \
+                   old_manifest.output_file(source) is not None:
+                    manifest.copy_file(source, old_manifest)
+                return
+            output = crypted_file.relative_to(output_dir)
+            if manifest is not None:
+                manifest.record_file(source, stat, output)
+            if journal is not None:
+                journal.record_file(source, stat, output)
+            if old_manifest.output_file(source) != output.as_posix():
+                old_manifest.remove_output(source, output_dir)
+
+        def finish_range(source: Path, stat: os.stat_result, original: Path,
+                         crypted_file: Path, results: List[Optional[bool]],
+                         num_ranges: int, result: Optional[bool]) -> None:
+            """
+            Collects the result of a chunk range, finishing its file once
+            every range is done
+            """
+            results.append(result)
+            if len(results) == num_ranges:
+                finish_file(source, stat,
+                            finish_split_file(original, crypted_file,
+                                              results, journal is not None))
+
+        # Results are handed back while the target is still being walked, so
+        # that only a window of files is ever held here at once
+        progress = start_progress(args)
+        with create_pool(args["--workers"], args["--engine"],
+                         progress) as pool:
+            scheduler = Scheduler(pool, args["--workers"],
+                                  args["--max-in-flight"], progress)
+            walk = walk_target(target, output_root,
+                               None if only is None else include_dir)
+            for file_entry in walk:
+                path_to_file = file_entry.path
+                # Names are decrypted here, rather than in the workers, so
+                # that unselected files are never read
+                crypted_name = None
+                if only is not None:
+                    crypted_name = dir_builder.build_file_name(path_to_file)
+                    crypted_file = dir_builder.build_dir_path(path_to_file)\
+                                              .joinpath(crypted_name)
+                    if not only.matches(
+                            crypted_file.relative_to(output_dir).parts):
+                        continue
+
+                stat = file_entry.stat()
+                source = path_to_file.relative_to(path_to_target)
+                if old_manifest.is_unchanged(source, stat, output_dir):
+                    if manifest is not None:
+                        manifest.copy_file(source, old_manifest)
+                    if progress is not None:
+                        progress.skip(stat.st_size)
+                    continue
+
+                if stat.st_size > SPLIT_FILE_SIZE and splittable:
+                    split_file = start_split_file(dir_builder, path_to_file,
+                                                  crypted_name)
+                    if split_file is None:
+                        finish_file(source, stat, None)
+                        continue
+                    (crypted_file, file_cryptor, chunk_ranges) = split_file
+                    on_done = partial(finish_range, source, stat,
+                                      path_to_file, crypted_file, [],
+                                      len(chunk_ranges))
+                    for (first, last) in chunk_ranges:
+                        scheduler.add(crypt_chunk_range,
+                                      (dir_builder, path_to_file, crypted_file,
+                                       file_cryptor, first, last),
+                                      stat.st_size - first *
+                                      file_cryptor.read_len if last is None
+                                      else (last - first) *
+                                      file_cryptor.read_len,
+                                      on_done, num_files=int(first == 0))
+                    continue
+
+                crypted_dir = dir_builder.build_dir_path(path_to_file)
+                scheduler.add(crypt_path_and_contents,
+                              (dir_builder, path_to_file, crypted_dir,
+                               crypted_name),
+                              stat.st_size,
+                              partial(finish_file, source, stat))
+            scheduler.finish()
+        if progress is not None:
+            progress.finish()
 
-            _ = [task.get() for task in crypting_tasks]
+        if manifest is not None:
+            old_manifest.remove_stale_outputs(manifest, output_dir)
+            manifest.record_dirs(dir_builder.visited_dirs, output_dir)
+            save_manifest(manifest, output_dir, mode)
+        if journal is not None:
+            finish_journal(journal, output_dir, num_failed)
 
     print("{} '{}'".format(mode.verb, target))
     if __debug__:
@@ -102,6 +990,7 @@ def main():
     else:
         run_dircrypt()
     print("Finished {} '{}'".format(mode.verb, target))
+    report_stats(args["--stats-json"])
 
 # -----------------------------------------------------------------------------
 
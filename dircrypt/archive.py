@@ -0,0 +1,296 @@
+"""
+archive
+
+Packed archives: a single file alternative to encrypted directory trees, for
+trees of many small files. Every file is encrypted into a record of the
+archive, and the records are followed by an encrypted index of their paths.
+"""
+__all__ = ['FileWindow', 'ArchiveIndex', 'is_archive', 'record_size',
+           'start_archive', 'pack_file', 'finish_archive',
+           'read_archive_index', 'select_sources', 'unpack_file',
+           'is_record_of', 'ARCHIVE_SUFFIX']
+
+import io
+import json
+import struct
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from dircrypt.aux import debug_print
+from dircrypt.cryptor import (Encryptor, Decryptor, FileCryptor,
+                              unpack_file_header, FILE_HEADER_SIZE)
+from dircrypt.ioutils import (create_partial_file, commit_partial_file,
+                              label_malformed)
+from dircrypt.routines import crypt_chunks
+
+# -----------------------------------------------------------------------------
+
+# "DCRA" | version | record_0 | ... | record_n | index | trailer
+ARCHIVE_MAGIC = b"DCRA"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = ARCHIVE_MAGIC + bytes([ARCHIVE_VERSION])
+# index offset | index length | "DCRA"
+ARCHIVE_TRAILER = struct.Struct(">QQ4s")
+ARCHIVE_SUFFIX = ".dca"
+INDEX_VERSION = 1
+
+# Maps every source file (relative to the directory containing the target, in
+# posix form) to the offset and length of its record, and its file salt (from
+# its header), so that records can't be swapped with each other, unnoticed
+ArchiveIndex = Dict[str, Tuple[int, int, bytes]]
+
+# -----------------------------------------------------------------------------
+
+class FileWindow(io.RawIOBase):
+    """
+    A read only view of the `length` bytes of `file` starting at `offset`, so
+    that reads of a record never spill over into the next one.
+    """
+
+    def __init__(self, file: BinaryIO, offset: int, length: int):
+        super().__init__()
+        self._file = file
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        file.seek(offset)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        """Reads up to the end of the window"""
+        num_wanted = min(len(buf), self._length - self._pos)
+        if num_wanted <= 0:
+            return 0
+        with memoryview(buf) as view:
+            num_read = self._file.readinto(view[:num_wanted])
+        self._pos += num_read
+        return num_read
+
+    def seek(self, pos: int, whence: int=io.SEEK_SET) -> int:
+        """Seeks within the window"""
+        base = {io.SEEK_SET: 0,
+                io.SEEK_CUR: self._pos,
+                io.SEEK_END: self._length}[whence]
+        self._pos = max(0, base + pos)
+        self._file.seek(self._offset + self._pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+# -----------------------------------------------------------------------------
+
+def is_archive(path: Path) -> bool:
+    """
+    Whether `path` is a packed archive.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    if not path.is_file():
+        return False
+    with path.open(mode="rb") as arch:
+        return arch.read(len(ARCHIVE_HEADER)) == ARCHIVE_HEADER
+
+def record_size(file_cryptor: FileCryptor, size: int) -> int:
+    """
+    The length of the record of a `size` byte file, when encrypted like
+    `file_cryptor` (which must not compress or deduplicate its chunks).
+    """
+    assert(file_cryptor.encrypting and file_cryptor.store_cryptor is None)
+    num_chunks = -(-size // file_cryptor.read_len)
+    if file_cryptor.marks_final:
+        num_chunks = max(1, num_chunks) # empty files hold an empty chunk
+    chunk_overhead = file_cryptor.write_len - file_cryptor.read_len
+    return file_cryptor.write_offset + size + num_chunks * chunk_overhead
+
+def start_archive(archive: Path) -> int:
+    """
+    Writes the archive header to `archive`, returning the offset of its first
+    record.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    archive.write_bytes(ARCHIVE_HEADER)
+    return len(ARCHIVE_HEADER)
+
+def pack_file(
+        mode: Encryptor,
+        original: Path,
+        archive: Path,
+        offset: int,
+        size: int
+    ) -> Optional[bytes]:
+    """
+    Encrypts the first `size` bytes of `original` into the record at `offset`
+    in `archive`, as sized by `record_size`. Returns the record's file salt,
+    for its index entry, or `None` if `original` has shrunk since it was
+    sized, in which case the record is incomplete. `OSError`'s are logged to
+    the end user, and `None` is returned.
+    """
+    try:
+        with original.open(mode="rb") as orig, \
+             archive.open(mode="r+b") as arch:
+            arch.seek(offset)
+            contents = FileWindow(orig, 0, size)
+            header = mode.new_file_header()
+            arch.write(header)
+            file_cryptor = mode.file_cryptor(header)
+            success = crypt_chunks(file_cryptor, contents, arch)
+            assert(success)
+            complete = arch.tell() - offset == record_size(file_cryptor, size)
+
+        if not complete:
+            print("'{}' changed while being archived, and was skipped"\
+                  .format(original))
+        debug_print("{} -> {}@{}".format(original, archive, offset))
+        return unpack_file_header(header).file_salt if complete else None
+
+    except OSError as e:
+        err_msg = "Error handling '{}'. Failed with '{}'".format(original, e)
+        print(err_msg)
+        return None
+
+def finish_archive(
+        archive: Path,
+        index_offset: int,
+        index: ArchiveIndex,
+        mode: Encryptor
+    ) -> None:
+    """
+    Encrypts `index` to `index_offset` in `archive` (i.e. the end of its last
+    record), followed by the trailer locating it.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    files = {src: (offset, length, file_salt.hex())
+             for (src, (offset, length, file_salt)) in index.items()}
+    data = {"version": INDEX_VERSION, "files": files}
+    contents = io.BytesIO(json.dumps(data).encode("utf-8"))
+
+    with archive.open(mode="r+b") as arch:
+        arch.seek(index_offset)
+        file_cryptor = mode.start_file(contents, arch)
+        success = crypt_chunks(file_cryptor, contents, arch)
+        assert(success)
+        index_len = arch.tell() - index_offset
+        arch.write(ARCHIVE_TRAILER.pack(index_offset, index_len,
+                                        ARCHIVE_MAGIC))
+        arch.truncate()
+
+def read_archive_index(
+        archive: Path,
+        mode: Decryptor
+    ) -> Optional[ArchiveIndex]:
+    """
+    Decrypts the index of `archive`, without reading any of its records.
+    Returns `None` if it can't be decrypted (e.g. the password is wrong).
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    contents = io.BytesIO()
+    with archive.open(mode="rb") as arch:
+        archive_len = arch.seek(0, io.SEEK_END)
+        if archive_len < len(ARCHIVE_HEADER) + ARCHIVE_TRAILER.size:
+            return None
+        arch.seek(archive_len - ARCHIVE_TRAILER.size)
+        (index_offset, index_len, magic) = \
+            ARCHIVE_TRAILER.unpack(arch.read(ARCHIVE_TRAILER.size))
+        if magic != ARCHIVE_MAGIC:
+            return None
+
+        window = FileWindow(arch, index_offset, index_len)
+        file_cryptor = mode.start_file(window, contents)
+        if file_cryptor is None or \
+           not crypt_chunks(file_cryptor, window, contents):
+            return None
+
+    try:
+        data = json.loads(contents.getvalue().decode("utf-8"))
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return {src: (offset, length, bytes.fromhex(file_salt))
+                for (src, (offset, length, file_salt))
+                in data["files"].items()}
+    except ValueError:
+        return None
+
+def select_sources(index: ArchiveIndex, path: str) -> ArchiveIndex:
+    """The records of `path` in `index`, or of every file under it"""
+    prefix = PurePosixPath(path).as_posix() + "/"
+    return {src: entry for (src, entry) in index.items()
+            if src == prefix[:-1] or src.startswith(prefix)}
+
+def is_record_of(record: BinaryIO, file_salt: bytes) -> bool:
+    """
+    Whether `record` (a `FileWindow`) is the record whose index entry has
+    `file_salt` (i.e. it hasn't been swapped with another), leaving it at its
+    start.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    header = unpack_file_header(record.read(FILE_HEADER_SIZE))
+    record.seek(0)
+    return header is not None and header.file_salt == file_salt
+
+def unpack_file(
+        mode: Decryptor,
+        archive: Path,
+        source: str,
+        offset: int,
+        length: int,
+        file_salt: bytes,
+        output_dir: Path
+    ) -> Optional[Path]:
+    """
+    Decrypts the record of `source`, at `offset` in `archive`, to the same
+    relative path in `output_dir`, checking it against the `file_salt` of its
+    index entry. Returns the output file, or `None` if an `OSError` occurred
+    (or `source` would escape `output_dir`). `OSError`'s are logged to the end
+    user, but otherwise swallowed.
+    """
+    source_path = PurePosixPath(source)
+    if source_path.is_absolute() or ".." in source_path.parts:
+        print("Refusing to unpack '{}' outside of '{}'"\
+              .format(source, output_dir))
+        return None
+    crypted_file = output_dir.joinpath(*source_path.parts)
+
+    try:
+        partial = create_partial_file(crypted_file)
+        with archive.open(mode="rb") as arch, \
+             partial.open(mode="wb") as targ:
+            window = FileWindow(arch, offset, length)
+            file_cryptor = mode.start_file(window, targ) \
+                           if is_record_of(window, file_salt) else None
+            success = file_cryptor is not None and \
+                      crypt_chunks(file_cryptor, window, targ)
+        commit_partial_file(crypted_file)
+
+        if not success:
+            crypted_file = label_malformed(crypted_file)
+            print("Decrypting '{}' contents failed. "\
+                    "View '{}' at your own risk."\
+                    .format(source, crypted_file))
+
+        debug_print("{}@{} -> {}".format(archive, offset, crypted_file))
+        return crypted_file
+
+    except OSError as e:
+        err_msg = "Error handling '{}'. Failed with '{}'".format(source, e)
+        print(err_msg)
+        return None
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
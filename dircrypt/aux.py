@@ -3,8 +3,8 @@ aux
 
 Misc helper utilities.
 """
-__all__ = ['implies', 'starts_with', 'debug_print', 'bench',
-           'num_available_cpus']
+__all__ = ['implies', 'starts_with', 'debug_print', 'set_quiet', 'is_quiet',
+           'bench', 'num_available_cpus', 'parse_size', 'format_size']
 
 import os
 from timeit import default_timer
@@ -15,6 +15,11 @@ from typing import TypeVar, Sequence, Tuple, Callable, Dict
 T = TypeVar('T')
 F = Callable[[], None]
 
+SIZE_SUFFIXES = ("", "K", "M", "G", "T")
+
+# Whether `debug_print` is silenced, in this process (see --quiet)
+_QUIET = False
+
 # -----------------------------------------------------------------------------
 
 def implies(cond1: bool, cond2: bool) -> bool:
@@ -29,10 +34,19 @@ def starts_with(full: Sequence[T], sub: Sequence[T]) -> bool:
         return full[:len(sub)] == sub
 
 def debug_print(*args, **kwargs) -> None:
-    """Wrapper for printing in __debug__ builds"""
-    if __debug__:
+    """Wrapper for printing in __debug__ builds, unless quieted"""
+    if __debug__ and not _QUIET:
         print("DEBUG :: ", *args, **kwargs)
 
+def set_quiet(quiet: bool=True) -> None:
+    """Silences (or unsilences) `debug_print`, in this process"""
+    global _QUIET # pylint: disable=global-statement
+    _QUIET = quiet
+
+def is_quiet() -> bool:
+    """Whether `debug_print` is silenced, in this process"""
+    return _QUIET
+
 def num_available_cpus() -> int:
     """
     Number of available cpus for current process. By default, this tries to
@@ -46,6 +60,25 @@ def num_available_cpus() -> int:
     except AttributeError:
         return os.cpu_count()
 
+def parse_size(size: str) -> int:
+    """
+    Parses a number of bytes, with an optional binary suffix (e.g. '16K' or
+    '4M'). Raises `ValueError` on malformed sizes.
+    """
+    size = size.strip().upper()
+    for (power, suffix) in reversed(list(enumerate(SIZE_SUFFIXES))):
+        if suffix != "" and size.endswith(suffix):
+            return int(size[:-len(suffix)]) * 1024**power
+    return int(size)
+
+def format_size(size: int) -> str:
+    """Inverse of `parse_size`, using the largest exact suffix"""
+    power = 0
+    while size != 0 and size % 1024 == 0 and power + 1 < len(SIZE_SUFFIXES):
+        size //= 1024
+        power += 1
+    return "{}{}".format(size, SIZE_SUFFIXES[power])
+
 def bench(**jobs: Dict[T, F]) -> None:
     """Naively benchmarks the given functions."""
     for name, job in jobs.items():
@@ -0,0 +1,8 @@
+"""
+benchmarks
+
+Benchmarks for dircrypt's hot paths. Each module is runnable on its own, e.g.
+`python -m dircrypt.benchmarks.chunk_copies`.
+"""
+__all__ = ["chunk_copies", "chunk_sizes", "workloads", "round_trips",
+           "walks", "startup"]
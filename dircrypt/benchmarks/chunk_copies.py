@@ -0,0 +1,164 @@
+"""
+chunk_copies
+
+Measures the memory allocated per chunk by the chunk pipeline, before and
+after switching `crypt_chunks` to reusable buffers.
+
+    python -m dircrypt.benchmarks.chunk_copies [num_chunks]
+"""
+__all__ = ['read_and_crypt', 'readinto_and_crypt', 'measure']
+
+import io
+import os
+import sys
+import tracemalloc
+from typing import BinaryIO, Callable, Dict, Optional
+
+from dircrypt.routines import crypt_chunks
+from dircrypt.cryptor import (FileCryptor, FileHeader, _V2FileCryptor,
+                              KEY_SIZE, SALT_SIZE)
+
+# -----------------------------------------------------------------------------
+
+Pipeline = Callable[[FileCryptor, BinaryIO, BinaryIO], bool]
+
+class Probe(object):
+    """
+    Records the peak traced memory, above the baseline, in between calls to
+    `mark`. Since every buffer is still alive when the next mark is hit, this
+    is the memory allocated in between marks.
+    """
+
+    def __init__(self):
+        self.samples = [] # List[int]
+        self._baseline = 0
+
+    def mark(self) -> None:
+        """Records the allocations since the last mark"""
+        (_, peak) = tracemalloc.get_traced_memory()
+        self.samples.append(peak - self._baseline)
+        tracemalloc.reset_peak()
+        (self._baseline, _) = tracemalloc.get_traced_memory()
+
+class ProbedReader(io.BufferedReader):
+    """Marks the probe on every read"""
+
+    def __init__(self, raw: BinaryIO, probe: Probe):
+        super().__init__(raw)
+        self._probe = probe
+
+    def read(self, *args) -> bytes:
+        self._probe.mark()
+        return super().read(*args)
+
+    def readinto(self, *args) -> int:
+        self._probe.mark()
+        return super().readinto(*args)
+
+class ProbedCryptor(FileCryptor):
+    """Marks the probe before and after (en|de)crypting every chunk"""
+
+    def __init__(self, file_cryptor: FileCryptor, probe: Probe):
+        self._file_cryptor = file_cryptor
+        self._probe = probe
+
+    def crypt_chunk(self, index: int, data: bytes) -> Optional[bytes]:
+        self._probe.mark()
+        crypted = self._file_cryptor.crypt_chunk(index, data)
+        self._probe.mark()
+        return crypted
+
+    def crypt_chunk_into(self, index: int, data: memoryview,
+                         out: memoryview) -> Optional[int]:
+        self._probe.mark()
+        num_crypted = self._file_cryptor.crypt_chunk_into(index, data, out)
+        self._probe.mark()
+        return num_crypted
+
+    encrypting = property(lambda self: self._file_cryptor.encrypting)
+    read_len = property(lambda self: self._file_cryptor.read_len)
+    write_len = property(lambda self: self._file_cryptor.write_len)
+    read_offset = property(lambda self: self._file_cryptor.read_offset)
+    write_offset = property(lambda self: self._file_cryptor.write_offset)
+
+class NullWriter(io.RawIOBase):
+    """Discards everything written to it, without copying"""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return len(data)
+
+# -----------------------------------------------------------------------------
+
+def read_and_crypt(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        targ: BinaryIO
+    ) -> bool:
+    """The chunk pipeline before `crypt_chunks`: fresh `bytes` per chunk"""
+    index = 0
+    contents = orig.read(file_cryptor.read_len)
+
+    while contents not in (b'', None):
+        crypted_contents = file_cryptor.crypt_chunk(index, contents)
+        if crypted_contents is None:
+            return False
+        targ.write(crypted_contents)
+        index += 1
+        contents = orig.read(file_cryptor.read_len)
+
+    return True
+
+def readinto_and_crypt(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        targ: BinaryIO
+    ) -> bool:
+    """The current chunk pipeline"""
+    return crypt_chunks(file_cryptor, orig, targ)
+
+def measure(pipeline: Pipeline, num_chunks: int) -> Dict[str, float]:
+    """
+    Encrypts a file of `num_chunks` random chunks with `pipeline`, and reports
+    the bytes allocated per chunk, and the number of allocations of at least
+    half a chunk (i.e. chunk copies) per chunk. The one off cost of setting up
+    the pipeline is reported separately.
+    """
+    probe = Probe()
+    header = FileHeader(os.urandom(SALT_SIZE), os.urandom(SALT_SIZE))
+    file_cryptor = _V2FileCryptor(os.urandom(KEY_SIZE), header,
+                                  encrypting=True)
+    file_cryptor = ProbedCryptor(file_cryptor, probe)
+    contents = io.BytesIO(os.urandom(file_cryptor.read_len * num_chunks))
+    orig = ProbedReader(contents, probe)
+
+    tracemalloc.start()
+    probe.mark()
+    success = pipeline(file_cryptor, orig, NullWriter())
+    assert(success)
+    tracemalloc.stop()
+
+    # The first mark only resets the peak, and the second ends the setup
+    (_, setup, *per_chunk) = probe.samples
+    copies = [sample for sample in per_chunk
+              if sample >= file_cryptor.read_len // 2]
+    return {
+        "setup bytes allocated": setup,
+        "bytes allocated per chunk": sum(per_chunk) / num_chunks,
+        "chunk copies per chunk": len(copies) / num_chunks,
+    }
+
+def main(num_chunks: int=1000) -> None:
+    """Prints the measurements for both pipelines"""
+    for (name, pipeline) in (("before (read)", read_and_crypt),
+                             ("after (readinto)", readinto_and_crypt)):
+        print(name)
+        for (stat, value) in measure(pipeline, num_chunks).items():
+            print("    {}: {:.1f}".format(stat, value))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
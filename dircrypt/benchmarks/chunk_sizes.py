@@ -0,0 +1,106 @@
+"""
+chunk_sizes
+
+Measures (en|de)cryption throughput across chunk sizes on the local machine,
+and recommends a `--chunk-size`. Also available as `dircrypt bench-chunks`.
+
+    python -m dircrypt.benchmarks.chunk_sizes [bench_size]
+"""
+__all__ = ['bench_chunk_sizes', 'recommend_chunk_size', 'CHUNK_SIZES']
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+from timeit import default_timer
+from typing import Dict, Iterable, Tuple
+
+from dircrypt.aux import parse_size, format_size
+from dircrypt.routines import crypt_chunks
+from dircrypt.cryptor import FileHeader, _V2FileCryptor, KEY_SIZE, SALT_SIZE
+
+# -----------------------------------------------------------------------------
+
+CHUNK_SIZES = (2**14, 2**16, 2**18, 2**20, 2**22) # 16K to 4M
+DEFAULT_BENCH_SIZE = 2**26 # 64 MiB
+
+# Chunk sizes within this fraction of the best throughput are considered
+# equivalent, in which case the smallest (i.e. least memory hungry) one wins
+TOLERANCE = 0.05
+
+# -----------------------------------------------------------------------------
+
+def bench_chunk_sizes(
+        bench_size: int=DEFAULT_BENCH_SIZE,
+        chunk_sizes: Iterable[int]=CHUNK_SIZES
+    ) -> Dict[int, Tuple[float, float]]:
+    # pylint: disable=invalid-sequence-index
+    """
+    Encrypts, then decrypts, a temporary file of `bench_size` random bytes for
+    each chunk size. Returns the encryption and decryption throughput (in
+    MB/s) for each chunk size.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="dircrypt_bench") as tmp_dir:
+        plain = Path(tmp_dir, "plain")
+        crypted = Path(tmp_dir, "crypted")
+        restored = Path(tmp_dir, "restored")
+
+        with plain.open(mode="wb") as plain_file:
+            for _ in range(0, bench_size, 2**20):
+                plain_file.write(os.urandom(2**20))
+
+        key = os.urandom(KEY_SIZE)
+        for chunk_size in chunk_sizes:
+            header = FileHeader(os.urandom(SALT_SIZE), os.urandom(SALT_SIZE),
+                                chunk_size)
+            enc_time = _time_crypt(_V2FileCryptor(key, header, True),
+                                   plain, crypted)
+            dec_time = _time_crypt(_V2FileCryptor(key, header, False),
+                                   crypted, restored)
+            megabytes = plain.stat().st_size / 10**6
+            results[chunk_size] = (megabytes / enc_time, megabytes / dec_time)
+
+    return results
+
+def recommend_chunk_size(results: Dict[int, Tuple[float, float]]) -> int:
+    # pylint: disable=invalid-sequence-index
+    """
+    The smallest chunk size whose round trip throughput is within `TOLERANCE`
+    of the best one, given the results of `bench_chunk_sizes`.
+    """
+    round_trip = {chunk_size: 1 / (1 / enc + 1 / dec)
+                  for (chunk_size, (enc, dec)) in results.items()}
+    best = max(round_trip.values())
+    return min(chunk_size for (chunk_size, throughput) in round_trip.items()
+               if throughput >= (1 - TOLERANCE) * best)
+
+def _time_crypt(file_cryptor: _V2FileCryptor, original: Path,
+                target: Path) -> float:
+    """
+    Times (en|de)crypting `original` to `target`, in seconds. The file header
+    is only a placeholder, since keys are handed out directly.
+    """
+    start_time = default_timer()
+    with original.open(mode="rb") as orig, target.open(mode="wb") as targ:
+        orig.seek(file_cryptor.read_offset)
+        targ.write(bytes(file_cryptor.write_offset))
+        success = crypt_chunks(file_cryptor, orig, targ)
+        assert(success)
+    return default_timer() - start_time
+
+def main(bench_size: int=DEFAULT_BENCH_SIZE) -> None:
+    """Prints the throughput of each chunk size, and the recommended one"""
+    print("Benchmarking chunk sizes over {} of random data"\
+          .format(format_size(bench_size)))
+    results = bench_chunk_sizes(bench_size)
+    for (chunk_size, (enc, dec)) in results.items():
+        print("    {:>5}: encrypt {:8.1f} MB/s, decrypt {:8.1f} MB/s"\
+              .format(format_size(chunk_size), enc, dec))
+    print("Recommended: --chunk-size={}"\
+          .format(format_size(recommend_chunk_size(results))))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main(*map(parse_size, sys.argv[1:]))
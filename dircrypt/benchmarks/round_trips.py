@@ -0,0 +1,161 @@
+"""
+round_trips
+
+Encrypts, then decrypts, each synthetic workload through the dircrypt command
+line, and records the time, throughput and peak memory of every phase as JSON
+(along with where dircrypt's own time went, as reported by --stats), so that
+runs can be compared over time.
+
+Usage:
+    round_trips [<workload>...] [--workers=<n>] [--scale=<f>] [--out=<json>]
+
+Options:
+    --workers=<n>   number of dircrypt worker processes (by default, one per
+                    available cpu)
+    --scale=<f>     size of every workload, relative to its default
+                    [default: 1]
+    --out=<json>    file to write the results to, instead of STDOUT
+"""
+__all__ = ['run_phase', 'round_trip', 'trees_equal']
+
+import os
+import sys
+import json
+import filecmp
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from timeit import default_timer
+from typing import Any, Dict, List
+
+from docopt import docopt
+
+from dircrypt.aux import num_available_cpus
+from dircrypt.benchmarks.workloads import WORKLOADS
+
+# -----------------------------------------------------------------------------
+
+# Lets the dircrypt child processes import this copy of dircrypt
+PACKAGE_ROOT = str(Path(__file__).resolve().parents[2])
+
+# -----------------------------------------------------------------------------
+
+def run_phase(args: List[str], cwd: Path,
+              stats: bool=False) -> Dict[str, Any]:
+    """
+    Runs `python -m dircrypt <args>` in `cwd`, with the same optimization level
+    as this process. Returns its wall clock time (in seconds), and the peak
+    RSS (in KiB) of it and its workers. With `stats`, dircrypt also times its
+    own phases (see --stats), whose breakdown is returned too.
+    """
+    stats_json = cwd.joinpath("dircrypt.stats.json")
+    if stats:
+        args = args + ["--stats-json={}".format(stats_json)]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (PACKAGE_ROOT,
+                                                      env.get("PYTHONPATH"))))
+    command = [sys.executable] + ["-O"] * sys.flags.optimize + \
+              ["-m", "dircrypt"] + args
+
+    start_time = default_timer()
+    proc = subprocess.Popen(command, cwd=str(cwd), env=env,
+                            stdout=subprocess.DEVNULL)
+    # unlike `proc.wait()`, `wait4` reports the resources the child used
+    (_, status, usage) = os.wait4(proc.pid, 0)
+    seconds = default_timer() - start_time
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        raise RuntimeError("'{}' failed with {}".format(" ".join(args),
+                                                        proc.returncode))
+    result = {"seconds": seconds, "peak_rss_kib": usage.ru_maxrss}
+    if stats:
+        result["stats"] = json.loads(stats_json.read_text())
+        stats_json.unlink()
+    return result
+
+def round_trip(workload: str, workers: int, scale: float) -> Dict[str, Any]:
+    """
+    Generates `workload` in a temporary directory, then encrypts and decrypts
+    it with `workers` worker processes, checking that it survived intact.
+    Both are broken down into dircrypt's own phases (key derivation, reads,
+    writes, etc.), whose timing slows them down a little.
+    """
+    with tempfile.TemporaryDirectory(prefix="dircrypt_bench") as tmp_dir:
+        cwd = Path(tmp_dir)
+        start_time = default_timer()
+        generated = WORKLOADS[workload](cwd.joinpath("tree"), scale)
+        phases = {"generate": {"seconds": default_timer() - start_time}}
+
+        worker_args = ["--workers={}".format(workers)]
+        phases["encrypt"] = run_phase(["-e", "tree", "--gen", "--as=enc"] +
+                                      worker_args, cwd, stats=True)
+        (encrypted,) = (path for path in cwd.joinpath("enc").iterdir()
+                        if path.is_dir())
+        phases["decrypt"] = run_phase(["-d", str(encrypted),
+                                       "--with=dircrypt.password",
+                                       "--as=dec"] + worker_args, cwd,
+                                      stats=True)
+
+        start_time = default_timer()
+        intact = trees_equal(cwd.joinpath("tree"), cwd.joinpath("dec", "tree"))
+        phases["verify"] = {"seconds": default_timer() - start_time}
+
+    for phase in ("encrypt", "decrypt"):
+        seconds = phases[phase]["seconds"]
+        phases[phase]["files_per_s"] = generated.num_files / seconds
+        phases[phase]["mb_per_s"] = generated.num_bytes / 10**6 / seconds
+
+    return {"workload": workload,
+            "files": generated.num_files,
+            "bytes": generated.num_bytes,
+            "intact": intact,
+            "phases": phases}
+
+def trees_equal(left: Path, right: Path) -> bool:
+    """Whether the two directory trees hold the same files, byte for byte"""
+    comparison = filecmp.dircmp(str(left), str(right))
+    if comparison.left_only or comparison.right_only or comparison.funny_files:
+        return False
+    (_, mismatch, errors) = filecmp.cmpfiles(str(left), str(right),
+                                             comparison.common_files,
+                                             shallow=False)
+    if mismatch or errors:
+        return False
+    return all(trees_equal(left.joinpath(subdir), right.joinpath(subdir))
+               for subdir in comparison.common_dirs)
+
+def main(arg_list: List[str]=sys.argv[1:]) -> None:
+    """Runs the round trip of every requested workload, and reports them"""
+    args = docopt(__doc__, argv=arg_list)
+    workloads = args["<workload>"] or list(WORKLOADS)
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            sys.exit("Unknown workload '{}'. Must be one of {}"\
+                     .format(workload, ", ".join(WORKLOADS)))
+    workers = num_available_cpus() if args["--workers"] is None \
+              else int(args["--workers"])
+    scale = float(args["--scale"])
+
+    results = {"python": platform.python_version(),
+               "platform": platform.platform(),
+               "cpus": num_available_cpus(),
+               "optimized": bool(sys.flags.optimize),
+               "workers": workers,
+               "scale": scale,
+               "workloads": []}
+    for workload in workloads:
+        print("Benchmarking '{}'".format(workload), file=sys.stderr)
+        results["workloads"].append(round_trip(workload, workers, scale))
+
+    report = json.dumps(results, indent=4)
+    if args["--out"] is None:
+        print(report)
+    else:
+        Path(args["--out"]).write_text(report + "\n")
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
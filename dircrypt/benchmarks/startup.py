@@ -0,0 +1,147 @@
+"""
+startup
+
+Measures what small runs of dircrypt mostly pay for: starting up. Reports, as
+JSON, the time to import `dircrypt.__main__` (and the slowest modules it
+imports, from `python -X importtime`), whether the modules only some runs need
+(`DEFERRED_MODULES`) were left out of it, and the wall clock time of
+encrypting a single 1 KiB file through the command line, next to that of
+starting an empty interpreter.
+
+Only those modules are deferred. The ciphers and KDFs (i.e. cryptography) are
+needed by every run, before any of its work, so they're imported at startup,
+and counted in the import time.
+
+Usage:
+    startup [--runs=<n>] [--top=<n>] [--out=<json>]
+
+Options:
+    --runs=<n>  number of times each measurement is repeated, of which the
+                median is reported [default: 10]
+    --top=<n>   number of the slowest imports to report [default: 10]
+    --out=<json>    file to write the results to, instead of STDOUT
+"""
+__all__ = ['import_times', 'time_interpreter', 'time_small_encrypt',
+           'DEFERRED_MODULES']
+
+import os
+import sys
+import json
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from statistics import median
+from timeit import default_timer
+from typing import Dict, List, Tuple
+
+from docopt import docopt
+
+from dircrypt.benchmarks.round_trips import run_phase, PACKAGE_ROOT
+
+# -----------------------------------------------------------------------------
+
+SMALL_FILE_SIZE = 2**10 # 1 KiB
+
+# Imported on first use, rather than by `dircrypt.__main__`, since only some
+# runs need them (pools, --dedup, --verify, --compress=lzma, and typed in
+# passwords)
+DEFERRED_MODULES = ("multiprocessing", "hashlib", "dircrypt.verify", "lzma",
+                    "getpass", "dircrypt.benchmarks.chunk_sizes")
+
+# -----------------------------------------------------------------------------
+
+def _python() -> List[str]:
+    """This interpreter, with the same optimization level as this process"""
+    return [sys.executable] + ["-O"] * sys.flags.optimize
+
+def import_times() -> Dict[str, Tuple[int, int]]:
+    """
+    The self and cumulative import time (in microseconds) of every module
+    `dircrypt.__main__` imports (itself included), in a fresh interpreter
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (PACKAGE_ROOT,
+                                                      env.get("PYTHONPATH"))))
+    proc = subprocess.run(_python() + ["-X", "importtime", "-c",
+                                       "import dircrypt.__main__"],
+                          env=env, stderr=subprocess.PIPE, check=True,
+                          universal_newlines=True)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        # e.g. "import time:       730 |      45171 | dircrypt.__main__"
+        fields = line.split(":", 1)[-1].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or \
+           not fields[0].strip().isdigit():
+            continue
+        times[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return times
+
+def time_interpreter() -> float:
+    """The wall clock time (in seconds) of starting an empty interpreter"""
+    start_time = default_timer()
+    subprocess.run(_python() + ["-c", "pass"], check=True)
+    return default_timer() - start_time
+
+def time_small_encrypt(cwd: Path, run: int) -> Dict[str, float]:
+    """
+    Encrypts a single `SMALL_FILE_SIZE` file in `cwd` (into a new output, for
+    the `run`th time) through the command line. Returns its wall clock time,
+    and peak RSS, as per `run_phase`.
+    """
+    small_file = cwd.joinpath("small.bin")
+    if not small_file.exists():
+        small_file.write_bytes(os.urandom(SMALL_FILE_SIZE))
+    return run_phase(["-e", small_file.name, "--gen",
+                      "--as=enc{}".format(run)], cwd)
+
+def main(arg_list: List[str]=sys.argv[1:]) -> None:
+    """Runs every startup measurement, and reports them"""
+    args = docopt(__doc__, argv=arg_list)
+    (runs, top) = (int(args["--runs"]), int(args["--top"]))
+    if runs <= 0 or top < 0:
+        sys.exit("--runs must be positive, and --top can't be negative")
+
+    print("Timing imports", file=sys.stderr)
+    all_times = [import_times() for _ in range(runs)]
+    slowest = sorted(all_times[-1].items(), key=lambda item: item[1][0],
+                     reverse=True)[:top]
+
+    print("Timing a {} byte encryption".format(SMALL_FILE_SIZE),
+          file=sys.stderr)
+    interpreter = [time_interpreter() for _ in range(runs)]
+    with tempfile.TemporaryDirectory(prefix="dircrypt_bench") as tmp_dir:
+        encrypts = [time_small_encrypt(Path(tmp_dir), run)
+                    for run in range(runs)]
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "optimized": bool(sys.flags.optimize),
+        "runs": runs,
+        "import_ms": median(times["dircrypt.__main__"][1]
+                            for times in all_times) / 10**3,
+        "slowest_imports": [{"module": module,
+                             "self_ms": self_us / 10**3,
+                             "cumulative_ms": cumulative_us / 10**3}
+                            for (module, (self_us, cumulative_us))
+                            in slowest],
+        "deferred": {module: module not in all_times[-1]
+                     for module in DEFERRED_MODULES},
+        "interpreter_s": median(interpreter),
+        "small_encrypt_s": median(run["seconds"] for run in encrypts),
+        "small_encrypt_peak_rss_kib": median(run["peak_rss_kib"]
+                                             for run in encrypts),
+    }
+
+    report = json.dumps(results, indent=4)
+    if args["--out"] is None:
+        print(report)
+    else:
+        Path(args["--out"]).write_text(report + "\n")
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
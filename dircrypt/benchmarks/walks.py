@@ -0,0 +1,156 @@
+"""
+walks
+
+Counts the metadata syscalls it takes to walk a reference tree (and `stat`
+every file in it, as dircrypt does), with the `os.scandir` based
+`walk_files`, against a walk over `Path.iterdir` that tells items apart with
+`is_dir` and `is_file`.
+
+    python -m dircrypt.benchmarks.walks [workload] [scale]
+"""
+__all__ = ['count_syscalls', 'iterdir_walk', 'bench_walks']
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Any, Callable, Dict, Iterator
+
+from dircrypt.ioutils import walk_files
+from dircrypt.benchmarks.workloads import WORKLOADS
+
+# -----------------------------------------------------------------------------
+
+# The `os` functions counted as syscalls by `count_syscalls`
+SYSCALLS = ("stat", "lstat", "listdir", "scandir")
+
+DEFAULT_WORKLOAD = "tiny_files"
+DEFAULT_SCALE = 0.25
+
+# -----------------------------------------------------------------------------
+
+class _CountingEntry(object):
+    """An `os.DirEntry`, counting the first `stat` of it (the syscall)"""
+
+    def __init__(self, entry: os.DirEntry, counts: Counter):
+        self._entry = entry
+        self._counts = counts
+        self._statted = False
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, **kwargs) -> bool:
+        return self._entry.is_dir(**kwargs)
+
+    def is_file(self, **kwargs) -> bool:
+        return self._entry.is_file(**kwargs)
+
+    def is_symlink(self) -> bool:
+        return self._entry.is_symlink()
+
+    def stat(self, **kwargs) -> os.stat_result:
+        if not self._statted:
+            self._counts["entry stat"] += 1
+            self._statted = True
+        return self._entry.stat(**kwargs)
+
+class _CountingScandir(object):
+    """The iterator returned by `os.scandir`, over `_CountingEntry`s"""
+
+    def __init__(self, entries, counts: Counter):
+        self._entries = entries
+        self._counts = counts
+
+    def __enter__(self) -> "_CountingScandir":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._entries.close()
+
+    def __iter__(self) -> Iterator[_CountingEntry]:
+        for entry in self._entries:
+            yield _CountingEntry(entry, self._counts)
+
+@contextmanager
+def count_syscalls() -> Iterator[Counter]:
+    """
+    Counts the calls to the `SYSCALLS` functions of `os` (which `pathlib`
+    goes through as well), and the first `stat` of every entry returned by
+    `os.scandir`, while active. Entries whose type the filesystem doesn't
+    report are `stat`ed by `is_dir` and `is_file` as well, which isn't counted.
+    """
+    counts = Counter()
+    originals = {name: getattr(os, name) for name in SYSCALLS}
+
+    def counted(name: str) -> Callable:
+        """`os.<name>`, counting its calls"""
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            result = originals[name](*args, **kwargs)
+            return _CountingScandir(result, counts) if name == "scandir" \
+                   else result
+        return wrapper
+
+    for name in SYSCALLS:
+        setattr(os, name, counted(name))
+    try:
+        yield counts
+    finally:
+        for (name, func) in originals.items():
+            setattr(os, name, func)
+
+def iterdir_walk(root: Path) -> Iterator[Path]:
+    """Every file under `root`, as found by `Path.iterdir` and `is_dir`"""
+    subdirs = [root]
+    while len(subdirs) > 0:
+        directory = subdirs.pop()
+        for path_item in directory.iterdir():
+            if path_item.is_dir():
+                subdirs.append(path_item)
+            elif path_item.is_file():
+                yield path_item
+
+def bench_walks(root: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Walks `root` with each walker, `stat`ing every file. Returns the number of
+    files found, the time taken (in seconds) and the syscalls made (in total,
+    and by function) for each walker.
+    """
+    walkers = {
+        "iterdir": lambda: ((path, path.stat())
+                            for path in iterdir_walk(root)),
+        "scandir": lambda: ((entry.path, entry.stat())
+                            for entry in walk_files(root)),
+    }
+    results = {}
+    for (walker, walk) in walkers.items():
+        with count_syscalls() as counts:
+            start_time = default_timer()
+            num_files = sum(1 for _ in walk())
+            seconds = default_timer() - start_time
+        results[walker] = {"files": num_files,
+                           "seconds": seconds,
+                           "syscalls": sum(counts.values()),
+                           "by_call": dict(counts)}
+    return results
+
+def main(workload: str=DEFAULT_WORKLOAD,
+         scale: str=str(DEFAULT_SCALE)) -> None:
+    """Prints the syscalls and time each walker takes over `workload`"""
+    with tempfile.TemporaryDirectory(prefix="dircrypt_bench") as tmp_dir:
+        root = Path(tmp_dir, "tree")
+        WORKLOADS[workload](root, float(scale))
+        print("Walking '{}' (scale {})".format(workload, scale))
+        for (walker, result) in bench_walks(root).items():
+            per_file = result["syscalls"] / max(1, result["files"])
+            print("    {:>7}: {:6} files, {:8} syscalls ({:.2f} per file), "\
+                  "{:.3f}s".format(walker, result["files"], result["syscalls"],
+                                   per_file, result["seconds"]))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,125 @@
+"""
+workloads
+
+Generators of synthetic, reproducible directory trees, each stressing a
+different part of dircrypt. Every generator is seeded, so the same `scale`
+always produces the same tree.
+
+    python -m dircrypt.benchmarks.workloads <workload> <root> [scale]
+"""
+__all__ = ['Workload', 'WORKLOADS', 'tiny_files', 'huge_files', 'deep_tree',
+           'wide_dir', 'unicode_names']
+
+import sys
+import random
+from pathlib import Path
+from typing import Callable, Dict, NamedTuple
+
+# -----------------------------------------------------------------------------
+
+SEED = 0xD1C
+
+# Encrypted names are about 4/3 the size of their plaintext, plus 60 bytes, so
+# plaintext names are kept well clear of the usual 255 byte limit
+MAX_NAME_BYTES = 120
+
+# Multi byte characters, from a few different scripts
+UNICODE_ALPHABET = "aé漢字ñößøλΩжЯअआ한글😀🔒"
+
+# -----------------------------------------------------------------------------
+
+class Workload(NamedTuple):
+    """The size of a generated tree"""
+    num_files: int
+    num_bytes: int
+
+def tiny_files(root: Path, scale: float=1.0) -> Workload:
+    """Many files of at most 1 KiB, spread over 100 directories"""
+    rng = random.Random(SEED)
+    num_files = int(20000 * scale)
+    sizes = [rng.randrange(2**10 + 1) for _ in range(num_files)]
+    for (i, size) in enumerate(sizes):
+        _write_file(root.joinpath("dir{}".format(i % 100), "file{}".format(i)),
+                    rng, size)
+    return Workload(num_files, sum(sizes))
+
+def huge_files(root: Path, scale: float=1.0) -> Workload:
+    """A few files big enough to be split into chunk ranges"""
+    rng = random.Random(SEED)
+    num_files = 2
+    size = int(2**27 * scale)
+    for i in range(num_files):
+        _write_file(root.joinpath("huge{}".format(i)), rng, size)
+    return Workload(num_files, num_files * size)
+
+def deep_tree(root: Path, scale: float=1.0) -> Workload:
+    """A deep and narrow chain of directories, with a couple files in each"""
+    rng = random.Random(SEED)
+    depth = max(1, int(64 * scale))
+    (directory, num_bytes) = (root, 0)
+    for level in range(depth):
+        directory = directory.joinpath("level{}".format(level))
+        for i in range(2):
+            size = rng.randrange(2**16)
+            _write_file(directory.joinpath("file{}".format(i)), rng, size)
+            num_bytes += size
+    return Workload(2 * depth, num_bytes)
+
+def wide_dir(root: Path, scale: float=1.0) -> Workload:
+    """A single flat directory holding many 4 KiB files"""
+    rng = random.Random(SEED)
+    num_files = int(10000 * scale)
+    for i in range(num_files):
+        _write_file(root.joinpath("file{}".format(i)), rng, 2**12)
+    return Workload(num_files, num_files * 2**12)
+
+def unicode_names(root: Path, scale: float=1.0) -> Workload:
+    """Files and directories with long, multi byte names"""
+    rng = random.Random(SEED)
+    num_files = int(2000 * scale)
+    dirs = [_unicode_name(rng) for _ in range(20)]
+    num_bytes = 0
+    for i in range(num_files):
+        name = "{}{}".format(i, _unicode_name(rng))
+        size = rng.randrange(2**12)
+        _write_file(root.joinpath(rng.choice(dirs), name), rng, size)
+        num_bytes += size
+    return Workload(num_files, num_bytes)
+
+WORKLOADS: Dict[str, Callable[[Path, float], Workload]] = {
+    "tiny_files": tiny_files,
+    "huge_files": huge_files,
+    "deep_tree": deep_tree,
+    "wide_dir": wide_dir,
+    "unicode_names": unicode_names,
+}
+
+# -----------------------------------------------------------------------------
+
+def _write_file(path: Path, rng: random.Random, size: int) -> None:
+    """Writes `size` pseudorandom bytes to `path`, creating its directories"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open(mode="wb") as file:
+        for offset in range(0, size, 2**20):
+            file.write(rng.randbytes(min(2**20, size - offset)))
+
+def _unicode_name(rng: random.Random) -> str:
+    """A random name, as long as possible within `MAX_NAME_BYTES`"""
+    name = ""
+    while True:
+        candidate = name + rng.choice(UNICODE_ALPHABET)
+        # leaving room for a numeric prefix
+        if len(candidate.encode("utf-8")) > MAX_NAME_BYTES - 8:
+            return name
+        name = candidate
+
+def main(workload: str, root: str, scale: str="1") -> None:
+    """Generates the given workload under `root`"""
+    generated = WORKLOADS[workload](Path(root), float(scale))
+    print("Generated {} files, {} bytes".format(generated.num_files,
+                                                 generated.num_bytes))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
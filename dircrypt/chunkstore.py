@@ -0,0 +1,162 @@
+"""
+chunkstore
+
+A content addressed store of encrypted chunks, for deduplicating file
+contents.
+"""
+__all__ = ['ChunkStore', 'ChunkRefReader', 'ChunkRefWriter',
+           'CHUNK_STORE_NAME']
+
+import io
+import os
+import threading
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from dircrypt.cryptor import ChunkStoreCryptor, REF_SIZE
+
+# -----------------------------------------------------------------------------
+
+# Stored at the root of the output directory, next to the encrypted target
+CHUNK_STORE_NAME = "dircrypt.chunks"
+
+# -----------------------------------------------------------------------------
+
+class ChunkStore(object):
+    """
+    Stores every encrypted chunk once, in a file named after its (hex encoded)
+    reference, and sharded into subdirectories by the reference's first byte.
+    The file system doubles as the index, so workers never need to coordinate.
+    """
+
+    def __init__(self, root: Path):
+        self._root = root
+
+    @staticmethod
+    def find(target: Path) -> Optional["ChunkStore"]:
+        """
+        Finds the chunk store for the encrypted `target`, by searching it (in
+        case it's the output directory), then its parent directories. Returns
+        `None` if there isn't one.
+        """
+        target = target.resolve()
+        for directory in (target, *target.parents):
+            root = directory.joinpath(CHUNK_STORE_NAME)
+            if root.is_dir():
+                return ChunkStore(root)
+        return None
+
+    def put(self, store_cryptor: ChunkStoreCryptor, chunk: bytes) -> bytes:
+        """
+        Stores the given (plaintext) chunk, unless it is already stored, and
+        returns its reference.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        ref = store_cryptor.ref(chunk)
+        path = self._path(ref)
+        if path.is_file():
+            return ref
+
+        # Written under a unique name, then renamed, so that concurrent writers
+        # of the same chunk never see each other's partial writes
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name("{}.{}.{}".format(path.name, os.getpid(),
+                                                    threading.get_ident()))
+        tmp_path.write_bytes(store_cryptor.encrypt(ref, chunk))
+        os.replace(str(tmp_path), str(path))
+        return ref
+
+    def get(self, store_cryptor: ChunkStoreCryptor,
+            ref: bytes) -> Optional[bytes]:
+        """
+        Returns the (plaintext) chunk with the given reference, or `None` if it
+        is missing or fails to decrypt.
+        """
+        try:
+            data = self._path(ref).read_bytes()
+        except OSError:
+            return None
+        return store_cryptor.decrypt(ref, data)
+
+    def _path(self, ref: bytes) -> Path:
+        """Where the chunk with the given reference is stored"""
+        name = ref.hex()
+        return self._root.joinpath(name[:2], name)
+
+class ChunkRefReader(io.RawIOBase):
+    """
+    Reads `chunk_size` chunks from `orig`, stores them in `store`, and returns
+    their references instead. i.e. the deduplicated contents of `orig`.
+    """
+
+    def __init__(self, orig: BinaryIO, store: ChunkStore,
+                 store_cryptor: ChunkStoreCryptor, chunk_size: int):
+        super().__init__()
+        self._orig = orig
+        self._store = store
+        self._store_cryptor = store_cryptor
+        self._chunk_size = chunk_size
+        self._refs = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        """Reads as many references as fit in `buf`"""
+        while len(self._refs) < len(buf):
+            chunk = self._orig.read(self._chunk_size)
+            if chunk in (b'', None):
+                break
+            self._refs += self._store.put(self._store_cryptor, chunk)
+
+        num_read = min(len(buf), len(self._refs))
+        buf[:num_read] = self._refs[:num_read]
+        self._refs = self._refs[num_read:]
+        return num_read
+
+class ChunkRefWriter(io.RawIOBase):
+    """
+    The inverse of `ChunkRefReader`: takes references, and writes the chunks
+    they refer to to `targ`. Stops writing after the first missing or
+    malformed chunk, which is reported through `ok`.
+    """
+
+    def __init__(self, targ: BinaryIO, store: ChunkStore,
+                 store_cryptor: ChunkStoreCryptor):
+        super().__init__()
+        self._targ = targ
+        self._store = store
+        self._store_cryptor = store_cryptor
+        self._refs = b''
+        self._ok = True
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """Writes out the chunks of every complete reference in `data`"""
+        self._refs += data
+        num_refs = len(self._refs) // REF_SIZE
+        for i in range(num_refs):
+            if not self._ok:
+                break
+            ref = self._refs[i * REF_SIZE:(i + 1) * REF_SIZE]
+            chunk = self._store.get(self._store_cryptor, ref)
+            if chunk is None:
+                self._ok = False
+            else:
+                self._targ.write(chunk)
+        self._refs = self._refs[num_refs * REF_SIZE:]
+        return len(data)
+
+    @property
+    def ok(self) -> bool:
+        """Whether every chunk was written, with no reference left over"""
+        return self._ok and len(self._refs) == 0
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
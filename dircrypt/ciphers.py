@@ -0,0 +1,124 @@
+"""
+ciphers
+
+The AEAD ciphers file contents can be encrypted with, registered by the id
+recorded in each file's header, and the pick of the fastest one on this
+machine, for `--cipher auto`.
+"""
+__all__ = ['Cipher', 'CIPHERS', 'CIPHER_NAMES', 'CHACHA20_POLY1305',
+           'AES_256_GCM', 'AUTO_CIPHER', 'new_aead', 'parse_cipher',
+           'choose_cipher', 'has_aes_instructions', 'fastest_cipher']
+
+import os
+from pathlib import Path
+from timeit import default_timer
+from typing import Any, Callable, NamedTuple, Optional
+
+from cryptography.hazmat.primitives.ciphers.aead import (ChaCha20Poly1305,
+                                                         AESGCM)
+
+# -----------------------------------------------------------------------------
+
+# Cipher ids, as recorded in file headers
+CHACHA20_POLY1305 = 0
+AES_256_GCM = 1
+
+# Picks a cipher with `choose_cipher`
+AUTO_CIPHER = "auto"
+
+# The cpu flags (in /proc/cpuinfo) which make AES-GCM fast: AES rounds, and
+# carry-less multiplication (for GHASH), on x86 and on arm respectively
+CPUINFO = Path("/proc/cpuinfo")
+AES_FLAG_SETS = ({"aes", "pclmulqdq"}, {"aes", "pmull"})
+
+# Without cpu flags, ciphers are timed over this many bytes (best of
+# `BENCH_RUNS`), which takes about a millisecond
+BENCH_SIZE = 2**16 # 64 KiB
+BENCH_RUNS = 3
+
+# -----------------------------------------------------------------------------
+
+class Cipher(NamedTuple):
+    """
+    A registered AEAD cipher. Every cipher takes 256 bit keys and 96 bit
+    nonces, and appends a 128 bit tag.
+    """
+    name: str
+    aead: Callable[[bytes], Any]
+
+CIPHERS = {
+    CHACHA20_POLY1305: Cipher("chacha20-poly1305", ChaCha20Poly1305),
+    AES_256_GCM: Cipher("aes-256-gcm", AESGCM),
+}
+CIPHER_NAMES = {cipher.name: cipher_id
+                for (cipher_id, cipher) in CIPHERS.items()}
+
+# -----------------------------------------------------------------------------
+
+def new_aead(cipher_id: int, key: bytes) -> Any:
+    """
+    The AEAD for the registered cipher `cipher_id`, under `key`
+
+    Raises:
+        `UnsupportedAlgorithm`: If the cipher isn't supported by this build of
+                                cryptography
+    """
+    return CIPHERS[cipher_id].aead(key)
+
+def parse_cipher(name: str) -> Optional[int]:
+    """
+    The id of the cipher `name` (or the one picked by `choose_cipher`, for
+    `AUTO_CIPHER`), or `None` if there is no such cipher
+    """
+    if name == AUTO_CIPHER:
+        return choose_cipher()
+    return CIPHER_NAMES.get(name, None)
+
+def choose_cipher() -> int:
+    """
+    AES-256-GCM if the cpu has instructions for it, and ChaCha20-Poly1305
+    (which is faster in software) otherwise. If the cpu's flags can't be
+    read, the ciphers are timed instead.
+    """
+    has_aes = has_aes_instructions()
+    if has_aes is None:
+        return fastest_cipher()
+    return AES_256_GCM if has_aes else CHACHA20_POLY1305
+
+def has_aes_instructions() -> Optional[bool]:
+    """
+    Whether the cpu flags in /proc/cpuinfo include AES (and carry-less
+    multiplication) instructions, or `None` if they can't be read
+    """
+    try:
+        cpuinfo = CPUINFO.read_text()
+    except OSError:
+        return None
+    for line in cpuinfo.splitlines():
+        (key, _, value) = line.partition(":")
+        if key.strip() in ("flags", "Features"):
+            flags = set(value.split())
+            return any(flag_set <= flags for flag_set in AES_FLAG_SETS)
+    return None
+
+def fastest_cipher() -> int:
+    """The id of the cipher encrypting `BENCH_SIZE` bytes fastest"""
+    (key, nonce, data) = (os.urandom(32), os.urandom(12),
+                          os.urandom(BENCH_SIZE))
+
+    def seconds(cipher_id: int) -> float:
+        """The best time of `BENCH_RUNS` encryptions of `data`"""
+        aead = new_aead(cipher_id, key)
+        times = []
+        for _ in range(BENCH_RUNS):
+            start = default_timer()
+            aead.encrypt(nonce, data, None)
+            times.append(default_timer() - start)
+        return min(times)
+
+    return min(CIPHERS, key=seconds)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
@@ -0,0 +1,89 @@
+"""
+compression
+
+Per chunk compression of file contents, before they're encrypted. Every
+compressed chunk starts with a byte identifying its codec, so chunks that
+don't compress can be stored raw.
+"""
+__all__ = ['compress_chunk', 'decompress_chunk', 'CODECS', 'CODEC_RAW',
+           'CODEC_ZLIB', 'CODEC_LZMA']
+
+import zlib
+from importlib.util import find_spec
+from typing import Dict, Optional
+
+# -----------------------------------------------------------------------------
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+# Codecs selectable with --compress, by name. lzma is only imported once a
+# chunk needs it, since most runs don't, but python may be built without
+# liblzma, so its extension module is looked up (without importing it)
+CODECS: Dict[str, int] = {"zlib": CODEC_ZLIB}
+if find_spec("_lzma") is not None:
+    CODECS["lzma"] = CODEC_LZMA
+
+# Chunks whose first `PROBE_SIZE` bytes don't compress under the cheapest zlib
+# level (e.g. media, or archives) aren't worth compressing in full
+PROBE_SIZE = 2**12
+
+# -----------------------------------------------------------------------------
+
+def compress_chunk(codec: int, chunk: bytes) -> bytes:
+    """
+    Compresses `chunk` with `codec`, prefixed by the codec's id. Chunks that
+    don't shrink are stored raw, under `CODEC_RAW`.
+    """
+    assert(codec in CODECS.values())
+    if len(chunk) > PROBE_SIZE and \
+       len(zlib.compress(chunk[:PROBE_SIZE], 1)) >= PROBE_SIZE:
+        return bytes([CODEC_RAW]) + chunk
+
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(chunk)
+    else:
+        import lzma
+        compressed = lzma.compress(chunk)
+
+    if len(compressed) >= len(chunk):
+        return bytes([CODEC_RAW]) + chunk
+    return bytes([codec]) + compressed
+
+def decompress_chunk(data: bytes, max_len: int) -> Optional[bytes]:
+    """
+    Reverses `compress_chunk`. Returns `None` if `data` is malformed, or would
+    decompress to more than `max_len` bytes.
+    """
+    if len(data) == 0:
+        return None
+    (codec, payload) = (data[0], data[1:])
+    if codec == CODEC_RAW:
+        return bytes(payload) if len(payload) <= max_len else None
+
+    if codec == CODEC_ZLIB:
+        try:
+            decompressor = zlib.decompressobj()
+            chunk = decompressor.decompress(payload, max_len)
+        except zlib.error:
+            return None
+        complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == CODEC_LZMA and CODEC_LZMA in CODECS.values():
+        import lzma
+        try:
+            decompressor = lzma.LZMADecompressor()
+            chunk = decompressor.decompress(payload, max_len)
+        except (lzma.LZMAError, EOFError):
+            return None
+        complete = decompressor.eof
+    else:
+        return None
+
+    complete = complete and not decompressor.unused_data
+    return chunk if complete else None
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
@@ -3,45 +3,178 @@ cryptor
 
 Utilities for (En|De)crypting.
 """
-__all__ = ['Cryptor', 'Encryptor', 'Decryptor']
+__all__ = ['Cryptor', 'Encryptor', 'Decryptor', 'FileCryptor', 'FileHeader',
+           'ChunkStoreCryptor', 'pack_file_header', 'unpack_file_header',
+           'MAX_CHUNK_SIZE', 'REF_SIZE', 'FRAME_LEN']
 
 import os
+import struct
 import binascii
 from pathlib import Path
-from getpass import getpass
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Optional, Tuple, BinaryIO, NamedTuple
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from abc import ABCMeta, abstractproperty, abstractmethod
 
 from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 
-from dircrypt.ioutils import BLOCK_SIZE, force_create_file
+from dircrypt.aux import implies
+from dircrypt.ciphers import CIPHERS, CHACHA20_POLY1305, new_aead
+from dircrypt.kdf import (KdfSpec, LEGACY_SPEC, KDF_SPEC, pack_kdf_spec,
+                          unpack_kdf_spec, is_valid_spec, stretch)
+from dircrypt.compression import compress_chunk, decompress_chunk
+from dircrypt.stats import current_stats
+from dircrypt.ioutils import BLOCK_SIZE, StreamReader, force_create_file
 
 # -----------------------------------------------------------------------------
 
 # Security Parameters
 SALT_SIZE = 16
 DEFAULT_PASSWORD_SIZE = 32
-KEY_STRETCH_COUNT = 100000
 KEY_SIZE = 32
 NONCE_SIZE = 12
 
 # Derived Parameters
 CHACHA_TAG_SIZE = 16
+TAG_SIZE = 16 # of every cipher in `ciphers.CIPHERS`
 ENC_READ_SIZE = BLOCK_SIZE
 DEC_READ_SIZE = ENC_READ_SIZE + CHACHA_TAG_SIZE + SALT_SIZE + NONCE_SIZE
 
-# calculated ahead of time purely for efficiency; strictly used in _decrypt()
+# calculated ahead of time purely for efficiency; strictly used in
+# _decrypt_v1()
 START_OF_NONCE = SALT_SIZE
 END_OF_NONCE = START_OF_NONCE + NONCE_SIZE
 START_OF_CIPHERTEXT = END_OF_NONCE
 
+# Format v2: the password is stretched once per archive, as per a KDF spec (see
+# `kdf.KDF_SPEC`), and per-file/name keys are derived from the stretched key
+# with HKDF. v2 names are `version | archive salt | KDF spec | nonce |
+# ciphertext`
+NAME_VERSION = 2
+NAME_HEADER_SIZE = 1 + SALT_SIZE + KDF_SPEC.size + NONCE_SIZE
+FILE_MAGIC = b"DCRY"
+FILE_VERSION = 2
+MAX_CHUNK_SIZE = 2**30
+
+# v2 file headers are `magic | version | archive salt | file salt | chunk size
+# | flags | cipher id (see `ciphers.CIPHERS`) | KDF spec`
+FILE_HEADER = struct.Struct(">4sB16s16sIBB" + KDF_SPEC.format.lstrip(">"))
+FILE_HEADER_SIZE = FILE_HEADER.size
+FILE_KEY_INFO = b"dircrypt v2 file contents"
+NAME_KEY_INFO = b"dircrypt v2 path names"
+
+# v2 header flags
+FLAG_DEDUPLICATED = 0x01 # contents are references into a chunk store
+FLAG_COMPRESSED = 0x02 # chunks are compressed, and framed by their length
+KNOWN_FLAGS = FLAG_DEDUPLICATED | FLAG_COMPRESSED
+
+# Chunks are numbered through their nonce, and the nonce of the final chunk
+# also has its top bit set, so that a file cut short (at a chunk boundary)
+# fails to authenticate, rather than decrypting to a shorter file
+FINAL_CHUNK = 1 << (8 * NONCE_SIZE - 1)
+
+# Decryption only stretches the password as per the KDF spec it first stretches
+# it with, and under at most this many archive salts, since every spec (and
+# salt) is read from the (untrusted) tree, which could otherwise make it
+# stretch the password over and over
+MAX_ARCHIVE_SALTS = 16
+
+# Compressed chunks vary in size, so each is prefixed by its encrypted length
+FRAME_LEN = struct.Struct(">I")
+
+# Deduplicated chunks are referenced by a keyed BLAKE2b hash of their plaintext
+REF_SIZE = 32
+REF_KEY_INFO = b"dircrypt v2 chunk references"
+STORE_KEY_INFO = b"dircrypt v2 chunk store"
+
+# `encrypt_into`/`decrypt_into` are only available on newer versions of
+# cryptography (>= 45)
+HAS_AEAD_INTO = hasattr(ChaCha20Poly1305, "encrypt_into")
+
 # -----------------------------------------------------------------------------
 
+class FileCryptor(metaclass=ABCMeta):
+    """(En|De)crypts the chunks of a single file's contents"""
+
+    @abstractmethod
+    def crypt_chunk(self, index: int, data: bytes,
+                    final: bool=False) -> Optional[bytes]:
+        """
+        (En|De)crypts the `index`th chunk of the file, which is its last chunk
+        if `final`. Assumes `len(data) <= FileCryptor.read_len`. Returns
+        `None` on failed decryption.
+        """
+        pass
+
+    def crypt_chunk_into(self, index: int, data: memoryview,
+                         out: memoryview, final: bool=False) -> Optional[int]:
+        """
+        `crypt_chunk`, writing the result to the start of `out` instead of a
+        freshly allocated `bytes`. Assumes `len(out) >= FileCryptor.write_len`.
+        Returns the number of bytes written, or `None` on failed decryption.
+        """
+        crypted = self.crypt_chunk(index, data, final)
+        if crypted is None:
+            return None
+        out[:len(crypted)] = crypted
+        return len(crypted)
+
+    @abstractproperty
+    def read_len(self) -> int:
+        """The largest number of bytes to read in a single IO operation"""
+        pass
+
+    @abstractproperty
+    def write_len(self) -> int:
+        """The largest number of bytes to write in a single IO operation."""
+        pass
+
+    @abstractproperty
+    def encrypting(self) -> bool:
+        """Whether this encrypts (rather than decrypts) chunks"""
+        pass
+
+    @property
+    def framed_input(self) -> bool:
+        """
+        Whether every chunk read is prefixed by its length (as a `FRAME_LEN`),
+        rather than `read_len` bytes long. Such chunks can't be located by
+        their index.
+        """
+        return False
+
+    @property
+    def marks_final(self) -> bool:
+        """
+        Whether the file's final chunk is (en|de)crypted differently from the
+        rest, i.e. whether `final` matters to `crypt_chunk`. Such files hold
+        at least one chunk, even when empty.
+        """
+        return False
+
+    @property
+    def store_cryptor(self) -> Optional["ChunkStoreCryptor"]:
+        """
+        For deduplicated files, whose (plaintext) contents are a list of
+        references into a chunk store, the cryptor for that chunk store.
+        `None` otherwise.
+        """
+        return None
+
+    @abstractproperty
+    def read_offset(self) -> int:
+        """Number of header bytes preceding the first chunk in the input"""
+        pass
+
+    @abstractproperty
+    def write_offset(self) -> int:
+        """Number of header bytes preceding the first chunk in the output"""
+        pass
+
 class Cryptor(metaclass=ABCMeta):
     """Interface for common operations over (en|de)cryption"""
 
@@ -54,21 +187,32 @@ class Cryptor(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def crypt_file_contents(self, data: bytes) -> Optional[bytes]:
+    def start_file(self, orig: BinaryIO, targ: BinaryIO) -> \
+            Optional[FileCryptor]:
         """
-        (En|De)crypts the given byte string. Returns `None` on failed
-        decryption. Meant for file contents.
+        Consumes (or emits) the file header of `orig` (or `targ`), leaving both
+        positioned at the first chunk. Returns the `FileCryptor` for the
+        remaining chunks, or `None` if the header is malformed.
         """
         pass
 
-    @abstractproperty
-    def read_len(self) -> int:
-        """The largest number of bytes to read in a single IO operation"""
+    @abstractmethod
+    def start_stream(self, orig: BinaryIO, targ: BinaryIO) -> \
+            Optional[Tuple[FileCryptor, BinaryIO]]:
+        # pylint: disable=invalid-sequence-index
+        """
+        `start_file`, for an `orig` that can't seek (e.g. a pipe). Also
+        returns the stream to read the remaining chunks from, whose reads only
+        come up short at the end of `orig`.
+        """
         pass
 
-    @abstractproperty
-    def write_len(self) -> int:
-        """The largest number of bytes to write in a single IO operation."""
+    @abstractmethod
+    def file_cryptor(self, header: bytes) -> Optional[FileCryptor]:
+        """
+        Returns the `FileCryptor` for the encrypted file starting with
+        `header`, or `None` if the header is malformed.
+        """
         pass
 
     @abstractproperty
@@ -84,21 +228,45 @@ class Cryptor(metaclass=ABCMeta):
 class Encryptor(Cryptor):
     """Encryption Handler"""
 
-    def __init__(self, gen_psw: bool=False):
+    def __init__(
+            self,
+            gen_psw: bool=False,
+            chunk_size: int=BLOCK_SIZE,
+            psw_file: Optional[str]=None,
+            archive_salt: Optional[bytes]=None,
+            dedup: bool=False,
+            codec: Optional[int]=None,
+            cipher: int=CHACHA20_POLY1305,
+            kdf: KdfSpec=LEGACY_SPEC
+        ):
         """
         If `gen_psw` is set, a cryptographically secure, pseudorandom password
-        is generated for encryption. Otherwise the password is queried through
-        STDIN.
+        is generated for encryption. Otherwise the password is read from
+        `psw_file`, or queried through STDIN. The password is stretched once,
+        as per `kdf`, under `archive_salt` (when adding to an existing archive,
+        whose spec `kdf` must then be), or a fresh one. File contents are
+        encrypted in chunks of `chunk_size` bytes, with `cipher` (one of
+        `ciphers.CIPHERS`). With `dedup`, file headers are flagged as
+        deduplicated, in which case `chunk_size` must be a multiple of
+        `REF_SIZE`. With `codec` (one of `compression.CODECS`), chunks are
+        compressed before they're encrypted.
 
         Raises:
-            `OSError`: If `gen_psw != None` and an IO-Error occurred.
+            `OSError`: If `gen_psw != None` or `psw_file != None` and an
+                       IO-Error occurred.
         """
-        (self._psw, psw_file) = create_psw_file() if gen_psw else (None, None)
+        assert(not (gen_psw and psw_file is not None))
+        (self._psw, psw_file) = create_psw_file() if gen_psw else \
+                                (None, None) if psw_file is None else \
+                                (read_psw_file(Path(psw_file)), None)
 
         if psw_file is not None:
             assert(self._psw is not None)
             print("Autogenerated password saved to '{}'".format(psw_file))
 
+        if self._psw is None:
+            # imported here, since passwords are mostly read from files
+            from getpass import getpass
         while self._psw is None:
             candidate = getpass(prompt="Password: ")
             check = getpass(prompt="Verify Password: ")
@@ -107,33 +275,78 @@ class Encryptor(Cryptor):
             else:
                 print("Passwords to not match. Please try again.")
 
+        assert(implies(dedup, chunk_size % REF_SIZE == 0))
+        assert(cipher in CIPHERS)
+        assert(is_valid_spec(kdf))
+        self._chunk_size = chunk_size
+        self._cipher = cipher
+        self._flags = (FLAG_DEDUPLICATED if dedup else 0) | \
+                      (0 if codec is None else FLAG_COMPRESSED)
+        self._codec = codec
+        self._archive_salt = os.urandom(SALT_SIZE) if archive_salt is None \
+                             else archive_salt
+        self._kdf = kdf
+        self._master_key = derive_master_key(self._psw, self._archive_salt,
+                                             kdf)
+        self._name_key = derive_subkey(self._master_key, NAME_KEY_INFO)
+
     def crypt_path_name(self, path_item_name: str) -> Optional[str]:
         """
         Encrypts the given str, returning a new str suitable for a file or
         directory name.
         """
         path_bytes = bytes(path_item_name, "utf-8")
-        ciphertext = self._encrypt(path_bytes)
-        b64_path_bytes = urlsafe_b64encode(ciphertext)
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = ChaCha20Poly1305(self._name_key)
+        ciphertext = cipher.encrypt(nonce, path_bytes, None)
+        name_bytes = bytes([NAME_VERSION]) + self._archive_salt + \
+                     pack_kdf_spec(self._kdf) + nonce + ciphertext
+        b64_path_bytes = urlsafe_b64encode(name_bytes)
         return str(b64_path_bytes, "utf-8")
 
-    def crypt_file_contents(self, data: bytes) -> Optional[bytes]:
-        """
-        Encrypts the given byte string. Meant for file contents. Assumes
-        `len(data) <= Encryptor.read_len`
-        """
-        assert(len(data) <= self.read_len)
-        return self._encrypt(data)
+    def start_file(self, orig: BinaryIO, targ: BinaryIO) -> FileCryptor:
+        """Writes a fresh file header to `targ`"""
+        header = self.new_file_header()
+        check = targ.write(header)
+        assert(check == len(header))
+        return self.file_cryptor(header)
+
+    def start_stream(self, orig: BinaryIO, targ: BinaryIO) -> \
+            Tuple[FileCryptor, BinaryIO]:
+        # pylint: disable=invalid-sequence-index
+        """Writes a fresh file header to `targ`"""
+        return (self.start_file(orig, targ), StreamReader(orig))
+
+    def new_file_header(self) -> bytes:
+        """A header for a new encrypted file, under a fresh file salt"""
+        header = FileHeader(archive_salt=self._archive_salt,
+                            file_salt=os.urandom(SALT_SIZE),
+                            chunk_size=self._chunk_size,
+                            flags=self._flags,
+                            cipher=self._cipher,
+                            kdf=self._kdf)
+        return pack_file_header(header)
+
+    def file_cryptor(self, header: bytes) -> FileCryptor:
+        """Returns the `FileCryptor` for a header from `new_file_header()`"""
+        file_header = unpack_file_header(header)
+        assert(file_header is not None)
+        return _v2_file_cryptor(self._master_key, file_header, True,
+                                self._codec)
+
+    def decryptor(self) -> "Decryptor":
+        """A `Decryptor` for files encrypted under the same password"""
+        return Decryptor(password=self._psw)
 
     @property
-    def read_len(self) -> int:
-        """The number of bytes to read in a single IO operation"""
-        return ENC_READ_SIZE
+    def archive_salt(self) -> bytes:
+        """The salt the password is stretched under"""
+        return self._archive_salt
 
     @property
-    def write_len(self) -> int:
-        """The largest number of bytes to write in a single IO operation."""
-        return DEC_READ_SIZE
+    def kdf(self) -> KdfSpec:
+        """The spec the password is stretched with"""
+        return self._kdf
 
     @property
     def output_dirname(self) -> str:
@@ -145,33 +358,33 @@ class Encryptor(Cryptor):
         """'Encrypting'"""
         return "Encrypting"
 
-    def _encrypt(self, plaintext: bytes) -> bytes:
-        """Encryption"""
-        salt = os.urandom(SALT_SIZE)
-        nonce = os.urandom(NONCE_SIZE)
-        key = derive_key(password=self._psw, salt=salt)
-        cipher = ChaCha20Poly1305(key)
-        ciphertext = cipher.encrypt(nonce, plaintext, None)
-
-        # Somewhat counterintuitively, benchmarking revealed that it was faster
-        # to concatenate bytes than use bytearray.extend
-        return salt + nonce + ciphertext
-
 class Decryptor(Cryptor):
     """Decryption Handler"""
 
-    def __init__(self, psw_file: Optional[str]=None):
+    def __init__(
+            self,
+            psw_file: Optional[str]=None,
+            password: Optional[bytes]=None
+        ):
         """
-        Initializes the key from the given user password or password file.
+        Initializes the key from the given user password, password file, or
+        `password` itself.
 
         Raises (if `psw_file` is not None):
             `OSError`: If some other IO related error occurred
         """
-        if psw_file is None:
+        if password is not None:
+            self._psw = password
+        elif psw_file is None:
+            from getpass import getpass # see `Encryptor`
             psw = getpass(prompt="Password: ")
             self._psw = bytes(psw, "utf-8")
         else:
             self._psw = read_psw_file(Path(psw_file))
+        # stretched keys are kept per instance, rather than just per process,
+        # so that workers are handed the keys found so far along with this
+        self._master_keys = {} # Dict[Tuple[bytes, KdfSpec], bytes]
+        self._kdf = None # Optional[KdfSpec], the first stretched with
 
     def crypt_path_name(self, path_item_name: str) -> Optional[str]:
         """
@@ -187,19 +400,131 @@ class Decryptor(Cryptor):
             return None
         assert(path_bytes is not None)
 
-        plaintext_bytes = self._decrypt(path_bytes)
+        plaintext_bytes = None
+        if path_bytes[:1] == bytes([NAME_VERSION]):
+            plaintext_bytes = self._decrypt_v2_name(path_bytes)
+        # A v1 name starts with a random salt, so it may look like a later one
+        if plaintext_bytes is None:
+            plaintext_bytes = _decrypt_v1(self._psw, path_bytes)
+
         if plaintext_bytes is None:
             return None
-        else:
+        try:
             return str(plaintext_bytes, "utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    def start_file(self, orig: BinaryIO, targ: BinaryIO) -> \
+            Optional[FileCryptor]:
+        """Consumes the file header of `orig`, if there is one"""
+        file_cryptor = self.file_cryptor(orig.read(FILE_HEADER_SIZE))
+        if file_cryptor is not None:
+            orig.seek(file_cryptor.read_offset)
+        return file_cryptor
+
+    def start_stream(self, orig: BinaryIO, targ: BinaryIO) -> \
+            Optional[Tuple[FileCryptor, BinaryIO]]:
+        # pylint: disable=invalid-sequence-index
+        """
+        Consumes the file header of `orig`, if there is one. Whatever was read
+        past the header is read again from the returned stream, instead of
+        seeking back to it.
+        """
+        header = StreamReader(orig).read(FILE_HEADER_SIZE)
+        file_cryptor = self.file_cryptor(header)
+        if file_cryptor is None:
+            return None
+        return (file_cryptor,
+                StreamReader(orig, header[file_cryptor.read_offset:]))
+
+    def file_cryptor(self, header: bytes) -> Optional[FileCryptor]:
+        """
+        Returns the `FileCryptor` matching the format version in `header`.
+        Files without a v2 header are treated as v1 (i.e. headerless) files.
+        Returns `None` if the header is malformed.
+        """
+        file_header = unpack_file_header(header)
+        if file_header is None:
+            return _V1FileDecryptor(self._psw)
+        if not 0 < file_header.chunk_size <= MAX_CHUNK_SIZE:
+            return None
+        if file_header.flags & ~KNOWN_FLAGS or \
+           file_header.cipher not in CIPHERS or \
+           not is_valid_spec(file_header.kdf):
+            return None # written by a later version of dircrypt
+
+        master_key = self._master_key(file_header.archive_salt,
+                                      file_header.kdf)
+        if master_key is None:
+            return None
+        return _v2_file_cryptor(master_key, file_header, False)
+
+    @property
+    def output_dirname(self) -> str:
+        """Name of the output directory"""
+        return "DECRYPTED_OUTPUT"
+
+    @property
+    def verb(self) -> str:
+        """'Decrypting'"""
+        return "Decrypting"
+
+    def _master_key(self, archive_salt: bytes,
+                    kdf: KdfSpec) -> Optional[bytes]:
+        """
+        The password, stretched under `archive_salt` as per `kdf`. Returns
+        `None` if `kdf` isn't the spec the password was first stretched with,
+        or it's been stretched under `MAX_ARCHIVE_SALTS` other salts already.
+        """
+        master_key = self._master_keys.get((archive_salt, kdf), None)
+        if master_key is not None:
+            return master_key
+        if self._kdf is None:
+            self._kdf = kdf
+        elif kdf != self._kdf or len(self._master_keys) >= MAX_ARCHIVE_SALTS:
+            return None
+
+        master_key = derive_master_key(self._psw, archive_salt, kdf)
+        self._master_keys[(archive_salt, kdf)] = master_key
+        return master_key
+
+    def _decrypt_v2_name(self, name_bytes: bytes) -> Optional[bytes]:
+        """Decryption of v2 names. Returns `None` if decryption fails."""
+        if len(name_bytes) < NAME_HEADER_SIZE + CHACHA_TAG_SIZE:
+            return None
+
+        archive_salt = name_bytes[1:1 + SALT_SIZE]
+        kdf = unpack_kdf_spec(name_bytes[1 + SALT_SIZE:])
+        if kdf is None:
+            return None
+        nonce = name_bytes[NAME_HEADER_SIZE - NONCE_SIZE:NAME_HEADER_SIZE]
+        master_key = self._master_key(archive_salt, kdf)
+        if master_key is None:
+            return None
+        cipher = ChaCha20Poly1305(derive_subkey(master_key, NAME_KEY_INFO))
+
+        try:
+            return cipher.decrypt(nonce, name_bytes[NAME_HEADER_SIZE:], None)
+        except InvalidTag:
+            return None
+
+class _V1FileDecryptor(FileCryptor):
+    """
+    Decrypts v1 files, where every chunk carries its own salt and nonce, and
+    is encrypted under its own PBKDF2 derived key.
+    """
+
+    def __init__(self, password: bytes):
+        self._psw = password
 
-    def crypt_file_contents(self, data: bytes) -> Optional[bytes]:
+    def crypt_chunk(self, index: int, data: bytes,
+                    final: bool=False) -> Optional[bytes]:
         """
-        Decrypts the given byte string. Meant for file contents. Assumes
-        `len(data) <= Decryptor.read_len`. Returns `None` if decryption fails.
+        Decrypts the given chunk. The chunk's `index` (and whether it's
+        `final`) is unused.
         """
         assert(len(data) <= self.read_len)
-        return self._decrypt(data)
+        return _decrypt_v1(self._psw, data)
 
     @property
     def read_len(self) -> int:
@@ -212,53 +537,304 @@ class Decryptor(Cryptor):
         return ENC_READ_SIZE
 
     @property
-    def output_dirname(self) -> str:
-        """Name of the output directory"""
-        return "DECRYPTED_OUTPUT"
+    def encrypting(self) -> bool:
+        """v1 files are only ever decrypted"""
+        return False
 
     @property
-    def verb(self) -> str:
-        """'Decrypting'"""
-        return "Decrypting"
+    def read_offset(self) -> int:
+        """v1 files have no header"""
+        return 0
+
+    @property
+    def write_offset(self) -> int:
+        """Decrypted files have no header"""
+        return 0
+
+class _V2FileCryptor(FileCryptor):
+    """
+    (En|De)crypts v2 files, where every chunk is encrypted under a single,
+    per-file key, with the file's cipher. Chunks are numbered through their
+    nonce, so they cannot be reordered, and the final chunk is marked in its
+    nonce, so that they cannot be dropped from the end.
+    """
+
+    def __init__(
+            self,
+            key: bytes,
+            header: "FileHeader",
+            encrypting: bool,
+            store_cryptor: Optional["ChunkStoreCryptor"]=None,
+            codec: Optional[int]=None
+        ):
+        """
+        `store_cryptor` is needed for deduplicated files, and `codec` for
+        compressed files being encrypted.
+        """
+        self._key = key
+        self._header = header
+        self._cipher = new_aead(header.cipher, key)
+        self._encrypting = encrypting
+        self._store_cryptor = store_cryptor
+        self._codec = codec
+        self._compressed = bool(header.flags & FLAG_COMPRESSED)
+        self._plain_len = header.chunk_size
+        self._crypted_len = header.chunk_size + TAG_SIZE
+        if self._compressed:
+            self._crypted_len += 1 # codec id
+        assert(implies(self._compressed and encrypting, codec is not None))
+
+    def __reduce__(self):
+        """The underlying cipher can't be pickled, but its key can"""
+        return (_V2FileCryptor, (self._key, self._header, self._encrypting,
+                                 self._store_cryptor, self._codec))
+
+    def crypt_chunk(self, index: int, data: bytes,
+                    final: bool=False) -> Optional[bytes]:
+        """
+        (En|De)crypts the `index`th chunk. Encrypted chunks of compressed files
+        are framed by their length.
+        """
+        assert(len(data) <= self.read_len)
+        nonce = self._nonce(index, final)
+        if self._encrypting and not self._compressed:
+            return self._cipher.encrypt(nonce, data, None)
+        if self._encrypting:
+            crypted = self._cipher.encrypt(nonce,
+                                           compress_chunk(self._codec, data),
+                                           None)
+            return FRAME_LEN.pack(len(crypted)) + crypted
 
-    def _decrypt(self, ciphertext: bytes) -> Optional[bytes]:
-        """Decryption. Returns `None` if decryption fails."""
-        salt = ciphertext[0:SALT_SIZE]
-        nonce = ciphertext[START_OF_NONCE:END_OF_NONCE]
-        ciphertext_and_tag = ciphertext[START_OF_CIPHERTEXT:]
+        try:
+            plaintext = self._cipher.decrypt(nonce, data, None)
+        except InvalidTag:
+            return None
+        if self._compressed:
+            return decompress_chunk(plaintext, self._plain_len)
+        return plaintext
 
-        is_malformed = (len(salt) != SALT_SIZE or
-                        len(nonce) != NONCE_SIZE or
-                        len(ciphertext_and_tag) < CHACHA_TAG_SIZE)
+    def crypt_chunk_into(self, index: int, data: memoryview,
+                         out: memoryview, final: bool=False) -> Optional[int]:
+        """
+        (En|De)crypts the `index`th chunk directly into `out`. Compressed
+        chunks are (de)compressed into fresh `bytes` anyway.
+        """
+        if not HAS_AEAD_INTO or self._compressed:
+            return super().crypt_chunk_into(index, data, out, final)
 
-        if is_malformed:
+        assert(len(data) <= self.read_len)
+        nonce = self._nonce(index, final)
+        if self._encrypting:
+            out_len = len(data) + TAG_SIZE
+            return self._cipher.encrypt_into(nonce, data, None, out[:out_len])
+        if len(data) < TAG_SIZE:
             return None
+        try:
+            out_len = len(data) - TAG_SIZE
+            return self._cipher.decrypt_into(nonce, data, None, out[:out_len])
+        except InvalidTag:
+            return None
+
+    @property
+    def read_len(self) -> int:
+        """The number of bytes to read in a single IO operation"""
+        return self._plain_len if self._encrypting else self._crypted_len
+
+    @property
+    def write_len(self) -> int:
+        """The largest number of bytes to write in a single IO operation."""
+        if not self._encrypting:
+            return self._plain_len
+        if self._compressed:
+            return FRAME_LEN.size + self._crypted_len
+        return self._crypted_len
+
+    def _nonce(self, index: int, final: bool) -> bytes:
+        """The nonce of the `index`th chunk"""
+        if final:
+            index |= FINAL_CHUNK
+        return index.to_bytes(NONCE_SIZE, "big")
+
+    @property
+    def framed_input(self) -> bool:
+        """Whether this decrypts a compressed file"""
+        return self._compressed and not self._encrypting
+
+    @property
+    def marks_final(self) -> bool:
+        """v2 files always mark their final chunk"""
+        return True
+
+    @property
+    def encrypting(self) -> bool:
+        """Whether this encrypts (rather than decrypts) chunks"""
+        return self._encrypting
 
-        key = derive_key(password=self._psw, salt=salt)
-        cipher = ChaCha20Poly1305(key)
+    @property
+    def store_cryptor(self) -> Optional["ChunkStoreCryptor"]:
+        """The chunk store cryptor, for deduplicated files"""
+        return self._store_cryptor
+
+    @property
+    def read_offset(self) -> int:
+        """Size of the file header, when decrypting"""
+        return 0 if self._encrypting else FILE_HEADER_SIZE
+
+    @property
+    def write_offset(self) -> int:
+        """Size of the file header, when encrypting"""
+        return FILE_HEADER_SIZE if self._encrypting else 0
+
+class ChunkStoreCryptor(object):
+    """
+    (En|De)crypts the chunks of a deduplicated chunk store. Each chunk is
+    referenced by a keyed hash of its plaintext, which doubles as its nonce
+    (and associated data). Identical chunks are therefore encrypted
+    identically, and only need to be stored once, while the references don't
+    reveal anything about the plaintext without the key. Chunks are encrypted
+    with the cipher of the files referencing them.
+    """
 
+    def __init__(self, ref_key: bytes, store_key: bytes,
+                 cipher: int=CHACHA20_POLY1305):
+        self._ref_key = ref_key
+        self._store_key = store_key
+        self._cipher_id = cipher
+        self._cipher = new_aead(cipher, store_key)
+
+    def __reduce__(self):
+        """The underlying cipher can't be pickled, but its key can"""
+        return (ChunkStoreCryptor, (self._ref_key, self._store_key,
+                                    self._cipher_id))
+
+    def ref(self, chunk: bytes) -> bytes:
+        """The reference of the given (plaintext) chunk"""
+        # imported here, since hashlib's startup isn't free, and only --dedup
+        # needs it
+        import hashlib
+        return hashlib.blake2b(chunk, key=self._ref_key,
+                               digest_size=REF_SIZE).digest()
+
+    def encrypt(self, ref: bytes, chunk: bytes) -> bytes:
+        """Encrypts the chunk with the given reference"""
+        return self._cipher.encrypt(ref[:NONCE_SIZE], chunk, ref)
+
+    def decrypt(self, ref: bytes, data: bytes) -> Optional[bytes]:
+        """Decrypts the chunk with the given reference, or returns `None`"""
         try:
-            plaintext = cipher.decrypt(nonce, ciphertext_and_tag, None)
-            return plaintext
+            return self._cipher.decrypt(ref[:NONCE_SIZE], data, ref)
         except InvalidTag:
             return None
 
 # -----------------------------------------------------------------------------
 
-def derive_key(password: bytes, salt: bytes) -> bytes:
+class FileHeader(NamedTuple):
+    """The parsed header of a v2 file"""
+    archive_salt: bytes
+    file_salt: bytes
+    chunk_size: int = BLOCK_SIZE
+    flags: int = 0
+    cipher: int = CHACHA20_POLY1305
+    kdf: KdfSpec = LEGACY_SPEC
+
+def pack_file_header(header: FileHeader) -> bytes:
+    """Serializes `header`"""
+    return FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, header.archive_salt,
+                            header.file_salt, header.chunk_size, header.flags,
+                            header.cipher, *header.kdf)
+
+def unpack_file_header(data: bytes) -> Optional[FileHeader]:
     """
-    Returns a url safe, base 64 encoded key for Fernet encryption. Key is
-    derived from the given password, using PBKDF2HMAC.
+    Parses the file header at the start of `data`. Returns `None` if `data`
+    doesn't start with a v2 file header. The KDF spec is parsed as is, and may
+    not be `kdf.is_valid_spec`.
+    """
+    if len(data) < FILE_HEADER_SIZE or not data.startswith(FILE_MAGIC) or \
+       data[len(FILE_MAGIC)] != FILE_VERSION:
+        return None
+
+    (_, _, *fields) = FILE_HEADER.unpack_from(data)
+    kdf_fields = len(KdfSpec._fields)
+    fields[-kdf_fields:] = [KdfSpec(*fields[-kdf_fields:])]
+    return FileHeader(*fields)
+
+def _v2_file_cryptor(
+        master_key: bytes,
+        header: FileHeader,
+        encrypting: bool,
+        codec: Optional[int]=None
+    ) -> FileCryptor:
+    """
+    The `FileCryptor` for a v2 file, under `master_key`. Compressed files are
+    compressed with `codec`, when encrypting.
+    """
+    key = derive_subkey(master_key, FILE_KEY_INFO, header.file_salt)
+    store_cryptor = None
+    if header.flags & FLAG_DEDUPLICATED:
+        # chunks stored under different ciphers have different references (and
+        # keys), so that a chunk stored under one is never read with the other
+        cipher_info = b" " + bytes(CIPHERS[header.cipher].name, "utf-8")
+        store_cryptor = ChunkStoreCryptor(
+            derive_subkey(master_key, REF_KEY_INFO + cipher_info),
+            derive_subkey(master_key, STORE_KEY_INFO + cipher_info),
+            header.cipher)
+    return _V2FileCryptor(key, header, encrypting, store_cryptor, codec)
+
+def _decrypt_v1(password: bytes, ciphertext: bytes) -> Optional[bytes]:
+    """v1 Decryption. Returns `None` if decryption fails."""
+    salt = bytes(ciphertext[0:SALT_SIZE])
+    nonce = ciphertext[START_OF_NONCE:END_OF_NONCE]
+    ciphertext_and_tag = ciphertext[START_OF_CIPHERTEXT:]
+
+    is_malformed = (len(salt) != SALT_SIZE or
+                    len(nonce) != NONCE_SIZE or
+                    len(ciphertext_and_tag) < CHACHA_TAG_SIZE)
+
+    if is_malformed:
+        return None
+
+    key = derive_key(password=password, salt=salt, kdf=LEGACY_SPEC)
+    cipher = ChaCha20Poly1305(key)
+
+    try:
+        plaintext = cipher.decrypt(nonce, ciphertext_and_tag, None)
+        return plaintext
+    except InvalidTag:
+        return None
+
+def derive_key(password: bytes, salt: bytes, kdf: KdfSpec) -> bytes:
+    """
+    Returns a 256 bit key for ChaCha20-Poly1305 encryption. Key is derived from
+    the given password, using the KDF (and parameters) of `kdf`.
     """
     assert(len(salt) == SALT_SIZE)
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
-                     length=KEY_SIZE,
-                     salt=salt,
-                     iterations=KEY_STRETCH_COUNT,
-                     backend=default_backend())
-    key = kdf.derive(password)
+    stats = current_stats()
+    start = stats.clock()
+    key = stretch(password, salt, kdf, KEY_SIZE)
+    stats.record("kdf", start)
     return key
 
+@lru_cache(maxsize=16)
+def derive_master_key(password: bytes, archive_salt: bytes,
+                      kdf: KdfSpec) -> bytes:
+    """
+    `derive_key`, memoized per process so that the password is only stretched
+    once per archive.
+    """
+    return derive_key(password=password, salt=archive_salt, kdf=kdf)
+
+def derive_subkey(master_key: bytes, info: bytes, salt: bytes=None) -> bytes:
+    """
+    Derives a key for a single purpose (e.g. a file's contents) from the
+    stretched master key, using HKDF. Cheap compared to `derive_key`.
+    """
+    kdf = HKDF(algorithm=hashes.SHA256(),
+               length=KEY_SIZE,
+               salt=salt,
+               info=info,
+               backend=default_backend())
+    return kdf.derive(master_key)
+
 def create_psw_file(prefix: str="dircrypt") -> Tuple[bytes, Path]:
     # pylint: disable=invalid-sequence-index
     """
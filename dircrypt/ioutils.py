@@ -5,38 +5,121 @@ Utilities for File IO
 """
 __all__ = ['force_create_dir', 'force_create_file', 'label_malformed',
            'force_create_dir_or_exit', 'create_path_and_file', 'dir_walk',
-           'parse_file_path', 'gen_malformed_name', 'BLOCK_SIZE']
+           'walk_files', 'FileEntry', 'parse_file_path', 'gen_malformed_name',
+           'PathPattern', 'StreamReader', 'partial_path',
+           'create_partial_file', 'commit_partial_file', 'BLOCK_SIZE',
+           'PARTIAL_SUFFIX']
 
+import io
+import os
 import sys
-from pathlib import Path
-from typing import Tuple, Iterable
+import stat
+import errno
+import itertools
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+from typing import Tuple, Iterable, Iterator, Callable, Optional, BinaryIO
 
 from dircrypt.aux import starts_with
+from dircrypt.stats import current_stats
 
 # -----------------------------------------------------------------------------
 
 # Maximum number of bytes to read in a single file IO read
 BLOCK_SIZE = 16384 # 2**14
 
+# Output files are written under this suffix, and only renamed to their final
+# name once complete, so that an interrupted run leaves no truncated outputs
+PARTIAL_SUFFIX = ".dircrypt-partial"
+
+# Numbers malformed names, atomically (worker threads may generate them too)
+_MALFORMED_COUNTER = itertools.count()
+
 # -----------------------------------------------------------------------------
 
-def dir_walk(root: Path) -> Path:
+class FileEntry(object):
+    """
+    A file found by `walk_files`, which `stat`s it at most once, and only when
+    its `stat` is first needed.
+    """
+    __slots__ = ('path', '_entry', '_stat')
+
+    def __init__(
+            self,
+            path: Path,
+            entry: Optional[os.DirEntry]=None,
+            stat_result: Optional[os.stat_result]=None
+        ):
+        self.path = path
+        self._entry = entry
+        self._stat = stat_result
+
+    def stat(self) -> os.stat_result:
+        """
+        The (cached) `stat` of the file.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        if self._stat is None:
+            self._stat = self.path.stat() if self._entry is None \
+                         else self._entry.stat()
+        return self._stat
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the file, in bytes.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        return self.stat().st_size
+
+def walk_files(
+        root: Path,
+        include_dir: Optional[Callable[[Path], bool]]=None
+    ) -> Iterator[FileEntry]:
     """
     Iterator over all the files in the given directory (including sub
-    directories). Only files are returned. If `root` is a file, only `root` is
-    `yield`ed. Items are `yield`ed in no particular order.
-    """
-    if root.is_file():
-        yield root
-    elif root.is_dir():
-        subdirs = [root]
-        while len(subdirs) > 0:
-            directory = subdirs.pop()
-            for path_item in directory.iterdir():
-                if path_item.is_dir():
-                    subdirs.append(path_item)
-                elif path_item.is_file():
-                    yield path_item
+    directories), as `FileEntry`s. Only files are returned. If `root` is a
+    file, only `root` is `yield`ed. Items are `yield`ed in no particular order.
+    Directories (`root` included) for which `include_dir` returns `False`
+    aren't walked at all.
+
+    Directories are listed with `os.scandir`, which (on most filesystems)
+    reports the type of every item along with its name, so items are told
+    apart without `stat`ing them.
+    """
+    try:
+        root_stat = root.stat()
+    except OSError:
+        return
+    if stat.S_ISREG(root_stat.st_mode):
+        yield FileEntry(root, stat_result=root_stat)
+        return
+    if not stat.S_ISDIR(root_stat.st_mode):
+        return
+
+    subdirs = [root] if include_dir is None or include_dir(root) else []
+    while len(subdirs) > 0:
+        directory = subdirs.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdir = directory.joinpath(entry.name)
+                    if include_dir is None or include_dir(subdir):
+                        subdirs.append(subdir)
+                elif entry.is_file():
+                    yield FileEntry(directory.joinpath(entry.name), entry)
+
+def dir_walk(
+        root: Path,
+        include_dir: Optional[Callable[[Path], bool]]=None
+    ) -> Iterator[Path]:
+    """`walk_files`, over the paths of the files alone"""
+    for file_entry in walk_files(root, include_dir):
+        yield file_entry.path
 
 def force_create_dir(dir_name: str) -> Path:
     """
@@ -102,7 +185,6 @@ def parse_file_path(root: Path, path: Path) -> Tuple[Iterable[str], str]:
 
     e.g. (root="foo/bar", path="foo/bar/biz/baz.txt") -> (["biz/"], "baz.txt")
     """
-    assert(path.is_file())
     assert(starts_with(path.parts, root.parts))
 
     full_parts = path.relative_to(root).parts
@@ -116,24 +198,127 @@ def parse_file_path(root: Path, path: Path) -> Tuple[Iterable[str], str]:
 
 def create_path_and_file(path: Path) -> None:
     """A combination of mkdir and touch on the given path. Raises: `OSError`"""
+    stats = current_stats()
+    start = stats.clock()
     parts = path.parts
     dir_component = Path(*parts[:-1])
     dir_component.mkdir(parents=True, exist_ok=True)
     path.touch(exist_ok=False)
+    stats.record("mkdir", start)
+
+def partial_path(path: Path) -> Path:
+    """The file the contents of `path` are written to, until complete"""
+    return path.with_name(path.name + PARTIAL_SUFFIX)
+
+def create_partial_file(path: Path) -> Path:
+    """
+    `create_path_and_file` for the partial file of `path`, which is renamed to
+    `path` by `commit_partial_file`. Returns the partial file.
+
+    Raises:
+        `OSError`: if `path` already exists, or file io goes wrong.
+    """
+    if path.exists():
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                              str(path))
+    partial = partial_path(path)
+    create_path_and_file(partial)
+    return partial
+
+def commit_partial_file(path: Path, durable: bool=False) -> None:
+    """
+    Renames the partial file of `path` to `path`, so that `path` is either
+    complete, or doesn't exist at all. If `durable`, the partial file is
+    flushed to disk first, so that this holds even across a crash of the
+    machine (as is needed before the file is journaled).
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    partial = partial_path(path)
+    if durable:
+        stats = current_stats()
+        start = stats.clock()
+        with partial.open(mode="r+b") as part:
+            os.fsync(part.fileno())
+        stats.record("sync", start)
+    os.replace(str(partial), str(path))
 
 def gen_malformed_name(is_dir: bool=True) -> str:
     """
     Returns a unique, freshly generated path item name marking malformed data
     """
-    while True:
-        try:
-            name = "MALFORMED_DIR_NAME_{}" if is_dir else \
-                   "MALFORMED_FILE_NAME_{}"
-            unique_name = name.format(gen_malformed_name.increment)
-            gen_malformed_name.increment += 1
-            return unique_name
-        except AttributeError:
-            gen_malformed_name.increment = 0
+    name = "MALFORMED_DIR_NAME_{}" if is_dir else "MALFORMED_FILE_NAME_{}"
+    return name.format(next(_MALFORMED_COUNTER))
+
+class PathPattern(object):
+    """
+    A glob over relative paths, e.g. `projects/foo/**`. `*`, `?` and `[...]`
+    match within a single path item, while `**` matches any number of them.
+    Paths under a matching path (i.e. the contents of a matching directory)
+    match as well.
+    """
+
+    def __init__(self, pattern: str):
+        self._parts = tuple(part for part in PurePosixPath(pattern).parts
+                            if part != "/")
+
+    def matches(self, parts: Tuple[str, ...]) -> bool:
+        """Whether the path with the given items matches"""
+        return self._match(self._parts, parts, prefix=False)
+
+    def may_match_under(self, parts: Tuple[str, ...]) -> bool:
+        """
+        Whether any path under the directory with the given items may match,
+        i.e. whether the directory needs to be walked at all.
+        """
+        return self._match(self._parts, parts, prefix=True)
+
+    @staticmethod
+    def _match(pattern: Tuple[str, ...], parts: Tuple[str, ...],
+               prefix: bool) -> bool:
+        """
+        Matches `parts` against `pattern`, or only against a prefix of
+        `pattern` if `prefix`.
+        """
+        if len(pattern) == 0:
+            return True # `parts` is (under) a match
+        if len(parts) == 0:
+            return prefix or all(item == "**" for item in pattern)
+
+        if pattern[0] == "**":
+            return PathPattern._match(pattern[1:], parts, prefix) or \
+                   PathPattern._match(pattern, parts[1:], prefix)
+        return fnmatchcase(parts[0], pattern[0]) and \
+               PathPattern._match(pattern[1:], parts[1:], prefix)
+
+class StreamReader(io.RawIOBase):
+    """
+    Reads `prefix`, then `stream` (e.g. a pipe). Unlike reads of pipes, which
+    return whatever happens to be available, reads only come up short at the
+    end of `stream`, so that chunks read from it stay whole.
+    """
+
+    def __init__(self, stream: BinaryIO, prefix: bytes=b''):
+        super().__init__()
+        self._stream = stream
+        self._prefix = prefix
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        """Fills `buf`, unless the end of `stream` is reached first"""
+        with memoryview(buf) as view:
+            num_read = min(len(view), len(self._prefix))
+            view[:num_read] = self._prefix[:num_read]
+            self._prefix = self._prefix[num_read:]
+            while num_read < len(view):
+                num_streamed = self._stream.readinto(view[num_read:])
+                if not num_streamed:
+                    break
+                num_read += num_streamed
+        return num_read
 
 def label_malformed(path: Path) -> Path:
     """
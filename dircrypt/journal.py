@@ -0,0 +1,262 @@
+"""
+journal
+
+A crash safe record of the files an encryption has finished so far, from
+which an interrupted run can be resumed. Output files only take their final
+name once complete (and on disk), and only then are they appended to the
+journal, so every file in the journal is complete. Anything else in the
+output directory was left behind mid-write, and is redone on resume.
+"""
+__all__ = ['Journal', 'remove_unfinished', 'JOURNAL_NAME']
+
+import os
+import json
+from pathlib import Path, PurePath, PurePosixPath
+from typing import Dict, Optional, TextIO, Tuple
+
+from dircrypt.cryptor import Encryptor
+from dircrypt.kdf import KdfSpec, pack_kdf_spec, unpack_kdf_spec
+from dircrypt.manifest import Manifest, MANIFEST_NAME
+from dircrypt.chunkstore import CHUNK_STORE_NAME
+from dircrypt.ioutils import walk_files
+
+# -----------------------------------------------------------------------------
+
+# Stored at the root of the output directory, next to the output target, until
+# the run finishes
+JOURNAL_NAME = "dircrypt.journal"
+JOURNAL_VERSION = 1
+
+# Sealed into the header of journals, to check the password against
+JOURNAL_CHECK = "dircrypt journal"
+
+# Files at the root of the output directory that aren't outputs
+METADATA_NAMES = (MANIFEST_NAME, JOURNAL_NAME)
+
+# -----------------------------------------------------------------------------
+
+class Journal(object):
+    """
+    An append only file, holding a header line, then a line per finished
+    file. Every line after the header is encrypted (like a path name), so that
+    the journal reveals no more than the outputs do. Lines are flushed as
+    they're appended, so they survive the process being killed. Lines that
+    didn't make it to disk whole (e.g. on a reboot) are skipped when the
+    journal is read, and their files redone.
+    """
+
+    def __init__(self, journal: TextIO, mode: Encryptor):
+        self._journal = journal
+        self._mode = mode
+
+    @staticmethod
+    def create(output_dir: Path, mode: Encryptor) -> "Journal":
+        """
+        Starts a new journal in `output_dir`, for an encryption with `mode`.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        header = {"version": JOURNAL_VERSION,
+                  "archive_salt": mode.archive_salt.hex(),
+                  "kdf": pack_kdf_spec(mode.kdf).hex(),
+                  "check": mode.crypt_path_name(JOURNAL_CHECK)}
+
+        path = output_dir.joinpath(JOURNAL_NAME)
+        journal = path.open(mode="x", encoding="utf-8")
+        journal.write(json.dumps(header) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+        return Journal(journal, mode)
+
+    @staticmethod
+    def read_archive_kdf(output_dir: Path) -> \
+            Optional[Tuple[bytes, KdfSpec]]:
+        # pylint: disable=invalid-sequence-index
+        """
+        Returns the archive salt of the journal in `output_dir`, and the KDF
+        spec it's stretched with, which are stored in the clear, or `None` if
+        there is no readable journal.
+        """
+        header = _read_header(output_dir)
+        if header is None:
+            return None
+        try:
+            archive_salt = bytes.fromhex(header["archive_salt"])
+            kdf = unpack_kdf_spec(bytes.fromhex(header["kdf"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return None if kdf is None else (archive_salt, kdf)
+
+    @staticmethod
+    def resume(output_dir: Path,
+               mode: Encryptor) -> Optional[Tuple["Journal", Manifest]]:
+        # pylint: disable=invalid-sequence-index
+        """
+        Reopens the journal in `output_dir` for appending, and reads the files
+        finished so far into a `Manifest` (whose directories are those
+        holding a finished file). Returns `None` if the journal can't be
+        decrypted (e.g. the password is wrong).
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        unseal = mode.decryptor().crypt_path_name
+        with output_dir.joinpath(JOURNAL_NAME).open(encoding="utf-8",
+                                                    errors="replace") as jrnl:
+            lines = jrnl.read().split("\n")
+
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return None
+        if not isinstance(header, dict) or \
+           header.get("version") != JOURNAL_VERSION or \
+           unseal(str(header.get("check"))) != JOURNAL_CHECK:
+            return None
+
+        finished = Manifest()
+        for line in lines[1:]:
+            record = _parse_record(unseal(line))
+            if record is not None:
+                (source, entry) = record
+                finished.files[source] = entry
+        finished.dirs = _finished_dirs(finished)
+
+        journal = output_dir.joinpath(JOURNAL_NAME).open(mode="a",
+                                                         encoding="utf-8")
+        # a line cut short by a crash mustn't swallow the next one
+        journal.write("\n")
+        return (Journal(journal, mode), finished)
+
+    def record_file(self, source: PurePath, stat: os.stat_result,
+                    output: PurePath) -> None:
+        """
+        Records that `source` was encrypted to `output`, which must
+        already be complete, and on disk. `OSError`'s are logged to the end
+        user, but otherwise swallowed.
+        """
+        line = json.dumps([source.as_posix(), stat.st_size, stat.st_mtime_ns,
+                           stat.st_ino, output.as_posix()])
+        line = self._mode.crypt_path_name(line)
+        try:
+            self._journal.write(line + "\n")
+            self._journal.flush()
+        except OSError as e:
+            print("Error journaling '{}'. Failed with '{}'".format(source, e))
+
+    def close(self) -> None:
+        """
+        Flushes the journal to disk, and closes it.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        try:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        finally:
+            self._journal.close()
+
+    @staticmethod
+    def remove(output_dir: Path) -> None:
+        """
+        Removes the journal in `output_dir`, once its run has finished.
+        `OSError`'s are logged to the end user, but otherwise swallowed.
+        """
+        try:
+            output_dir.joinpath(JOURNAL_NAME).unlink()
+        except OSError as e:
+            print("Error removing '{}'. Failed with '{}'"\
+                  .format(JOURNAL_NAME, e))
+
+# -----------------------------------------------------------------------------
+
+def remove_unfinished(output_dir: Path, finished: Manifest) -> int:
+    """
+    Removes every file in `output_dir` that isn't a finished output (i.e.
+    one left behind mid-write, or finished but never journaled), along with
+    any directories left empty. dircrypt's own files (and the chunk store)
+    are kept. Returns the number of files removed. `OSError`'s are logged to
+    the end user, but otherwise swallowed.
+    """
+    outputs = {entry[3] for entry in finished.files.values()}
+    chunk_store = output_dir.joinpath(CHUNK_STORE_NAME)
+    walked_dirs = []
+
+    def include_dir(directory: Path) -> bool:
+        """Walks every directory but the chunk store"""
+        walked_dirs.append(directory)
+        return directory != chunk_store
+
+    num_removed = 0
+    for file_entry in walk_files(output_dir, include_dir):
+        output = file_entry.path.relative_to(output_dir)
+        if output.as_posix() in outputs or \
+           (len(output.parts) == 1 and output.name in METADATA_NAMES):
+            continue
+        try:
+            file_entry.path.unlink()
+            num_removed += 1
+        except OSError as e:
+            print("Error removing '{}'. Failed with '{}'"\
+                  .format(file_entry.path, e))
+
+    # deepest first, so that parents are empty by the time they're reached
+    for directory in sorted(walked_dirs, key=lambda d: len(d.parts),
+                            reverse=True):
+        if directory not in (output_dir, chunk_store):
+            try:
+                directory.rmdir()
+            except OSError:
+                pass # not empty
+    return num_removed
+
+def _finished_dirs(finished: Manifest) -> Dict[str, str]:
+    """
+    The output directory of every source directory holding a finished file.
+    Outputs mirror their sources item by item, so each parent of a source
+    maps to the parent of its output at the same depth.
+    """
+    dirs = {}
+    for (source, entry) in finished.files.items():
+        source_parents = PurePosixPath(source).parts[:-1]
+        output_parents = PurePosixPath(entry[3]).parts[:-1]
+        if len(source_parents) != len(output_parents):
+            continue
+        for depth in range(1, len(source_parents) + 1):
+            dirs[PurePosixPath(*source_parents[:depth]).as_posix()] = \
+                PurePosixPath(*output_parents[:depth]).as_posix()
+    return dirs
+
+def _parse_record(line: Optional[str]) -> Optional[Tuple[str, tuple]]:
+    # pylint: disable=invalid-sequence-index
+    """
+    The source and `Manifest` entry journaled on `line`, or `None` if `line`
+    is malformed (e.g. cut short by a crash).
+    """
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, list) or len(record) != 5:
+        return None
+    (source, *entry) = record
+    return (source, tuple(entry))
+
+def _read_header(output_dir: Path) -> Optional[Dict]:
+    """The header of the journal in `output_dir`, or `None` if unreadable"""
+    try:
+        with output_dir.joinpath(JOURNAL_NAME).open(encoding="utf-8",
+                                                    errors="replace") as jrnl:
+            header = json.loads(jrnl.readline())
+    except (OSError, ValueError):
+        return None
+    return header if isinstance(header, dict) else None
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
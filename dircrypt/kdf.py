@@ -0,0 +1,162 @@
+"""
+kdf
+
+The key derivation functions passwords can be stretched with, the parameters
+(or spec) recorded alongside each archive salt, and the calibration of those
+parameters to a time budget, for --kdf-target-ms.
+"""
+__all__ = ['KdfSpec', 'KDF_NAMES', 'PBKDF2', 'SCRYPT', 'LEGACY_SPEC',
+           'DEFAULT_SPECS', 'KDF_SPEC', 'pack_kdf_spec', 'unpack_kdf_spec',
+           'is_valid_spec', 'stretch', 'calibrate', 'describe']
+
+import os
+import struct
+from timeit import default_timer
+from typing import NamedTuple, Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# -----------------------------------------------------------------------------
+
+# KDF ids, as recorded in specs
+PBKDF2 = 0
+SCRYPT = 1
+KDF_NAMES = {"pbkdf2": PBKDF2, "scrypt": SCRYPT}
+
+# `kdf | cost | block size | parallelism`, where the cost is the number of
+# iterations for PBKDF2 (whose block size and parallelism are 0), and log2(N)
+# for scrypt
+KDF_SPEC = struct.Struct(">BIBB")
+
+# Bounds on the specs read from headers, so that a malicious one can't ask for
+# more than a few seconds, or more memory (128 * r * N bytes, for scrypt) than
+# a small machine has to spare. Calibration never goes above them either
+MAX_PBKDF2_ITERATIONS = 10**7
+MAX_SCRYPT_MEMORY = 2**28 # 256 MiB
+MAX_SCRYPT_BLOCK_SIZE = 32
+MAX_SCRYPT_PARALLELISM = 4
+
+# Calibration never goes below these, however small the time budget
+MIN_PBKDF2_ITERATIONS = 10000
+MIN_SCRYPT_LOG_N = 10
+
+# PBKDF2 is timed over this many iterations, and scaled up (linearly)
+PBKDF2_PROBE_ITERATIONS = 10000
+
+# -----------------------------------------------------------------------------
+
+class KdfSpec(NamedTuple):
+    """A KDF, and its parameters (see `KDF_SPEC`)"""
+    kdf: int
+    cost: int
+    block_size: int = 0
+    parallelism: int = 0
+
+# Archive salts from before specs were recorded are always stretched with
+LEGACY_SPEC = KdfSpec(PBKDF2, 100000)
+
+# Used without --kdf-target-ms (scrypt's takes 32 MiB)
+DEFAULT_SPECS = {
+    PBKDF2: LEGACY_SPEC,
+    SCRYPT: KdfSpec(SCRYPT, 15, 8, 1),
+}
+
+# -----------------------------------------------------------------------------
+
+def pack_kdf_spec(spec: KdfSpec) -> bytes:
+    """Serializes `spec`, as a `KDF_SPEC`"""
+    return KDF_SPEC.pack(*spec)
+
+def unpack_kdf_spec(data: bytes) -> Optional[KdfSpec]:
+    """
+    Parses the `KDF_SPEC` at the start of `data`. Returns `None` if it's cut
+    short, or isn't `is_valid_spec`.
+    """
+    if len(data) < KDF_SPEC.size:
+        return None
+    spec = KdfSpec(*KDF_SPEC.unpack_from(data))
+    return spec if is_valid_spec(spec) else None
+
+def is_valid_spec(spec: KdfSpec) -> bool:
+    """
+    Whether `spec` is a known KDF, with parameters within bounds (i.e. that
+    was likely written by dircrypt)
+    """
+    if spec.kdf == PBKDF2:
+        return 0 < spec.cost <= MAX_PBKDF2_ITERATIONS and \
+               spec.block_size == spec.parallelism == 0
+    if spec.kdf == SCRYPT:
+        return 0 < spec.cost < 64 and \
+               0 < spec.block_size <= MAX_SCRYPT_BLOCK_SIZE and \
+               0 < spec.parallelism <= MAX_SCRYPT_PARALLELISM and \
+               128 * spec.block_size * 2**spec.cost <= MAX_SCRYPT_MEMORY
+    return False
+
+def stretch(password: bytes, salt: bytes, spec: KdfSpec,
+            length: int) -> bytes:
+    """Stretches `password` into a `length` byte key, as per `spec`"""
+    assert(is_valid_spec(spec))
+    if spec.kdf == PBKDF2:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
+                         length=length,
+                         salt=salt,
+                         iterations=spec.cost,
+                         backend=default_backend())
+    else:
+        kdf = Scrypt(salt=salt,
+                     length=length,
+                     n=2**spec.cost,
+                     r=spec.block_size,
+                     p=spec.parallelism,
+                     backend=default_backend())
+    return kdf.derive(password)
+
+def calibrate(kdf: int, target_ms: float) -> KdfSpec:
+    """
+    The spec of `kdf` with the highest cost that stretches a password within
+    `target_ms`, as measured on this machine (but no lower than the minimum
+    cost). PBKDF2 is timed once, and scaled up. Scrypt's time doesn't scale
+    as neatly (its memory stops fitting in caches), so N is doubled, and
+    timed, until the next doubling would overrun, taking about twice the
+    budget in total.
+    """
+    assert(kdf in DEFAULT_SPECS and target_ms > 0)
+    target = target_ms / 10**3
+
+    if kdf == PBKDF2:
+        seconds = _time_stretch(KdfSpec(PBKDF2, PBKDF2_PROBE_ITERATIONS))
+        iterations = int(PBKDF2_PROBE_ITERATIONS * target / seconds)
+        return KdfSpec(PBKDF2, min(max(MIN_PBKDF2_ITERATIONS, iterations),
+                                   MAX_PBKDF2_ITERATIONS))
+
+    default = DEFAULT_SPECS[SCRYPT]
+    spec = KdfSpec(SCRYPT, MIN_SCRYPT_LOG_N, default.block_size,
+                   default.parallelism)
+    while True:
+        seconds = _time_stretch(spec)
+        bigger = spec._replace(cost=spec.cost + 1)
+        if 2 * seconds > target or not is_valid_spec(bigger):
+            return spec
+        spec = bigger
+
+def describe(spec: KdfSpec) -> str:
+    """`spec`, for the end user"""
+    if spec.kdf == PBKDF2:
+        return "PBKDF2 with {} iterations".format(spec.cost)
+    return "scrypt with N=2**{}, r={}, p={} ({} MiB)"\
+           .format(spec.cost, spec.block_size, spec.parallelism,
+                   128 * spec.block_size * 2**spec.cost // 2**20)
+
+def _time_stretch(spec: KdfSpec) -> float:
+    """The time (in seconds) `stretch` takes, under `spec`"""
+    start = default_timer()
+    stretch(b"dircrypt calibration", os.urandom(16), spec, 32)
+    return default_timer() - start
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
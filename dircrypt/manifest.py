@@ -0,0 +1,197 @@
+"""
+manifest
+
+An encrypted record of what was encrypted, for incremental re-encryption.
+"""
+__all__ = ['Manifest', 'MANIFEST_NAME']
+
+import io
+import os
+import json
+from pathlib import Path, PurePath
+from typing import Dict, Optional, Tuple
+
+from dircrypt.cryptor import Encryptor, unpack_file_header, FILE_HEADER_SIZE
+from dircrypt.kdf import KdfSpec, is_valid_spec
+from dircrypt.routines import crypt_chunks
+
+# -----------------------------------------------------------------------------
+
+# Stored at the root of the output directory, next to the encrypted target
+MANIFEST_NAME = "dircrypt.manifest"
+MANIFEST_VERSION = 1
+
+# (size, mtime_ns, inode, output file relative to the output directory)
+FileEntry = Tuple[int, int, int, str]
+
+# -----------------------------------------------------------------------------
+
+class Manifest(object):
+    """
+    Maps every encrypted source file (relative to the directory containing the
+    target) to its metadata at encryption time and its output file, and every
+    encrypted source directory to its output directory. Output paths are
+    relative to the output directory.
+    """
+
+    def __init__(
+            self,
+            files: Optional[Dict[str, FileEntry]]=None,
+            dirs: Optional[Dict[str, str]]=None
+        ):
+        self.files = {} if files is None else files
+        self.dirs = {} if dirs is None else dirs
+
+    @staticmethod
+    def read_archive_kdf(output_dir: Path) -> \
+            Optional[Tuple[bytes, KdfSpec]]:
+        # pylint: disable=invalid-sequence-index
+        """
+        Returns the archive salt of the manifest in `output_dir`, and the KDF
+        spec it's stretched with, which are stored in the clear, or `None` if
+        there is no readable manifest.
+        """
+        try:
+            with output_dir.joinpath(MANIFEST_NAME).open(mode="rb") as man:
+                header = unpack_file_header(man.read(FILE_HEADER_SIZE))
+        except OSError:
+            return None
+        if header is None or not is_valid_spec(header.kdf):
+            return None
+        return (header.archive_salt, header.kdf)
+
+    @staticmethod
+    def load(output_dir: Path, mode: Encryptor) -> Optional["Manifest"]:
+        """
+        Decrypts the manifest in `output_dir`. Returns `None` if it can't be
+        decrypted (e.g. the password is wrong).
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        contents = io.BytesIO()
+        decryptor = mode.decryptor()
+        with output_dir.joinpath(MANIFEST_NAME).open(mode="rb") as man:
+            file_cryptor = decryptor.start_file(man, contents)
+            if file_cryptor is None or \
+               not crypt_chunks(file_cryptor, man, contents):
+                return None
+
+        try:
+            data = json.loads(contents.getvalue().decode("utf-8"))
+        except ValueError:
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+
+        files = {src: tuple(entry) for (src, entry) in data["files"].items()}
+        return Manifest(files, data["dirs"])
+
+    def save(self, output_dir: Path, mode: Encryptor) -> None:
+        """
+        Encrypts the manifest to `output_dir`, replacing any existing manifest
+        atomically.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        data = {"version": MANIFEST_VERSION,
+                "files": self.files,
+                "dirs": self.dirs}
+        contents = io.BytesIO(json.dumps(data).encode("utf-8"))
+
+        manifest = output_dir.joinpath(MANIFEST_NAME)
+        tmp_manifest = output_dir.joinpath(MANIFEST_NAME + ".tmp")
+        with tmp_manifest.open(mode="wb") as man:
+            file_cryptor = mode.start_file(contents, man)
+            success = crypt_chunks(file_cryptor, contents, man)
+            assert(success)
+            man.flush()
+            os.fsync(man.fileno())
+        os.replace(str(tmp_manifest), str(manifest))
+
+    def is_unchanged(self, source: PurePath, stat: os.stat_result,
+                     output_dir: Path) -> bool:
+        """
+        Whether `source` (relative to the directory containing the target) is
+        unchanged since it was recorded, and its output file still exists.
+        """
+        entry = self.files.get(source.as_posix(), None)
+        if entry is None:
+            return False
+        (size, mtime_ns, inode, output) = entry
+        return (size, mtime_ns, inode) == \
+               (stat.st_size, stat.st_mtime_ns, stat.st_ino) and \
+               output_dir.joinpath(output).is_file()
+
+    def output_file(self, source: PurePath) -> Optional[str]:
+        """The recorded output file for `source`, if there is one"""
+        entry = self.files.get(source.as_posix(), None)
+        return None if entry is None else entry[3]
+
+    def remove_output(self, source: PurePath, output_dir: Path) -> None:
+        """
+        Removes the recorded output file for `source`, if there is one.
+        `OSError`'s are logged to the end user, but otherwise swallowed.
+        """
+        output = self.output_file(source)
+        if output is None:
+            return
+        try:
+            output_dir.joinpath(output).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("Error removing '{}'. Failed with '{}'".format(output, e))
+
+    def copy_file(self, source: PurePath, other: "Manifest") -> None:
+        """Copies the record of `source` from `other`"""
+        self.files[source.as_posix()] = other.files[source.as_posix()]
+
+    def record_file(self, source: PurePath, stat: os.stat_result,
+                    output: PurePath) -> None:
+        """Records that `source` was encrypted to `output`"""
+        self.files[source.as_posix()] = (stat.st_size, stat.st_mtime_ns,
+                                         stat.st_ino, output.as_posix())
+
+    def visited_dirs(self, output_dir: Path) -> Dict[PurePath, Path]:
+        """
+        The recorded output directories, in the form expected by
+        `DirectoryBuilder`. Directories that no longer exist are left out.
+        """
+        visited_dirs = {}
+        for (source, output) in self.dirs.items():
+            output_path = output_dir.joinpath(output)
+            if output_path.is_dir():
+                visited_dirs[PurePath(source)] = output_path
+        return visited_dirs
+
+    def record_dirs(self, visited_dirs: Dict[PurePath, Path],
+                    output_dir: Path) -> None:
+        """Records the output directories of a `DirectoryBuilder`"""
+        self.dirs = {source.as_posix(): \
+                        output.relative_to(output_dir).as_posix()
+                     for (source, output) in visited_dirs.items()}
+
+    def remove_stale_outputs(self, current: "Manifest",
+                             output_dir: Path) -> None:
+        """
+        Removes the output files of sources recorded here, but not in
+        `current`, along with any output directories left empty.
+        `OSError`'s are logged to the end user, but otherwise swallowed.
+        """
+        for source in self.files:
+            if source not in current.files:
+                self.remove_output(PurePath(source), output_dir)
+
+        # deepest first, so that parents are empty by the time they're reached
+        for output in sorted(self.dirs.values(), key=len, reverse=True):
+            try:
+                output_dir.joinpath(output).rmdir()
+            except OSError:
+                pass # not empty, or already gone
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
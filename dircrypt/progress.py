@@ -0,0 +1,166 @@
+"""
+progress
+
+Live progress reporting: bytes and files done, throughput, and an estimate of
+the time left. Workers count what they've done into their own slots of a
+shared memory array, so that progress costs no messages (or locks) per file.
+The parent adds the slots up periodically, from a background thread, against
+the totals of the work handed out (or skipped) by the run's own walk.
+"""
+__all__ = ['Progress', 'enable_progress', 'advance', 'format_duration',
+           'PROGRESS_INTERVAL']
+
+import sys
+import threading
+from timeit import default_timer
+from typing import TextIO, Tuple
+
+# -----------------------------------------------------------------------------
+
+# Seconds between progress lines, on a terminal (redrawn in place), or not
+# (appended)
+PROGRESS_INTERVAL = 0.5
+LOG_INTERVAL = 10
+
+# Counters per slot: bytes done, files done
+SLOT_SIZE = 2
+
+# Shared with the parent, and this worker's slot in them (per thread, since
+# worker threads share a process)
+_COUNTERS = None
+_LOCAL = threading.local()
+
+# -----------------------------------------------------------------------------
+
+def enable_progress(counters, next_slot) -> None:
+    """
+    Claims a slot of `counters` for the calling worker (process or thread),
+    to count its progress into. Meant as a pool initializer.
+    """
+    global _COUNTERS # pylint: disable=global-statement
+    _COUNTERS = counters
+    with next_slot.get_lock():
+        # workers replacing dead ones share a slot, and may lose counts
+        _LOCAL.slot = next_slot.value % (len(counters) // SLOT_SIZE)
+        next_slot.value += 1
+
+def advance(num_bytes: int, num_files: int) -> None:
+    """
+    Counts `num_bytes` and `num_files` done by this worker. A no-op, unless
+    progress is enabled.
+    """
+    slot = getattr(_LOCAL, "slot", None)
+    if slot is None:
+        return
+    _COUNTERS[SLOT_SIZE * slot] += num_bytes
+    _COUNTERS[SLOT_SIZE * slot + 1] += num_files
+
+def format_duration(seconds: float) -> str:
+    """`seconds`, as h:mm:ss"""
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+
+class Progress(object):
+    """
+    Totals of the work to do, and the slots workers count the work done into.
+    Totals are those of the work found (and skipped) so far, and are only
+    final once every piece of work has been found (see `found_all`). Work
+    that's skipped (e.g. unchanged files, with --update) counts as done.
+    """
+
+    def __init__(self, workers: int, stream: TextIO=sys.stderr):
+        # imported here, so that runs without --progress (or a pool) never
+        # import multiprocessing
+        from multiprocessing import Value
+        from multiprocessing.sharedctypes import RawArray
+        self._counters = RawArray('q', SLOT_SIZE * workers)
+        self._next_slot = Value('i', 0)
+        self._stream = stream
+        self._found = [0, 0] # bytes, files
+        self._skipped = [0, 0]
+        self._complete = False # whether the totals are final
+        self._start = default_timer()
+        self._stop = threading.Event()
+        self._display = None
+
+    @property
+    def worker_args(self) -> Tuple:
+        """The arguments of `enable_progress`, for pool initializers"""
+        return (self._counters, self._next_slot)
+
+    def found(self, num_bytes: int, num_files: int) -> None:
+        """Adds work that's been found, and handed to the workers"""
+        self._found[0] += num_bytes
+        self._found[1] += num_files
+
+    def skip(self, num_bytes: int, num_files: int=1) -> None:
+        """Adds work that's been found, but needs no doing"""
+        self._skipped[0] += num_bytes
+        self._skipped[1] += num_files
+
+    def found_all(self) -> None:
+        """Marks the work found so far as all of it, making the totals final"""
+        self._complete = True
+
+    def start(self) -> None:
+        """Starts printing progress lines, from a background thread"""
+        interval = PROGRESS_INTERVAL if self._stream.isatty() \
+                   else LOG_INTERVAL
+
+        def display() -> None:
+            """Prints a progress line every `interval` seconds"""
+            while not self._stop.wait(interval):
+                self._print(final=False)
+
+        self._start = default_timer()
+        self._display = threading.Thread(target=display, daemon=True)
+        self._display.start()
+
+    def finish(self) -> None:
+        """Stops printing progress lines, and prints the final one"""
+        self._complete = True
+        self._stop.set()
+        if self._display is not None:
+            self._display.join()
+        self._print(final=True)
+
+    def _print(self, final: bool) -> None:
+        """Prints a single progress line"""
+        (done_bytes, done_files) = (sum(self._counters[0::SLOT_SIZE]),
+                                    sum(self._counters[1::SLOT_SIZE]))
+        (total_bytes, total_files) = [found + skipped for (found, skipped)
+                                      in zip(self._found, self._skipped)]
+        elapsed = max(default_timer() - self._start, 1e-9)
+        (byte_rate, file_rate) = (done_bytes / elapsed, done_files / elapsed)
+        done_bytes += self._skipped[0]
+        done_files += self._skipped[1]
+
+        # whichever of the bytes, or files, left takes longer (the latter for
+        # many small files, whose time goes to opening and creating them)
+        eta = None
+        if self._complete and byte_rate > 0 and file_rate > 0:
+            eta = max(max(0, total_bytes - done_bytes) / byte_rate,
+                      max(0, total_files - done_files) / file_rate)
+        line = "{:.1f} / {:.1f}{} MB ({:.0f}%), {} / {}{} files, "\
+               "{:.1f} MB/s, {:.0f} files/s, {}"\
+               .format(done_bytes / 10**6, total_bytes / 10**6,
+                       "" if self._complete else "+",
+                       100 * done_bytes / max(total_bytes, 1),
+                       done_files, total_files,
+                       "" if self._complete else "+",
+                       byte_rate / 10**6, file_rate,
+                       "took {}".format(format_duration(elapsed)) if final
+                       else "ETA " + ("?" if eta is None
+                                      else format_duration(eta)))
+
+        if self._stream.isatty():
+            self._stream.write("\r\033[K" + line + ("\n" if final else ""))
+        else:
+            self._stream.write(line + "\n")
+        self._stream.flush()
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
@@ -0,0 +1,240 @@
+"""
+reader
+
+Random access to the plaintext of encrypted files. Every chunk but the last
+holds the same number of plaintext bytes, so the chunks overlapping any byte
+range can be found, and decrypted, without decrypting the rest of the file.
+Recently decrypted chunks are cached, so that small, nearby reads don't
+decrypt the same chunk over and over.
+"""
+__all__ = ['EncryptedFile', 'open_encrypted', 'wrap_encrypted',
+           'CACHE_SIZE']
+
+import io
+import errno
+from pathlib import Path
+from collections import OrderedDict
+from typing import BinaryIO, List, Optional, Tuple
+
+from dircrypt.cryptor import Decryptor, FileCryptor, FRAME_LEN
+from dircrypt.stats import current_stats
+
+# -----------------------------------------------------------------------------
+
+# Number of decrypted chunks cached by default
+CACHE_SIZE = 16
+
+# -----------------------------------------------------------------------------
+
+class EncryptedFile(io.RawIOBase):
+    """
+    A seekable, read only view of the plaintext of an encrypted file. Reads
+    only decrypt the chunks they overlap. Chunks that fail to authenticate
+    raise an `OSError` (`EIO`), like an unreadable disk sector would.
+    """
+
+    def __init__(
+            self,
+            file: BinaryIO,
+            file_cryptor: FileCryptor,
+            chunks: List[Tuple[int, int]],
+            size: Optional[int]=None,
+            cache_size: int=CACHE_SIZE
+        ):
+        # pylint: disable=invalid-sequence-index
+        """
+        `chunks` holds the offset and length of every (encrypted) chunk in
+        `file`, whose plaintext is `size` bytes long. If `size` isn't known
+        (e.g. the last chunk is compressed), the last chunk is decrypted to
+        find it. So is the last chunk of files which mark their final chunk,
+        so that a file cut short fails to open, rather than reading short.
+
+        Raises:
+            `OSError`: if the last chunk is decrypted, and file io goes wrong,
+                       or it's malformed.
+        """
+        super().__init__()
+        assert(cache_size > 0)
+        self._file = file
+        self._file_cryptor = file_cryptor
+        self._chunks = chunks
+        self._size = size
+        self._cache_size = cache_size
+        self._cache = OrderedDict() # Dict[int, bytes], least recent first
+        self._pos = 0
+
+        if len(chunks) > 0 and (size is None or file_cryptor.marks_final):
+            last_chunk = self._chunk(len(chunks) - 1)
+            self._size = (len(chunks) - 1) * file_cryptor.write_len + \
+                         len(last_chunk)
+        elif size is None:
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        """The length of the plaintext"""
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        """
+        Reads up to the end of the plaintext, decrypting only the chunks that
+        overlap the read.
+
+        Raises:
+            `OSError`: if file io goes wrong, or a chunk is malformed.
+        """
+        chunk_len = self._file_cryptor.write_len
+        with memoryview(buf) as view:
+            end = min(self._size, self._pos + len(view))
+            num_read = 0
+            while self._pos < end:
+                (index, skip) = divmod(self._pos, chunk_len)
+                chunk = self._chunk(index)
+                num_copied = min(len(chunk) - skip, end - self._pos)
+                if num_copied <= 0:
+                    break # the last chunk was shorter than expected
+                view[num_read:num_read + num_copied] = \
+                    chunk[skip:skip + num_copied]
+                num_read += num_copied
+                self._pos += num_copied
+        return num_read
+
+    def seek(self, pos: int, whence: int=io.SEEK_SET) -> int:
+        """Seeks within the plaintext"""
+        base = {io.SEEK_SET: 0,
+                io.SEEK_CUR: self._pos,
+                io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        """Closes the underlying encrypted file"""
+        if not self.closed:
+            self._file.close()
+            self._cache.clear()
+        super().close()
+
+    def _chunk(self, index: int) -> bytes:
+        """
+        The plaintext of the `index`th chunk, decrypted (and cached) if it
+        isn't cached already.
+
+        Raises:
+            `OSError`: if file io goes wrong, or the chunk is malformed.
+        """
+        chunk = self._cache.get(index, None)
+        if chunk is not None:
+            self._cache.move_to_end(index)
+            return chunk
+
+        stats = current_stats()
+        clock = stats.clock()
+        (offset, length) = self._chunks[index]
+        self._file.seek(offset)
+        data = self._file.read(length)
+        clock = stats.record("read", clock, len(data))
+        final = index == len(self._chunks) - 1
+        chunk = None if len(data) != length else \
+                self._file_cryptor.crypt_chunk(index, data, final)
+        stats.record("crypt", clock, len(data))
+        if chunk is None:
+            raise OSError(errno.EIO,
+                          "Chunk {} failed to decrypt".format(index))
+
+        self._cache[index] = chunk
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return chunk
+
+# -----------------------------------------------------------------------------
+
+def wrap_encrypted(
+        file: BinaryIO,
+        decryptor: Decryptor,
+        cache_size: int=CACHE_SIZE
+    ) -> Optional[EncryptedFile]:
+    """
+    Wraps `file`, a seekable encrypted file (or e.g. an archive record, as a
+    `FileWindow`), in an `EncryptedFile`. Returns `None` if its header is
+    malformed, or its chunks are deduplicated (i.e. stored in a chunk store).
+    Compressed chunks vary in length, so their lengths are read up front,
+    and the last chunk is decrypted to find the length of the plaintext.
+
+    Raises:
+        `OSError`: if file io goes wrong, or the last chunk is decrypted (see
+                   `EncryptedFile`), and is malformed (e.g. the file was cut
+                   short).
+    """
+    file_cryptor = decryptor.start_file(file, io.BytesIO())
+    if file_cryptor is None or file_cryptor.store_cryptor is not None:
+        return None
+    file_len = file.seek(0, io.SEEK_END)
+
+    if not file_cryptor.framed_input:
+        body_len = file_len - file_cryptor.read_offset
+        chunks = [(offset, min(file_cryptor.read_len, file_len - offset))
+                  for offset in range(file_cryptor.read_offset, file_len,
+                                      file_cryptor.read_len)]
+        if not chunks and file_cryptor.marks_final:
+            # the (missing) empty final chunk, which fails to decrypt
+            chunks = [(file_cryptor.read_offset, 0)]
+        num_full_chunks = body_len // file_cryptor.read_len
+        overhead = file_cryptor.read_len - file_cryptor.write_len
+        size = num_full_chunks * file_cryptor.write_len + \
+               max(0, body_len % file_cryptor.read_len - overhead)
+        return EncryptedFile(file, file_cryptor, chunks, size,
+                             cache_size=cache_size)
+
+    chunks = []
+    offset = file_cryptor.read_offset
+    while offset < file_len:
+        file.seek(offset)
+        prefix = file.read(FRAME_LEN.size)
+        if len(prefix) != FRAME_LEN.size:
+            return None
+        (frame_len,) = FRAME_LEN.unpack(prefix)
+        if frame_len > file_cryptor.read_len:
+            return None
+        chunks.append((offset + FRAME_LEN.size, frame_len))
+        offset += FRAME_LEN.size + frame_len
+    if not chunks and file_cryptor.marks_final:
+        return None # missing its final chunk
+
+    return EncryptedFile(file, file_cryptor, chunks, cache_size=cache_size)
+
+def open_encrypted(
+        path: Path,
+        decryptor: Decryptor,
+        cache_size: int=CACHE_SIZE
+    ) -> Optional[EncryptedFile]:
+    """
+    Opens the encrypted file at `path` for random access reads of its
+    plaintext, caching up to `cache_size` decrypted chunks. See
+    `wrap_encrypted`.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    file = path.open(mode="rb")
+    try:
+        encrypted = wrap_encrypted(file, decryptor, cache_size)
+    except OSError:
+        file.close()
+        raise
+    if encrypted is None:
+        file.close()
+    return encrypted
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
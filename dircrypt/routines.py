@@ -3,15 +3,34 @@ routines
 
 Higher level routines for dircrypt
 """
-__all__ = ['DirectoryBuilder', 'crypt_path_and_contents']
+__all__ = ['DirectoryBuilder', 'crypt_path_and_contents', 'start_split_file',
+           'crypt_chunk_range', 'finish_split_file', 'crypt_chunks',
+           'read_chunks', 'crypt_mapped_chunks', 'crypt_stream',
+           'SPLIT_FILE_SIZE', 'MMAP_MIN_SIZE']
 
+import io
+import os
+import mmap
 from pathlib import Path, PurePath
-from multiprocessing.managers import SyncManager
+from typing import Optional, Tuple, List, Dict, BinaryIO, Iterator
 
 from dircrypt.aux import debug_print
-from dircrypt.cryptor import Cryptor
+from dircrypt.stats import current_stats
+from dircrypt.cryptor import Cryptor, FileCryptor, REF_SIZE, FRAME_LEN
+from dircrypt.chunkstore import ChunkStore, ChunkRefReader, ChunkRefWriter
 from dircrypt.ioutils import (parse_file_path, gen_malformed_name,
-                              create_path_and_file, label_malformed)
+                              label_malformed, partial_path,
+                              create_partial_file, commit_partial_file)
+
+# -----------------------------------------------------------------------------
+
+# Files larger than this are split into ranges of chunks (of roughly
+# `RANGE_SIZE` bytes), which are (en|de)crypted concurrently
+SPLIT_FILE_SIZE = 2**26 # 64 MiB
+RANGE_SIZE = 2**24 # 16 MiB
+
+# With `use_mmap`, files at least this large are memory mapped instead of read
+MMAP_MIN_SIZE = 2**24 # 16 MiB
 
 # -----------------------------------------------------------------------------
 
@@ -26,55 +45,117 @@ class DirectoryBuilder(object):
             root: Path,
             output_dir: Path,
             mode: Cryptor,
-            manager: SyncManager
+            use_mmap: bool=False,
+            visited_dirs: Optional[Dict[PurePath, Path]]=None,
+            chunk_store: Optional[ChunkStore]=None,
+            durable: bool=False
         ):
         """
         `root`: The path to the target directory (not including the target)
         `output_dir`: The path to the output directory
         `mode`: Encryptor or Decryptor object
-        `manager`: used to generate shared dictionary and lock for building
-                   directory
+        `use_mmap`: whether to memory map files of at least `MMAP_MIN_SIZE`
+        `visited_dirs`: directories already (en|de)crypted into `output_dir`,
+                        e.g. by a previous run
+        `chunk_store`: where the chunks of deduplicated files are stored
+        `durable`: whether to flush output files to disk before they take
+                   their final name (see `commit_partial_file`)
         """
         self._mode = mode
+        self._use_mmap = use_mmap
         self._path_to_target = root
         self._output_dir = output_dir
-        self._visited_dirs = manager.dict() # Dict[Path, str]
-        self._lock = manager.Lock() # since `_visited_dirs` is the only mutated
-                                    # variable, locking only needs to happen
-                                    # around that
+        self._visited_dirs = {} if visited_dirs is None else visited_dirs
+        self._chunk_store = chunk_store
+        self._durable = durable
 
-    def build_file_path(self, path: Path) -> Path:
+    def __getstate__(self):
+        """
+        `_visited_dirs` is only used by the thread walking the target
+        directory, so it isn't sent along to worker processes.
+        """
+        state = self.__dict__.copy()
+        state["_visited_dirs"] = {}
+        return state
+
+    @property
+    def visited_dirs(self) -> Dict[PurePath, Path]:
+        """
+        Maps the original directories (relative to `root`) to their output
+        directories
+        """
+        return self._visited_dirs
+
+    @property
+    def durable(self) -> bool:
+        """Whether output files are flushed to disk before they're committed"""
+        return self._durable
+
+    def build_dir_path(self, path: Path) -> Path:
         """
         Given the original path to a target file, returns the new path to the
-        output file. Path items that cannot be decrypted are labeled as
-        malformed in the returned path.
+        output directory containing the output file. Each directory name is
+        only (en|de)crypted once, so this must only be called from a single
+        process (i.e. the one walking the target directory). Path items that
+        cannot be decrypted are labeled as malformed in the returned path.
+        """
+        intermediate_path, _ = parse_file_path(self._path_to_target, path)
+        return self._build_dir_path(intermediate_path)
+
+    def build_subdir_path(self, directory: Path) -> Path:
         """
-        intermediate_path, target_file = parse_file_path(self._path_to_target,
-                                                         path)
-        crypted_path = [self._output_dir]
+        Given the original path to a directory within the target (or the target
+        itself), returns the new path to its output directory. Same
+        restrictions as `build_dir_path`.
+        """
+        parts = directory.relative_to(self._path_to_target).parts
+        return self._build_dir_path(parts)
+
+    def _build_dir_path(self, intermediate_path: Tuple[str, ...]) -> Path:
+        """The output directory of an original directory, given its items"""
+        crypted_path = self._output_dir
         path_id = PurePath() # Used in distinguishing subdirs w/same name
 
         for path_item in intermediate_path:
-            path_id = path_id.joinpath(Path(path_item))
-            new_dir = None
-            with self._lock:
-                new_dir = self._visited_dirs.get(path_id, None)
-                if new_dir is None:
-                    new_dir = self._mode.crypt_path_name(path_item)
-                    if new_dir is None:
-                        new_dir = gen_malformed_name(is_dir=True)
-                    self._visited_dirs[path_id] = new_dir
+            path_id = path_id.joinpath(path_item)
+            new_dir = self._visited_dirs.get(path_id, None)
+            if new_dir is None:
+                stats = current_stats()
+                start = stats.clock()
+                new_dir_name = self._mode.crypt_path_name(path_item)
+                stats.record("names", start)
+                if new_dir_name is None:
+                    new_dir_name = gen_malformed_name(is_dir=True)
+                new_dir = crypted_path.joinpath(new_dir_name)
+                self._visited_dirs[path_id] = new_dir
 
             assert(new_dir is not None)
-            crypted_path.append(new_dir)
+            crypted_path = new_dir
 
-        crypted_file_name = self._mode.crypt_path_name(target_file)
+        return crypted_path
+
+    def build_file_name(self, path: Path) -> str:
+        """
+        Given the original path to a target file, returns the new name of the
+        output file. Names that cannot be decrypted are labeled as malformed.
+        """
+        stats = current_stats()
+        start = stats.clock()
+        crypted_file_name = self._mode.crypt_path_name(path.name)
+        stats.record("names", start)
 
         if crypted_file_name is None:
             crypted_file_name = gen_malformed_name(is_dir=False)
 
-        crypted_path.append(crypted_file_name)
-        return Path(*crypted_path)
+        return crypted_file_name
+
+    def build_file_path(self, path: Path) -> Path:
+        """
+        Given the original path to a target file, returns the new path to the
+        output file. Same restrictions as `build_dir_path`.
+        """
+        crypted_dir = self.build_dir_path(path)
+        return crypted_dir.joinpath(self.build_file_name(path))
 
     def write_crypted_contents(self, original: Path, target: Path) -> bool:
         """
@@ -84,49 +165,406 @@ class DirectoryBuilder(object):
         Raises:
             `OSError`: if file io goes wrong.
         """
-        assert(original.is_file())
-        assert(target.is_file())
+        with original.open(mode="rb") as orig, target.open(mode="wb") as targ:
+            file_cryptor = self._mode.start_file(orig, targ)
+            if file_cryptor is None:
+                return False
+            if file_cryptor.store_cryptor is not None:
+                return self._crypt_deduplicated(file_cryptor, orig, targ)
+            if self._use_mmap and not file_cryptor.framed_input and \
+               os.fstat(orig.fileno()).st_size >= MMAP_MIN_SIZE:
+                return crypt_mapped_chunks(file_cryptor, orig, targ)
+            return crypt_chunks(file_cryptor, orig, targ)
 
-        with original.open(mode="rb", buffering=self._mode.read_len) as orig, \
-             target.open(mode="wb", buffering=self._mode.write_len) as targ:
+    def start_split_file(self, original: Path, target: Path) -> \
+            Optional[FileCryptor]:
+        """
+        Handles the file header of `original` (or `target`), so that the
+        remaining chunks can be (en|de)crypted out of order with
+        `crypt_chunk_range`. Returns `None` on a malformed header.
 
-            contents = orig.read(self._mode.read_len)
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        with original.open(mode="rb") as orig, target.open(mode="wb") as targ:
+            return self._mode.start_file(orig, targ)
+
+    def write_crypted_range(
+            self,
+            original: Path,
+            target: Path,
+            file_cryptor: FileCryptor,
+            first: int,
+            last: Optional[int]
+        ) -> bool:
+        """
+        (En|De)crypts the chunks `[first, last)` of `original` (or every chunk
+        from `first` on, if `last` is `None`), writing them at their final
+        offsets in `target`. Since every chunk but the last is a fixed size,
+        the output is identical to that of `write_crypted_contents`. Files
+        with framed chunks can only be (en|de)crypted from `first == 0`.
+        Returns `False` on failed decryption.
+
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        read_len = file_cryptor.read_len
+        write_len = file_cryptor.write_len
+
+        with original.open(mode="rb") as orig, \
+             target.open(mode="r+b") as targ:
+            orig.seek(file_cryptor.read_offset + first * read_len)
+
+            if file_cryptor.store_cryptor is None:
+                targ.seek(file_cryptor.write_offset + first * write_len)
+                use_mmap = self._use_mmap and not file_cryptor.framed_input
+                crypt = crypt_mapped_chunks if use_mmap else crypt_chunks
+                return crypt(file_cryptor, orig, targ, first, last)
+
+            # Deduplicated files are only split when decrypting, where every
+            # (full) chunk holds `write_len // REF_SIZE` references, to chunks
+            # of `write_len` bytes
+            assert(not file_cryptor.encrypting)
+            if write_len % REF_SIZE != 0:
+                return False
+            targ.seek(first * (write_len // REF_SIZE) * write_len)
+            return self._crypt_deduplicated(file_cryptor, orig, targ, first,
+                                            last)
+
+    def _crypt_deduplicated(
+            self,
+            file_cryptor: FileCryptor,
+            orig: BinaryIO,
+            targ: BinaryIO,
+            first: int=0,
+            last: Optional[int]=None
+        ) -> bool:
+        """
+        `crypt_chunks` for deduplicated files, whose (plaintext) contents are
+        references into the chunk store. Returns `False` on failed decryption,
+        including missing chunks.
 
-            while contents not in (b'', None):
-                crypted_contents = self._mode.crypt_file_contents(contents)
-                if crypted_contents is None:
-                    return False
-                check = targ.write(crypted_contents)
-                assert(check == len(crypted_contents))
-                contents = orig.read(self._mode.read_len)
+        Raises:
+            `OSError`: if file io goes wrong.
+        """
+        store_cryptor = file_cryptor.store_cryptor
+        assert(store_cryptor is not None)
+        if self._chunk_store is None:
+            return False
 
-        return True
+        if file_cryptor.encrypting:
+            refs = ChunkRefReader(orig, self._chunk_store, store_cryptor,
+                                  file_cryptor.read_len)
+            return crypt_chunks(file_cryptor, io.BufferedReader(refs), targ,
+                                first, last)
+
+        refs = ChunkRefWriter(targ, self._chunk_store, store_cryptor)
+        success = crypt_chunks(file_cryptor, orig, refs, first, last)
+        return success and refs.ok
 
 # -----------------------------------------------------------------------------
 
-def crypt_path_and_contents(builder: DirectoryBuilder, original: Path) -> None:
+def crypt_chunks(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        targ: BinaryIO,
+        first: int=0,
+        last: Optional[int]=None
+    ) -> bool:
     """
-    Encrypts the `target`'s path, filename, and contents according to the data
-    in `builder`. `OSError`'s are logged to the end user, but otherwise
-    swallowed.
+    (En|De)crypts the chunks `[first, last)` from `orig` to `targ`, starting at
+    their current positions. Chunks are read (see `read_chunks`) into, and
+    (en|de)crypted into, buffers allocated once per call, rather than once per
+    chunk. Returns `False` on failed decryption.
+
+    Raises:
+        `OSError`: if file io goes wrong.
     """
-    assert(original.is_file())
-    crypted_file = builder.build_file_path(original)
+    out_view = memoryview(bytearray(file_cryptor.write_len))
+    stats = current_stats()
+
+    for (index, chunk, final) in read_chunks(file_cryptor, orig, first, last):
+        if chunk is None:
+            return False
+        clock = stats.clock()
+        num_crypted = file_cryptor.crypt_chunk_into(index, chunk, out_view,
+                                                    final)
+        if num_crypted is None:
+            return False
+        clock = stats.record("crypt", clock, len(chunk))
+        check = targ.write(out_view[:num_crypted])
+        assert(check == num_crypted)
+        stats.record("write", clock, num_crypted)
+
+    return True
+
+def read_chunks(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        first: int=0,
+        last: Optional[int]=None
+    ) -> Iterator[Tuple[int, Optional[memoryview], bool]]:
+    # pylint: disable=invalid-sequence-index
+    """
+    Reads the chunks `[first, last)` (or every chunk from `first` on) from
+    `orig`, starting at its current position. Yields the index of every chunk,
+    the chunk itself (only valid until the next one is yielded), and whether
+    it's the final chunk of the file, i.e. whether `orig` ends right after it,
+    which is found by reading ahead. For files which mark their final chunk,
+    an empty body (from `first == 0`) is a single, empty, final chunk. A
+    malformed frame is yielded as `None`, after which nothing more is read.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    views = [memoryview(bytearray(file_cryptor.read_len)) for _ in range(2)]
+    framed = file_cryptor.framed_input
+    stats = current_stats()
+
+    def read(view: memoryview) -> Optional[int]:
+        """Reads the next chunk (or frame) into `view`"""
+        clock = stats.clock()
+        num_read = _read_frame(orig, view) if framed else orig.readinto(view)
+        stats.record("read", clock, num_read or 0)
+        return num_read
+
+    index = first
+    num_read = read(views[0])
+    if num_read == 0 and first == 0 and file_cryptor.marks_final:
+        yield (index, views[0][:0], True)
+        return
+
+    while num_read and (last is None or index < last):
+        # past the last chunk of a range, only whether there's more matters
+        ahead = views[1] if last is None or index + 1 < last else views[1][:1]
+        next_read = read(ahead)
+        yield (index, views[0][:num_read], next_read == 0)
+        views.reverse()
+        (index, num_read) = (index + 1, next_read)
+
+    if num_read is None and (last is None or index < last):
+        yield (index, None, False)
+
+def _read_frame(orig: BinaryIO, in_view: memoryview) -> Optional[int]:
+    """
+    Reads the next length prefixed chunk from `orig` into `in_view`. Returns
+    the chunk's length, `0` at the end of `orig`, or `None` if the frame is
+    malformed.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    prefix = orig.read(FRAME_LEN.size)
+    if not prefix:
+        return 0
+    if len(prefix) != FRAME_LEN.size:
+        return None
+
+    (frame_len,) = FRAME_LEN.unpack(prefix)
+    if frame_len > len(in_view):
+        return None
+    num_read = orig.readinto(in_view[:frame_len])
+    return frame_len if num_read == frame_len else None
+
+def crypt_mapped_chunks(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        targ: BinaryIO,
+        first: int=0,
+        last: Optional[int]=None
+    ) -> bool:
+    """
+    `crypt_chunks`, except that chunks are sliced out of a memory map of
+    `orig`, rather than read. `orig`'s position is ignored, since chunks are
+    located by their index, unless there are no chunks to map.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    read_len = file_cryptor.read_len
+    if os.fstat(orig.fileno()).st_size <= \
+       file_cryptor.read_offset + first * read_len:
+        # empty files can't be mapped, and may still hold an empty final chunk
+        return crypt_chunks(file_cryptor, orig, targ, first, last)
+    out_view = memoryview(bytearray(file_cryptor.write_len))
+
+    with mmap.mmap(orig.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+         memoryview(mapped) as view:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        stats = current_stats()
+        index = first
+        start = file_cryptor.read_offset + first * read_len
+        while start < len(view) and (last is None or index < last):
+            clock = stats.clock()
+            final = start + read_len >= len(view)
+            with view[start:start + read_len] as contents:
+                num_crypted = file_cryptor.crypt_chunk_into(index, contents,
+                                                            out_view, final)
+                clock = stats.record("crypt", clock, len(contents))
+            if num_crypted is None:
+                return False
+            check = targ.write(out_view[:num_crypted])
+            assert(check == num_crypted)
+            stats.record("write", clock, num_crypted)
+            index += 1
+            start += read_len
+
+    return True
+
+def crypt_stream(mode: Cryptor, orig: BinaryIO, targ: BinaryIO) -> bool:
+    """
+    (En|De)crypts a single file's contents from `orig` to `targ` in one
+    sequential pass, e.g. between pipes, holding a single chunk in memory at a
+    time. Returns `False` on a malformed header, or failed decryption, in
+    which case everything written to `targ` so far was still authenticated.
+    Deduplicated contents can't be streamed, since they need a chunk store.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    stream = mode.start_stream(orig, targ)
+    if stream is None:
+        return False
+    (file_cryptor, contents) = stream
+    if file_cryptor.store_cryptor is not None:
+        return False
+    return crypt_chunks(file_cryptor, contents, targ)
+
+def crypt_path_and_contents(
+        builder: DirectoryBuilder,
+        original: Path,
+        crypted_dir: Path,
+        crypted_name: Optional[str]=None
+    ) -> Optional[Path]:
+    """
+    Encrypts the `target`'s filename and contents according to the data in
+    `builder`, writing the result to `crypted_dir` (as returned by
+    `builder.build_dir_path`). If the filename was already (en|de)crypted
+    (as `crypted_name`), it isn't (en|de)crypted again. The contents are
+    written to a partial file, which only takes the output file's name once
+    complete. Returns the output file, or `None` if an `OSError` occurred.
+    `OSError`'s are logged to the end user, but otherwise swallowed.
+    """
+    if crypted_name is None:
+        crypted_name = builder.build_file_name(original)
+    crypted_file = crypted_dir.joinpath(crypted_name)
 
     try:
-        create_path_and_file(crypted_file)
-        success = builder.write_crypted_contents(original, crypted_file)
+        partial = create_partial_file(crypted_file)
+        success = builder.write_crypted_contents(original, partial)
+        commit_partial_file(crypted_file, builder.durable)
         if not success:
-            malformed_file = label_malformed(crypted_file)
+            crypted_file = label_malformed(crypted_file)
             print("Decrypting '{}' contents failed. "\
                     "View '{}' at your own risk."\
-                    .format(original, malformed_file))
+                    .format(original, crypted_file))
 
         debug_print("{} -> {}".format(original, crypted_file))
+        return crypted_file
+
+    except OSError as e:
+        err_msg = "Error handling '{}'. Failed with '{}'".format(original, e)
+        print(err_msg)
+        return None
+
+def start_split_file(
+        builder: DirectoryBuilder,
+        original: Path,
+        crypted_name: Optional[str]=None
+    ) -> Optional[Tuple[Path, FileCryptor, List[Tuple[int, Optional[int]]]]]:
+    # pylint: disable=invalid-sequence-index
+    """
+    Creates the (partial) output file for `original` (named `crypted_name`,
+    if its name was already (en|de)crypted), and splits its chunks into
+    ranges of `[first, last)` chunk indices, to be handed to
+    `crypt_chunk_range`. The last range is left open (`[first, None)`), so
+    that it runs to the end of the file, however long it is by then. Framed
+    chunks can't be located by their index, so they're left in a single
+    `[0, None)` range. Returns the output file, its
+    `FileCryptor`, and the chunk ranges, or `None` if `original` can't be
+    split. `OSError`'s are logged to the end user, but otherwise swallowed.
+    """
+    crypted_file = builder.build_file_path(original) if crypted_name is None \
+                   else builder.build_dir_path(original).joinpath(crypted_name)
+
+    try:
+        partial = create_partial_file(crypted_file)
+        file_cryptor = builder.start_split_file(original, partial)
+        if file_cryptor is None:
+            finish_split_file(original, crypted_file, [False])
+            return None
+        if file_cryptor.framed_input:
+            return (crypted_file, file_cryptor, [(0, None)])
+
+        body_size = original.stat().st_size - file_cryptor.read_offset
+        num_chunks = -(-body_size // file_cryptor.read_len)
+        chunks_per_range = max(1, RANGE_SIZE // file_cryptor.read_len)
+        chunk_ranges = [(first, first + chunks_per_range)
+                        for first in range(0, num_chunks, chunks_per_range)]
+        chunk_ranges[-1] = (chunk_ranges[-1][0], None)
+        return (crypted_file, file_cryptor, chunk_ranges)
+
+    except OSError as e:
+        err_msg = "Error handling '{}'. Failed with '{}'".format(original, e)
+        print(err_msg)
+        return None
+
+def crypt_chunk_range(
+        builder: DirectoryBuilder,
+        original: Path,
+        target: Path,
+        file_cryptor: FileCryptor,
+        first: int,
+        last: Optional[int]
+    ) -> Optional[bool]:
+    """
+    Wrapper over `builder.write_crypted_range`, writing to the partial file
+    of `target`. Returns `False` on failed decryption. `OSError`'s are logged
+    to the end user, and `None` is returned.
+    """
+    try:
+        return builder.write_crypted_range(original, partial_path(target),
+                                           file_cryptor, first, last)
+
+    except OSError as e:
+        err_msg = "Error handling '{}'. Failed with '{}'".format(original, e)
+        print(err_msg)
+        return None
+
+def finish_split_file(
+        original: Path,
+        target: Path,
+        results: List[Optional[bool]],
+        durable: bool=False
+    ) -> Optional[Path]:
+    """
+    Renames the partial file of `target` to `target` (flushing it to disk
+    first, if `durable`), labeling it as malformed if any of its chunk ranges
+    failed to decrypt. Returns the output file,
+    like `crypt_path_and_contents`, or `None` if an `OSError` occurred in any
+    chunk range (leaving the partial file behind). `OSError`'s are logged to
+    the end user, but otherwise swallowed.
+    """
+    if None in results:
+        return None
+
+    try:
+        commit_partial_file(target, durable)
+        if False in results:
+            target = label_malformed(target)
+            print("Decrypting '{}' contents failed. "\
+                    "View '{}' at your own risk."\
+                    .format(original, target))
+
+        debug_print("{} -> {}".format(original, target))
+        return target
 
     except OSError as e:
         err_msg = "Error handling '{}'. Failed with '{}'".format(original, e)
         print(err_msg)
+        return None
 
 # -----------------------------------------------------------------------------
 
@@ -0,0 +1,220 @@
+"""
+scheduler
+
+Size aware, bounded submission of tasks to a worker pool. Tasks are collected
+in windows, along with the number of bytes they process, and each window is
+submitted largest first, so that no huge file is left to finish on a single
+worker at the end of a run. Small tasks are batched together, by their total
+size, so that they share the cost of a round trip to a worker. Only so many
+tasks are in flight at once, and results are handed out as soon as they're
+finished, so that the memory held by the parent stays flat, however many
+files there are. Workers count each finished call towards --progress, and the
+parent counts each added one towards its totals. Small runs may skip the pool
+(and importing multiprocessing) entirely, with an `InlinePool`.
+"""
+__all__ = ['Scheduler', 'InlinePool', 'run_batch', 'init_worker',
+           'BATCH_SIZE', 'TASK_COST', 'WINDOW_SIZE', 'IN_FLIGHT_PER_WORKER']
+
+from queue import SimpleQueue
+from typing import Any, Callable, List, Optional, Tuple
+
+from dircrypt.aux import set_quiet
+from dircrypt.progress import advance, enable_progress
+from dircrypt.stats import submit, enable_stats, enable_thread_stats
+
+# -----------------------------------------------------------------------------
+
+# Batches of small tasks are filled up to (about) this many bytes
+BATCH_SIZE = 2**22 # 4 MiB
+
+# The fixed cost of a task (opening, creating and naming files), in bytes, so
+# that batches of empty files stay bounded too
+TASK_COST = 2**12 # 4 KiB
+
+# Batches are capped to a fraction of each worker's share of a window, so that
+# small runs are still spread over every worker
+BATCHES_PER_WORKER = 4
+
+# Calls are collected (and sorted by size) in windows of this many calls
+WINDOW_SIZE = 2**14
+
+# Tasks (or batches) handed to the pool at once, by default, per worker
+IN_FLIGHT_PER_WORKER = 4
+
+# -----------------------------------------------------------------------------
+
+def run_batch(calls: List[Tuple[Callable, Tuple, int, int]]) -> List[Any]:
+    """
+    Runs every `func(*args)` in `calls`, returning their results in order.
+    Each call's number of bytes and files are counted as done as it finishes.
+    """
+    results = []
+    for (func, args, num_bytes, num_files) in calls:
+        results.append(func(*args))
+        advance(num_bytes, num_files)
+    return results
+
+def init_worker(thread: bool, stats: bool, quiet: bool,
+                progress: Optional[Tuple]) -> None:
+    """
+    Pool initializer, carrying --stats, --quiet and --progress (given the
+    `worker_args` of a `Progress`) over to each worker, be it a process, or a
+    thread (if `thread`).
+    """
+    if thread:
+        enable_thread_stats()
+    elif stats:
+        enable_stats()
+    set_quiet(quiet)
+    if progress is not None:
+        enable_progress(*progress)
+
+class InlinePool(object):
+    """
+    A stand in for a pool, running each task in the calling thread, as soon as
+    it's submitted, for runs too small to pay for starting a pool. Supports
+    the parts of the `multiprocessing.pool.Pool` interface dircrypt uses.
+    """
+
+    def __init__(self, initializer: Optional[Callable]=None,
+                 initargs: Tuple=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self) -> 'InlinePool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def apply_async(
+            self,
+            func: Callable,
+            args: Tuple=(),
+            callback: Optional[Callable[[Any], None]]=None,
+            error_callback: Optional[Callable[[BaseException], None]]=None
+        ) -> '_InlineResult':
+        """Calls `func(*args)`, then `callback` (or `error_callback`)"""
+        try:
+            result = _InlineResult(func(*args), None)
+        except Exception as e: # pylint: disable=broad-except
+            result = _InlineResult(None, e)
+            if error_callback is not None:
+                error_callback(e)
+            return result
+        if callback is not None:
+            callback(result.get())
+        return result
+
+class _InlineResult(object):
+    """The result of an `InlinePool` task, or the exception it raised"""
+
+    def __init__(self, value: Any, error: Optional[Exception]):
+        self._value = value
+        self._error = error
+
+    def get(self) -> Any:
+        """The result of the task. Raises the exception it raised, if any"""
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class Scheduler(object):
+    """
+    Collects calls with `add`, and submits them to a pool, a window at a time.
+    Each call's result is handed to its `on_done` callback, in the thread
+    calling `add` (or `finish`), as soon as it's finished. `finish` submits
+    the remaining calls, and waits for all of them.
+    """
+
+    def __init__(self, pool, workers: int, max_in_flight: Optional[int]=None,
+                 progress=None):
+        """
+        At most `max_in_flight` tasks (by default, `IN_FLIGHT_PER_WORKER` per
+        worker) are submitted to `pool`, of `workers` workers, at once. Added
+        calls are counted towards the totals of `progress`, if given.
+        """
+        assert(max_in_flight is None or max_in_flight > 0)
+        self._pool = pool
+        self._workers = workers
+        self._max_in_flight = IN_FLIGHT_PER_WORKER * workers \
+                              if max_in_flight is None else max_in_flight
+        self._progress = progress
+        self._calls = [] # List[Tuple[int, Callable, Tuple, int, Callable]]
+        self._in_flight = {} # Dict[int, Tuple[AsyncResult, List[Callable]]]
+        self._finished = SimpleQueue() # ids of finished tasks
+        self._num_tasks = 0
+
+    def add(self, func: Callable, args: Tuple, size: int,
+            on_done: Callable[[Any], None], num_files: int=1) -> None:
+        """
+        Adds the call `func(*args)`, which processes `size` bytes (and
+        finishes `num_files` files), and whose result is handed to `on_done`.
+        Blocks (handing out finished results) while too many tasks are in
+        flight.
+        """
+        if self._progress is not None:
+            self._progress.found(size, num_files)
+        self._calls.append((size + TASK_COST, func, args, num_files, on_done))
+        if len(self._calls) >= WINDOW_SIZE:
+            self._submit_window()
+
+    def finish(self) -> None:
+        """Submits every remaining call, and hands out every result"""
+        if self._progress is not None:
+            self._progress.found_all()
+        self._submit_window()
+        while len(self._in_flight) > 0:
+            self._collect()
+
+    def _submit_window(self) -> None:
+        """
+        Submits the collected calls, largest first. Calls smaller than a
+        batch are batched with the calls following them.
+        """
+        total_size = sum(call[0] for call in self._calls)
+        batch_size = min(BATCH_SIZE,
+                         total_size // (BATCHES_PER_WORKER * self._workers))
+        self._calls.sort(key=lambda call: call[0], reverse=True)
+
+        (batch, filled) = ([], 0)
+        for call in self._calls:
+            batch.append(call)
+            filled += call[0]
+            if filled >= batch_size:
+                self._submit_batch(batch)
+                (batch, filled) = ([], 0)
+        if len(batch) > 0:
+            self._submit_batch(batch)
+        self._calls = []
+
+    def _submit_batch(self, batch: List[Tuple]) -> None:
+        """
+        Submits the given calls as a single task, once there's room for it
+        """
+        while len(self._in_flight) >= self._max_in_flight:
+            self._collect()
+
+        task_id = self._num_tasks
+        self._num_tasks += 1
+        calls = [(func, args, size - TASK_COST, num_files)
+                 for (size, func, args, num_files, _) in batch]
+        task = submit(self._pool, run_batch, (calls,),
+                      callback=lambda _: self._finished.put(task_id))
+        self._in_flight[task_id] = (task,
+                                    [on_done for (*_, on_done) in batch])
+
+    def _collect(self) -> None:
+        """
+        Waits for any task in flight to finish, and hands out its results.
+        Exceptions raised by the task are raised here.
+        """
+        task_id = self._finished.get()
+        (task, callbacks) = self._in_flight.pop(task_id)
+        for (on_done, result) in zip(callbacks, task.get()):
+            on_done(result)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
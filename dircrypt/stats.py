@@ -0,0 +1,225 @@
+"""
+stats
+
+Cheap, per process timing and byte counters for dircrypt's phases (key
+derivation, name and chunk (en|de)cryption, file io, directory creation).
+Workers send their counters back along with the results of their tasks, to be
+merged into the parent's. While disabled, recording is a no-op.
+"""
+__all__ = ['Stats', 'PhaseStats', 'current_stats', 'enable_stats',
+           'enable_thread_stats', 'stats_enabled', 'take_stats', 'submit']
+
+import threading
+from time import perf_counter_ns
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# -----------------------------------------------------------------------------
+
+# Durations are bucketed by their (nanosecond) bit length, i.e. by power of 2
+NUM_BUCKETS = 64
+PERCENTILES = (50, 90, 99)
+
+# -----------------------------------------------------------------------------
+
+class PhaseStats(object):
+    """
+    The number of events in a phase, their total duration and size, and a
+    histogram of their durations, from which percentiles are estimated.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.num_bytes = 0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, duration_ns: int, num_bytes: int) -> None:
+        """Records a single event"""
+        self.count += 1
+        self.total_ns += duration_ns
+        self.max_ns = max(self.max_ns, duration_ns)
+        self.num_bytes += num_bytes
+        self.buckets[min(duration_ns.bit_length(), NUM_BUCKETS - 1)] += 1
+
+    def merge(self, other: "PhaseStats") -> None:
+        """Adds the events of `other`"""
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.num_bytes += other.num_bytes
+        self.buckets = [mine + theirs for (mine, theirs)
+                        in zip(self.buckets, other.buckets)]
+
+    def percentile_ns(self, percentile: float) -> int:
+        """
+        An upper bound on the given percentile of event durations, accurate to
+        within a factor of 2.
+        """
+        threshold = self.count * percentile / 100
+        seen = 0
+        for (bit_length, num_events) in enumerate(self.buckets):
+            seen += num_events
+            if seen >= threshold:
+                return min(2**bit_length, self.max_ns)
+        return self.max_ns
+
+    def to_dict(self) -> Dict[str, Any]:
+        """A JSON serializable summary, with durations in seconds"""
+        summary = {"count": self.count,
+                   "total_s": self.total_ns / 10**9,
+                   "bytes": self.num_bytes,
+                   "max_s": self.max_ns / 10**9}
+        for percentile in PERCENTILES:
+            summary["p{}_s".format(percentile)] = \
+                self.percentile_ns(percentile) / 10**9
+        return summary
+
+class Stats(object):
+    """
+    Counters for every phase, in a single process. Events are timed between
+    the value of `clock()` they start at, and the call to `record` that ends
+    them.
+    """
+
+    def __init__(self):
+        self.phases = {} # Dict[str, PhaseStats]
+
+    @staticmethod
+    def clock() -> int:
+        """The current time, in nanoseconds"""
+        return perf_counter_ns()
+
+    def record(self, phase: str, start: int, num_bytes: int=0) -> int:
+        """
+        Records an event of `phase`, which began at `start`, and processed
+        `num_bytes`. Returns the current time, so that consecutive events can
+        be chained.
+        """
+        now = perf_counter_ns()
+        phase_stats = self.phases.get(phase, None)
+        if phase_stats is None:
+            phase_stats = self.phases[phase] = PhaseStats()
+        phase_stats.add(now - start, num_bytes)
+        return now
+
+    def merge(self, other: "Stats") -> None:
+        """Adds the events of `other`"""
+        for (phase, phase_stats) in other.phases.items():
+            self.phases.setdefault(phase, PhaseStats()).merge(phase_stats)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """A JSON serializable summary of every phase"""
+        return {phase: phase_stats.to_dict()
+                for (phase, phase_stats) in sorted(self.phases.items())}
+
+class _DisabledStats(Stats):
+    """Drops every event, without reading the clock"""
+
+    @staticmethod
+    def clock() -> int:
+        return 0
+
+    def record(self, phase: str, start: int, num_bytes: int=0) -> int:
+        return 0
+
+_STATS: Stats = _DisabledStats()
+
+# Worker threads record into their own counters, rather than contending over
+# (and racing on) the process' counters, which are merged by `take_stats`
+_LOCAL = threading.local()
+_THREAD_STATS: List[Stats] = []
+
+# -----------------------------------------------------------------------------
+
+def current_stats() -> Stats:
+    """
+    This process' (or worker thread's) counters, which drop every event unless
+    enabled
+    """
+    return getattr(_LOCAL, "stats", _STATS)
+
+def enable_stats() -> None:
+    """
+    Starts recording events in this process, from scratch (e.g. as a pool
+    initializer, so that forked workers don't inherit the parent's counters).
+    """
+    global _STATS # pylint: disable=global-statement
+    _STATS = Stats()
+
+def enable_thread_stats() -> None:
+    """
+    Gives the calling (worker) thread its own counters, if recording is
+    enabled in this process. Meant as a thread pool initializer.
+    """
+    if stats_enabled():
+        _LOCAL.stats = Stats()
+        _THREAD_STATS.append(_LOCAL.stats)
+
+def stats_enabled() -> bool:
+    """Whether events are being recorded in this process"""
+    return not isinstance(_STATS, _DisabledStats)
+
+def take_stats() -> Optional[Stats]:
+    """
+    Returns this process' counters (including those of its worker threads),
+    resetting them, or `None` if recording isn't enabled. Worker threads
+    mustn't be running.
+    """
+    global _STATS # pylint: disable=global-statement
+    if not stats_enabled():
+        return None
+    (stats, _STATS) = (_STATS, Stats())
+    for thread_stats in _THREAD_STATS:
+        stats.merge(thread_stats)
+    _THREAD_STATS.clear()
+    return stats
+
+def submit(pool, func: Callable, args: Tuple,
+           callback: Optional[Callable[[Any], None]]=None) -> Any:
+    """
+    `pool.apply_async(func, args)`. While recording is enabled, the worker
+    process' counters are sent back along with the result, and merged into
+    this process' counters when the result is fetched. Thread pools (and
+    `InlinePool`s) already share this process' counters. `callback` is
+    called (from one of the pool's threads) once the task finishes, or
+    fails, so it should only signal that the result is ready to be fetched.
+    """
+    if not stats_enabled() or not _is_process_pool(pool):
+        return pool.apply_async(func=func, args=args, callback=callback,
+                                error_callback=callback)
+    return _StatsResult(pool.apply_async(func=_call_with_stats,
+                                         args=(func, args),
+                                         callback=callback,
+                                         error_callback=callback))
+
+def _is_process_pool(pool) -> bool:
+    """Whether `pool` runs its tasks in other processes"""
+    # imported here, so that runs without a pool never import multiprocessing
+    from multiprocessing.pool import Pool, ThreadPool
+    return isinstance(pool, Pool) and not isinstance(pool, ThreadPool)
+
+def _call_with_stats(func: Callable, args: Tuple) -> Tuple[Any, Stats]:
+    """Calls `func`, returning its result along with the recorded counters"""
+    result = func(*args)
+    return (result, take_stats())
+
+class _StatsResult(object):
+    """An `AsyncResult` of `_call_with_stats`, which merges its counters"""
+
+    def __init__(self, async_result):
+        self._async_result = async_result
+        self._merged = False
+
+    def get(self) -> Any:
+        """The result of the task"""
+        (result, stats) = self._async_result.get()
+        if stats is not None and not self._merged:
+            _STATS.merge(stats)
+            self._merged = True
+        return result
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
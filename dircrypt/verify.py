@@ -0,0 +1,241 @@
+"""
+verify
+
+Authentication of encrypted trees (and packed archives) without writing any
+plaintext. Every name and chunk is decrypted, and the result thrown away.
+Unlike decryption, verification carries on past bad chunks, so that all of
+them are reported.
+"""
+__all__ = ['NullWriter', 'FileReport', 'verify_chunks', 'verify_file',
+           'verify_record', 'Summary']
+
+import io
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+from dircrypt.aux import debug_print
+from dircrypt.archive import FileWindow, is_record_of
+from dircrypt.chunkstore import ChunkStore
+from dircrypt.cryptor import (Decryptor, FileCryptor, ChunkStoreCryptor,
+                              REF_SIZE)
+from dircrypt.routines import read_chunks
+from dircrypt.stats import current_stats
+
+# -----------------------------------------------------------------------------
+
+class NullWriter(io.RawIOBase):
+    """Discards everything written to it"""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return len(data)
+
+class FileReport(NamedTuple):
+    """
+    The outcome of verifying a single file (or archive record). `error` says
+    why verification stopped early (e.g. a malformed header), if it did.
+    """
+    path: str
+    num_bytes: int
+    num_chunks: int
+    name_ok: bool
+    bad_chunks: List[int]
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        """Whether the name and every chunk authenticated"""
+        return self.name_ok and not self.bad_chunks and self.error is None
+
+# -----------------------------------------------------------------------------
+
+def verify_chunks(
+        file_cryptor: FileCryptor,
+        orig: BinaryIO,
+        chunk_store: Optional[ChunkStore]=None
+    ) -> Tuple[int, List[int], Optional[str]]:
+    # pylint: disable=invalid-sequence-index
+    """
+    Decrypts every chunk of `orig`, from its current position, discarding the
+    plaintext. Returns the number of chunks, the indices of those that failed
+    to authenticate (or, for deduplicated files, that refer to missing or
+    malformed chunks in `chunk_store`), and why verification stopped early,
+    if it did. Files that mark their final chunk are checked to end with it,
+    so that a file cut short (even at a chunk boundary) is reported as
+    truncated.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    assert(not file_cryptor.encrypting)
+    store_cryptor = file_cryptor.store_cryptor
+    if store_cryptor is not None and chunk_store is None:
+        return (0, [], "no chunk store found")
+
+    out_view = memoryview(bytearray(file_cryptor.write_len))
+    stats = current_stats()
+    (num_chunks, bad_chunks) = (0, [])
+
+    for (index, chunk, final) in read_chunks(file_cryptor, orig):
+        if chunk is None:
+            return (index, bad_chunks,
+                    "malformed frame at chunk {}".format(index))
+        clock = stats.clock()
+        num_crypted = file_cryptor.crypt_chunk_into(index, chunk, out_view,
+                                                    final)
+        stats.record("crypt", clock, len(chunk))
+        if num_crypted is None and final and \
+           _is_cut_short(file_cryptor, index, chunk, out_view):
+            num_chunks = index + int(len(chunk) > 0)
+            return (num_chunks, bad_chunks,
+                    "truncated after {} chunks".format(num_chunks))
+        num_chunks = index + 1
+
+        if num_crypted is None or \
+           (store_cryptor is not None and
+            not _verify_refs(chunk_store, store_cryptor,
+                             out_view[:num_crypted])):
+            bad_chunks.append(index)
+
+    return (num_chunks, bad_chunks, None)
+
+def _is_cut_short(file_cryptor: FileCryptor, index: int, chunk: memoryview,
+                  out_view: memoryview) -> bool:
+    """
+    Whether the last chunk read, `chunk`, failed to authenticate as the final
+    chunk because the file was cut short, i.e. the file has no chunks at
+    all, or `chunk` authenticates as one from the middle of the file.
+    """
+    if not file_cryptor.marks_final:
+        return False
+    return len(chunk) == 0 or \
+           file_cryptor.crypt_chunk_into(index, chunk, out_view) is not None
+
+def _verify_refs(chunk_store: ChunkStore, store_cryptor: ChunkStoreCryptor,
+                 refs: memoryview) -> bool:
+    """
+    Whether every chunk referred to in `refs` is in `chunk_store`, and
+    authenticates.
+
+    Raises:
+        `OSError`: if file io goes wrong.
+    """
+    if len(refs) % REF_SIZE != 0:
+        return False
+    return all(chunk_store.get(store_cryptor,
+                               bytes(refs[start:start + REF_SIZE])) is not None
+               for start in range(0, len(refs), REF_SIZE))
+
+def verify_file(
+        mode: Decryptor,
+        crypted_file: Path,
+        path: str,
+        chunk_store: Optional[ChunkStore]=None
+    ) -> FileReport:
+    """
+    Verifies the name and contents of `crypted_file`, reported under `path`.
+    `OSError`'s are reported as errors, but otherwise swallowed.
+    """
+    stats = current_stats()
+    start = stats.clock()
+    name_ok = mode.crypt_path_name(crypted_file.name) is not None
+    stats.record("names", start)
+    (num_bytes, num_chunks, bad_chunks, error) = (0, 0, [], None)
+    try:
+        with crypted_file.open(mode="rb") as orig:
+            file_cryptor = mode.start_file(orig, NullWriter())
+            if file_cryptor is None:
+                error = "malformed header"
+            else:
+                (num_chunks, bad_chunks, error) = \
+                    verify_chunks(file_cryptor, orig, chunk_store)
+            num_bytes = orig.tell()
+    except OSError as e:
+        error = str(e)
+
+    debug_print("verified {}".format(crypted_file))
+    return FileReport(path, num_bytes, num_chunks, name_ok, bad_chunks, error)
+
+def verify_record(
+        mode: Decryptor,
+        archive: Path,
+        source: str,
+        offset: int,
+        length: int,
+        file_salt: bytes
+    ) -> FileReport:
+    """
+    Verifies the record of `source`, at `offset` in `archive`, against the
+    `file_salt` of its index entry. Its name is authenticated along with the
+    archive's index. `OSError`'s are reported as errors, but otherwise
+    swallowed.
+    """
+    (num_chunks, bad_chunks, error) = (0, [], None)
+    try:
+        with archive.open(mode="rb") as arch:
+            window = FileWindow(arch, offset, length)
+            if not is_record_of(window, file_salt):
+                error = "record doesn't match the index"
+            else:
+                file_cryptor = mode.start_file(window, NullWriter())
+                if file_cryptor is None:
+                    error = "malformed header"
+                else:
+                    (num_chunks, bad_chunks, error) = \
+                        verify_chunks(file_cryptor, window)
+    except OSError as e:
+        error = str(e)
+
+    debug_print("verified {}@{}".format(archive, offset))
+    return FileReport(source, length, num_chunks, True, bad_chunks, error)
+
+class Summary(object):
+    """
+    Running totals of the files (and archive records) verified so far. Only
+    the reports of those that failed are kept, so that a summary stays small
+    however large the verified tree is.
+    """
+
+    def __init__(self):
+        self.num_files = 0
+        self.num_bytes = 0
+        self.num_chunks = 0
+        self.failures = [] # List[FileReport]
+
+    def add(self, report: FileReport) -> None:
+        """Adds the outcome of verifying a single file"""
+        self.num_files += 1
+        self.num_bytes += report.num_bytes
+        self.num_chunks += report.num_chunks
+        if not report.ok:
+            self.failures.append(report)
+
+    def report(self, target: Path, num_dirs: int,
+               malformed_dirs: List[str]) -> Dict[str, Any]:
+        """
+        The JSON serializable report of verifying `target`: totals, malformed
+        names, and every file with bad chunks (or that couldn't be verified).
+        """
+        malformed_names = malformed_dirs + [report.path
+                                            for report in self.failures
+                                            if not report.name_ok]
+        bad_files = [{"path": report.path,
+                      "bad_chunks": report.bad_chunks,
+                      "error": report.error}
+                     for report in self.failures
+                     if report.bad_chunks or report.error is not None]
+        return {"target": str(target),
+                "ok": not (malformed_names or bad_files),
+                "files": self.num_files,
+                "directories": num_dirs,
+                "bytes": self.num_bytes,
+                "chunks": self.num_chunks,
+                "malformed_names": sorted(malformed_names),
+                "bad_files": sorted(bad_files, key=lambda bad: bad["path"])}
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    raise Exception("Unimplemented")
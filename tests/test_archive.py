@@ -0,0 +1,122 @@
+"""
+Round trips of packed archives, and tampering with (and swapping) their
+records.
+"""
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt.archive import (ARCHIVE_TRAILER, start_archive, record_size,
+                              pack_file, finish_archive, read_archive_index,
+                              unpack_file)
+from dircrypt.cryptor import Encryptor
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.verify import verify_record
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+@pytest.fixture
+def mode(psw_file) -> Encryptor:
+    return Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+
+def pack(mode: Encryptor, tmp_path: Path, files):
+    """
+    Packs `files` (plaintext, by source path) into an archive, returning it,
+    and its index.
+    """
+    archive = tmp_path.joinpath("test.dca")
+    offset = start_archive(archive)
+    index = {}
+    for (source, plaintext) in files.items():
+        original = tmp_path.joinpath(source.replace("/", "_"))
+        original.write_bytes(plaintext)
+        file_salt = pack_file(mode, original, archive, offset, len(plaintext))
+        assert file_salt is not None
+        length = record_size(mode.file_cryptor(mode.new_file_header()),
+                             len(plaintext))
+        index[source] = (offset, length, file_salt)
+        offset += length
+    finish_archive(archive, offset, index, mode)
+    return (archive, index)
+
+def unpack(mode: Encryptor, archive: Path, output_dir: Path):
+    """
+    Unpacks every record of `archive` to `output_dir`, returning the
+    plaintext of those that decrypted, by source path.
+    """
+    decryptor = mode.decryptor()
+    index = read_archive_index(archive, decryptor)
+    assert index is not None
+    unpacked = {}
+    for (source, (offset, length, file_salt)) in index.items():
+        path = unpack_file(decryptor, archive, source, offset, length,
+                           file_salt, output_dir)
+        if path is not None and path.name == source.split("/")[-1]:
+            unpacked[source] = path.read_bytes()
+    return unpacked
+
+def swap_records(archive: Path, first, second) -> None:
+    """Swaps the records at `first` and `second`, of the same length"""
+    ((first_offset, length, _), (second_offset, second_len, _)) = \
+        (first, second)
+    assert length == second_len
+    data = bytearray(archive.read_bytes())
+    (data[first_offset:first_offset + length],
+     data[second_offset:second_offset + length]) = \
+        (data[second_offset:second_offset + length],
+         data[first_offset:first_offset + length])
+    archive.write_bytes(bytes(data))
+
+# -----------------------------------------------------------------------------
+
+def test_round_trip(tmp_path, mode):
+    files = {"src/a": os.urandom(3 * CHUNK_SIZE + 7),
+             "src/d/b": b"",
+             "src/d/c": os.urandom(10)}
+    (archive, _) = pack(mode, tmp_path, files)
+    assert unpack(mode, archive, tmp_path.joinpath("out")) == files
+
+def test_tampered_record_fails(tmp_path, mode):
+    files = {"src/a": os.urandom(3 * CHUNK_SIZE), "src/b": os.urandom(10)}
+    (archive, index) = pack(mode, tmp_path, files)
+    (offset, length, file_salt) = index["src/a"]
+    data = bytearray(archive.read_bytes())
+    data[offset + length - 1] ^= 0x01
+    archive.write_bytes(bytes(data))
+
+    assert unpack(mode, archive, tmp_path.joinpath("out")) == \
+           {"src/b": files["src/b"]}
+    report = verify_record(mode.decryptor(), archive, "src/a", offset,
+                           length, file_salt)
+    assert report.bad_chunks == [2]
+
+def test_swapped_records_fail(tmp_path, mode):
+    files = {"src/a": os.urandom(CHUNK_SIZE), "src/b": os.urandom(CHUNK_SIZE),
+             "src/c": os.urandom(10)}
+    (archive, index) = pack(mode, tmp_path, files)
+    swap_records(archive, index["src/a"], index["src/b"])
+
+    assert unpack(mode, archive, tmp_path.joinpath("out")) == \
+           {"src/c": files["src/c"]}
+    for source in ("src/a", "src/b"):
+        report = verify_record(mode.decryptor(), archive, source,
+                               *index[source])
+        assert report.error == "record doesn't match the index"
+
+def test_tampered_index_fails(tmp_path, mode):
+    (archive, _) = pack(mode, tmp_path, {"src/a": os.urandom(10)})
+    data = bytearray(archive.read_bytes())
+    data[-ARCHIVE_TRAILER.size - 1] ^= 0x01 # in the index
+    archive.write_bytes(bytes(data))
+    assert read_archive_index(archive, mode.decryptor()) is None
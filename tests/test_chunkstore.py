@@ -0,0 +1,123 @@
+"""
+Round trips of deduplicated files, and tampering with (and swapping) the
+chunks they refer to in the chunk store.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt.chunkstore import (ChunkStore, ChunkRefReader, ChunkRefWriter,
+                                 CHUNK_STORE_NAME)
+from dircrypt.cryptor import Encryptor, REF_SIZE, TAG_SIZE
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.routines import crypt_chunks
+from dircrypt.verify import verify_file
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+@pytest.fixture
+def mode(psw_file) -> Encryptor:
+    return Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, dedup=True,
+                     kdf=TEST_KDF)
+
+@pytest.fixture
+def store(tmp_path) -> ChunkStore:
+    return ChunkStore(tmp_path.joinpath(CHUNK_STORE_NAME))
+
+def encrypt_file(mode: Encryptor, store: ChunkStore, path: Path,
+                 plaintext: bytes) -> None:
+    """Encrypts `plaintext` to `path`, storing its chunks in `store`"""
+    contents = io.BytesIO(plaintext)
+    with path.open(mode="wb") as crypted:
+        file_cryptor = mode.start_file(contents, crypted)
+        refs = ChunkRefReader(contents, store, file_cryptor.store_cryptor,
+                              file_cryptor.read_len)
+        assert crypt_chunks(file_cryptor, io.BufferedReader(refs), crypted)
+
+def decrypt_file(mode: Encryptor, store: ChunkStore, path: Path):
+    """The plaintext of `path`, or `None` if it fails to decrypt"""
+    (decryptor, contents) = (mode.decryptor(), io.BytesIO())
+    with path.open(mode="rb") as crypted:
+        file_cryptor = decryptor.start_file(crypted, contents)
+        refs = ChunkRefWriter(contents, store, file_cryptor.store_cryptor)
+        if not crypt_chunks(file_cryptor, crypted, refs) or not refs.ok:
+            return None
+    return contents.getvalue()
+
+def crypted_path(mode: Encryptor, directory: Path) -> Path:
+    """Where to encrypt a file to in `directory`, under an encrypted name"""
+    return directory.joinpath(mode.crypt_path_name("f"))
+
+def stored_chunks(store_root: Path):
+    """Every chunk file in the chunk store at `store_root`"""
+    return sorted(path for path in store_root.rglob("*") if path.is_file())
+
+# -----------------------------------------------------------------------------
+
+def test_round_trip(tmp_path, mode, store):
+    chunk = os.urandom(CHUNK_SIZE)
+    plaintext = chunk + os.urandom(CHUNK_SIZE) + chunk + b"tail"
+    path = crypted_path(mode, tmp_path)
+    encrypt_file(mode, store, path, plaintext)
+
+    assert len(stored_chunks(tmp_path.joinpath(CHUNK_STORE_NAME))) == 3
+    assert decrypt_file(mode, store, path) == plaintext
+    assert verify_file(mode.decryptor(), path, "f", store).ok
+
+def test_tampered_chunk_fails(tmp_path, mode, store):
+    path = crypted_path(mode, tmp_path)
+    encrypt_file(mode, store, path, os.urandom(2 * CHUNK_SIZE))
+    chunk_file = stored_chunks(tmp_path.joinpath(CHUNK_STORE_NAME))[0]
+    data = bytearray(chunk_file.read_bytes())
+    data[0] ^= 0x01
+    chunk_file.write_bytes(bytes(data))
+
+    assert decrypt_file(mode, store, path) is None
+    report = verify_file(mode.decryptor(), path, "f", store)
+    assert report.bad_chunks == [0]
+
+def test_swapped_chunks_fail(tmp_path, mode, store):
+    path = crypted_path(mode, tmp_path)
+    encrypt_file(mode, store, path, os.urandom(2 * CHUNK_SIZE))
+    (first, second) = stored_chunks(tmp_path.joinpath(CHUNK_STORE_NAME))
+    (first_data, second_data) = (first.read_bytes(), second.read_bytes())
+    first.write_bytes(second_data)
+    second.write_bytes(first_data)
+
+    assert decrypt_file(mode, store, path) is None
+    assert not verify_file(mode.decryptor(), path, "f", store).ok
+
+def test_missing_chunk_fails(tmp_path, mode, store):
+    path = crypted_path(mode, tmp_path)
+    encrypt_file(mode, store, path, os.urandom(2 * CHUNK_SIZE))
+    stored_chunks(tmp_path.joinpath(CHUNK_STORE_NAME))[0].unlink()
+
+    assert decrypt_file(mode, store, path) is None
+    assert not verify_file(mode.decryptor(), path, "f", store).ok
+
+def test_reordered_refs_fail(tmp_path, mode, store):
+    # each (encrypted) chunk of the file holds `CHUNK_SIZE // REF_SIZE` refs,
+    # so swapping two refs in place means tampering with the file's chunk
+    path = crypted_path(mode, tmp_path)
+    encrypt_file(mode, store, path, os.urandom(2 * CHUNK_SIZE))
+    data = bytearray(path.read_bytes())
+    (first, second) = (len(data) - TAG_SIZE - 2 * REF_SIZE,
+                       len(data) - TAG_SIZE - REF_SIZE)
+    (data[first:second], data[second:second + REF_SIZE]) = \
+        (data[second:second + REF_SIZE], data[first:second])
+    path.write_bytes(bytes(data))
+
+    assert decrypt_file(mode, store, path) is None
+    assert not verify_file(mode.decryptor(), path, "f", store).ok
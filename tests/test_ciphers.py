@@ -0,0 +1,87 @@
+"""
+The cipher registry, the pick of `--cipher auto`, and round trips of files
+under every cipher.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt import ciphers
+from dircrypt.ciphers import (CIPHERS, CHACHA20_POLY1305, AES_256_GCM,
+                              AUTO_CIPHER, parse_cipher, choose_cipher,
+                              has_aes_instructions)
+from dircrypt.cryptor import Encryptor, FILE_HEADER_SIZE, unpack_file_header
+from dircrypt.kdf import KdfSpec, PBKDF2, KDF_SPEC
+from dircrypt.routines import crypt_chunks
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+def encrypt(mode: Encryptor, plaintext: bytes) -> bytes:
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    assert crypt_chunks(mode.start_file(contents, crypted), contents, crypted)
+    return crypted.getvalue()
+
+def decrypt(mode: Encryptor, data: bytes):
+    """The plaintext of `data`, or `None` if it fails to decrypt"""
+    (crypted, contents) = (io.BytesIO(data), io.BytesIO())
+    file_cryptor = mode.decryptor().start_file(crypted, contents)
+    if not crypt_chunks(file_cryptor, crypted, contents):
+        return None
+    return contents.getvalue()
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("cipher", sorted(CIPHERS))
+def test_file_round_trip(psw_file, cipher):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, cipher=cipher,
+                     kdf=TEST_KDF)
+    plaintext = os.urandom(3 * CHUNK_SIZE + 7)
+    data = encrypt(mode, plaintext)
+    assert unpack_file_header(data[:FILE_HEADER_SIZE]).cipher == cipher
+    assert decrypt(mode, data) == plaintext
+
+def test_cipher_id_is_authenticated(psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE,
+                     cipher=AES_256_GCM, kdf=TEST_KDF)
+    data = bytearray(encrypt(mode, os.urandom(CHUNK_SIZE)))
+    header = unpack_file_header(bytes(data[:FILE_HEADER_SIZE]))
+    cipher_offset = FILE_HEADER_SIZE - KDF_SPEC.size - 1
+    assert data[cipher_offset] == header.cipher
+    data[cipher_offset] = CHACHA20_POLY1305
+    assert decrypt(mode, bytes(data)) is None
+
+def test_parse_cipher():
+    assert parse_cipher("chacha20-poly1305") == CHACHA20_POLY1305
+    assert parse_cipher("aes-256-gcm") == AES_256_GCM
+    assert parse_cipher(AUTO_CIPHER) in CIPHERS
+    assert parse_cipher("rot13") is None
+
+@pytest.mark.parametrize(("flags", "expected"), [
+    ("fpu aes pclmulqdq sse2", True),
+    ("fp asimd aes pmull", True),
+    ("fpu sse2", False),
+])
+def test_has_aes_instructions(tmp_path, monkeypatch, flags, expected):
+    cpuinfo = tmp_path.joinpath("cpuinfo")
+    cpuinfo.write_text("processor\t: 0\nflags\t\t: {}\n".format(flags))
+    monkeypatch.setattr(ciphers, "CPUINFO", cpuinfo)
+    assert has_aes_instructions() is expected
+    assert choose_cipher() == (AES_256_GCM if expected
+                               else CHACHA20_POLY1305)
+
+def test_unreadable_cpuinfo_times_the_ciphers(tmp_path, monkeypatch):
+    monkeypatch.setattr(ciphers, "CPUINFO", tmp_path.joinpath("missing"))
+    assert has_aes_instructions() is None
+    assert choose_cipher() in CIPHERS
@@ -0,0 +1,76 @@
+"""
+Compression of chunks before they're encrypted, and round trips of
+compressed files.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt.compression import (compress_chunk, decompress_chunk, CODECS,
+                                  CODEC_RAW)
+from dircrypt.cryptor import Encryptor
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.routines import crypt_chunks
+
+CHUNK_SIZE = 2**14
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+def round_trip(mode: Encryptor, plaintext: bytes):
+    """
+    The encrypted length of `plaintext`, and what it decrypts back to (or
+    `None`)
+    """
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    assert crypt_chunks(mode.start_file(contents, crypted), contents, crypted)
+    crypted.seek(0)
+    restored = io.BytesIO()
+    file_cryptor = mode.decryptor().start_file(crypted, restored)
+    if not crypt_chunks(file_cryptor, crypted, restored):
+        return (len(crypted.getvalue()), None)
+    return (len(crypted.getvalue()), restored.getvalue())
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("codec", sorted(CODECS.values()))
+def test_chunk_round_trip(codec):
+    chunk = b"compressible " * 1000
+    compressed = compress_chunk(codec, chunk)
+    assert compressed[0] == codec
+    assert len(compressed) < len(chunk)
+    assert decompress_chunk(compressed, len(chunk)) == chunk
+
+@pytest.mark.parametrize("codec", sorted(CODECS.values()))
+def test_incompressible_chunk_is_stored_raw(codec):
+    chunk = os.urandom(CHUNK_SIZE)
+    compressed = compress_chunk(codec, chunk)
+    assert compressed == bytes([CODEC_RAW]) + chunk
+    assert decompress_chunk(compressed, len(chunk)) == chunk
+
+@pytest.mark.parametrize("codec", sorted(CODECS.values()))
+def test_oversized_chunk_is_rejected(codec):
+    chunk = bytes(CHUNK_SIZE)
+    assert decompress_chunk(compress_chunk(codec, chunk),
+                            CHUNK_SIZE - 1) is None
+
+@pytest.mark.parametrize("data", [b"", b"\x09abc", b"\x01not zlib"])
+def test_malformed_chunk_is_rejected(data):
+    assert decompress_chunk(data, CHUNK_SIZE) is None
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_file_round_trip(psw_file, codec):
+    mode = Encryptor(psw_file=psw_file, codec=CODECS[codec], kdf=TEST_KDF)
+    plaintext = bytes(3 * CHUNK_SIZE) + os.urandom(CHUNK_SIZE) + b"tail"
+    (crypted_len, restored) = round_trip(mode, plaintext)
+    assert restored == plaintext
+    assert crypted_len < len(plaintext)
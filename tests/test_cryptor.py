@@ -0,0 +1,151 @@
+"""
+Round trips of both file (and name) format versions: v2, and v1, in a tree
+encrypted by dircrypt 1.0. Tampering with, truncating and reordering chunks
+and names.
+"""
+import io
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from pathlib import Path
+
+import pytest
+
+from dircrypt.cryptor import (Encryptor, Decryptor, FileHeader, SALT_SIZE,
+                              TAG_SIZE, FILE_HEADER_SIZE, FILE_MAGIC,
+                              pack_file_header, unpack_file_header)
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.routines import crypt_chunks
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+PASSWORD = b"correct horse battery staple"
+
+# encrypted by dircrypt 1.0, from `plain`, as laid out by `v1_plaintext`
+V1_FIXTURE = Path(__file__).parent.joinpath("fixtures", "v1")
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(PASSWORD)
+    return str(path)
+
+def encrypt(psw_file: str, plaintext: bytes) -> bytes:
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    file_cryptor = mode.start_file(contents, crypted)
+    assert crypt_chunks(file_cryptor, contents, crypted)
+    return crypted.getvalue()
+
+def decrypt(data: bytes, mode: Decryptor=None):
+    """The plaintext of `data`, or `None` if it fails to decrypt"""
+    mode = Decryptor(password=PASSWORD) if mode is None else mode
+    (crypted, contents) = (io.BytesIO(data), io.BytesIO())
+    file_cryptor = mode.start_file(crypted, contents)
+    if file_cryptor is None or \
+       not crypt_chunks(file_cryptor, crypted, contents):
+        return None
+    return contents.getvalue()
+
+def v1_plaintext():
+    """The plaintext of every file in the v1 fixture, by relative path"""
+    return {"plain/a.txt": b"dircrypt v1\n",
+            "plain/d/b.bin": bytes(i % 251 for i in range(20000))}
+
+def chunk_offsets(data: bytes):
+    """The offsets of the (uncompressed) chunks of `data`"""
+    return range(FILE_HEADER_SIZE, len(data), CHUNK_SIZE + TAG_SIZE)
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK_SIZE, 3 * CHUNK_SIZE + 7])
+def test_file_round_trip(psw_file, size):
+    plaintext = os.urandom(size)
+    assert decrypt(encrypt(psw_file, plaintext)) == plaintext
+
+def test_name_round_trip(psw_file):
+    mode = Encryptor(psw_file=psw_file, kdf=TEST_KDF)
+    name = mode.crypt_path_name("ñame.txt")
+    assert mode.decryptor().crypt_path_name(name) == "ñame.txt"
+
+def test_header_round_trip():
+    header = FileHeader(os.urandom(SALT_SIZE), os.urandom(SALT_SIZE),
+                        CHUNK_SIZE, 0x03, 1, TEST_KDF)
+    data = pack_file_header(header)
+    assert len(data) == FILE_HEADER_SIZE
+    assert unpack_file_header(data) == header
+    assert unpack_file_header(data[:-1]) is None
+
+def test_unknown_header_version_isnt_parsed():
+    data = bytearray(pack_file_header(FileHeader(os.urandom(SALT_SIZE),
+                                                 os.urandom(SALT_SIZE))))
+    data[len(FILE_MAGIC)] = 3
+    assert unpack_file_header(bytes(data)) is None
+
+def test_v1_fixture_decrypts():
+    mode = Decryptor(psw_file=str(V1_FIXTURE.joinpath("dircrypt.password")))
+    decrypted = {}
+    for path in V1_FIXTURE.rglob("*"):
+        if not path.is_file() or path.name == "dircrypt.password":
+            continue
+        names = [mode.crypt_path_name(part)
+                 for part in path.relative_to(V1_FIXTURE).parts]
+        assert None not in names
+        decrypted["/".join(names)] = decrypt(path.read_bytes(), mode)
+    assert decrypted == v1_plaintext()
+
+# -----------------------------------------------------------------------------
+
+def test_tampered_chunk_fails(psw_file):
+    data = bytearray(encrypt(psw_file, os.urandom(3 * CHUNK_SIZE)))
+    data[chunk_offsets(data)[1] + 10] ^= 0x01
+    assert decrypt(bytes(data)) is None
+
+def test_tampered_header_fails(psw_file):
+    data = bytearray(encrypt(psw_file, os.urandom(3 * CHUNK_SIZE)))
+    data[30] ^= 0x01 # in the file salt
+    assert decrypt(bytes(data)) is None
+
+def test_reordered_chunks_fail(psw_file):
+    data = encrypt(psw_file, os.urandom(3 * CHUNK_SIZE))
+    (first, second, third) = chunk_offsets(data)
+    reordered = data[:first] + data[second:third] + data[first:second] + \
+                data[third:]
+    assert decrypt(reordered) is None
+
+@pytest.mark.parametrize("num_chunks", [0, 1, 2])
+def test_truncated_at_chunk_boundary_fails(psw_file, num_chunks):
+    data = encrypt(psw_file, os.urandom(3 * CHUNK_SIZE))
+    cut = chunk_offsets(data)[num_chunks]
+    assert decrypt(data[:cut]) is None
+
+def test_truncated_mid_chunk_fails(psw_file):
+    data = encrypt(psw_file, os.urandom(3 * CHUNK_SIZE))
+    assert decrypt(data[:-100]) is None
+
+def test_empty_file_missing_its_final_chunk_fails(psw_file):
+    data = encrypt(psw_file, b"")
+    assert decrypt(data) == b""
+    assert decrypt(data[:-TAG_SIZE]) is None
+
+def test_appended_chunk_fails(psw_file):
+    plaintext = os.urandom(3 * CHUNK_SIZE)
+    data = encrypt(psw_file, plaintext)
+    (_, second, third) = chunk_offsets(data)
+    assert decrypt(data + data[second:third]) is None
+
+def test_tampered_name_fails(psw_file):
+    mode = Encryptor(psw_file=psw_file, kdf=TEST_KDF)
+    name_bytes = bytearray(urlsafe_b64decode(mode.crypt_path_name("name")))
+    name_bytes[-1] ^= 0x01
+    name = str(urlsafe_b64encode(bytes(name_bytes)), "utf-8")
+    assert mode.decryptor().crypt_path_name(name) is None
+
+def test_names_arent_interchangeable_across_passwords(tmp_path):
+    other_psw_file = tmp_path.joinpath("other.password")
+    other_psw_file.write_bytes(b"other")
+    mode = Encryptor(psw_file=str(other_psw_file), kdf=TEST_KDF)
+    name = mode.crypt_path_name("name")
+    assert Decryptor(password=PASSWORD).crypt_path_name(name) is None
@@ -0,0 +1,79 @@
+"""
+Path patterns (as given with --only), and decrypting just the subtree they
+select.
+"""
+from pathlib import PurePosixPath
+
+import pytest
+
+from dircrypt.__main__ import main
+from dircrypt.ioutils import PathPattern
+
+# -----------------------------------------------------------------------------
+
+def matches(pattern: str, path: str) -> bool:
+    return PathPattern(pattern).matches(PurePosixPath(path).parts)
+
+def may_match_under(pattern: str, directory: str) -> bool:
+    return PathPattern(pattern).may_match_under(
+        PurePosixPath(directory).parts)
+
+def files_under(root):
+    """Every file under `root`, relative to it"""
+    return sorted(path.relative_to(root).as_posix()
+                  for path in root.rglob("*") if path.is_file())
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize(("pattern", "path", "expected"), [
+    ("src/*.txt", "src/a.txt", True),
+    ("src/*.txt", "src/a.bin", False),
+    ("src/*.txt", "src/d/a.txt", False), # `*` stays within a path item
+    ("src/?.txt", "src/a.txt", True),
+    ("src/[ab].txt", "src/c.txt", False),
+    ("src/**", "src/d/e/f", True),
+    ("src/**/f", "src/f", True), # `**` matches no path items, too
+    ("src/**/f", "src/d/e/f", True),
+    ("src/**/f", "src/d/e/g", False),
+    ("**/f", "src/d/f", True),
+    ("src/d", "src/d/e/f", True), # under a matching directory
+    ("src/d", "src/dd", False),
+])
+def test_matches(pattern, path, expected):
+    assert matches(pattern, path) is expected
+
+@pytest.mark.parametrize(("pattern", "path", "expected"), [
+    ("src/a", "src/a", True),
+    ("/src/a", "src/a", True), # a leading `/` anchors like any pattern
+    ("src/a", "x/src/a", False),
+    ("a", "src/a", False),
+    ("*/a", "src/a", True),
+    ("*/a", "x/src/a", False),
+])
+def test_patterns_are_anchored(pattern, path, expected):
+    assert matches(pattern, path) is expected
+
+@pytest.mark.parametrize(("pattern", "directory", "expected"), [
+    ("src/c/**", "src", True),
+    ("src/c/**", "src/c", True),
+    ("src/c/**", "src/d", False),
+    ("src/*/f", "src/d", True),
+    ("src/*/f", "src/d/e", False),
+    ("**/f", "src/d/e", True),
+])
+def test_may_match_under(pattern, directory, expected):
+    assert may_match_under(pattern, directory) is expected
+
+def test_only_decrypts_the_selected_subtree(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for (path, contents) in [("src/a", b"a"), ("src/c/b", b"b"),
+                             ("src/c/e/f", b"f"), ("src/d/g", b"g")]:
+        tmp_path.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.joinpath(path).write_bytes(contents)
+    main(["-e", "src", "--gen", "--as=enc", "--kdf-target-ms=1"])
+
+    main(["-d", "enc", "--with=dircrypt.password", "--as=dec",
+          "--only=src/c/**"])
+    assert files_under(tmp_path.joinpath("dec")) == ["src/c/b", "src/c/e/f"]
+    assert tmp_path.joinpath("dec", "src", "c", "e", "f").read_bytes() == \
+           b"f"
@@ -0,0 +1,154 @@
+"""
+KDF specs: the bounds on those read from (untrusted) headers, the cap on
+the archive salts (and specs) decryption stretches the password under, scrypt
+round trips, and calibration to a time budget.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt import kdf as kdf_module
+from dircrypt.cryptor import (Encryptor, Decryptor, FileHeader, SALT_SIZE,
+                              MAX_ARCHIVE_SALTS, pack_file_header)
+from dircrypt.kdf import (KdfSpec, PBKDF2, SCRYPT, KDF_SPEC,
+                          MAX_PBKDF2_ITERATIONS, MIN_PBKDF2_ITERATIONS,
+                          MIN_SCRYPT_LOG_N, pack_kdf_spec, unpack_kdf_spec,
+                          is_valid_spec, calibrate)
+from dircrypt.routines import crypt_chunks
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+# the cheapest scrypt spec calibration picks (1 MiB)
+TEST_SCRYPT = KdfSpec(SCRYPT, MIN_SCRYPT_LOG_N, 8, 1)
+PASSWORD = b"correct horse battery staple"
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(PASSWORD)
+    return str(path)
+
+def encrypt(mode: Encryptor, plaintext: bytes) -> bytes:
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    assert crypt_chunks(mode.start_file(contents, crypted), contents, crypted)
+    return crypted.getvalue()
+
+def decrypt(mode: Decryptor, data: bytes):
+    """The plaintext of `data`, or `None` if it fails to decrypt"""
+    (crypted, contents) = (io.BytesIO(data), io.BytesIO())
+    file_cryptor = mode.start_file(crypted, contents)
+    if file_cryptor is None or \
+       not crypt_chunks(file_cryptor, crypted, contents):
+        return None
+    return contents.getvalue()
+
+def fake_stretch_times(monkeypatch, pbkdf2_s: float, scrypt_s: float):
+    """
+    Times PBKDF2's probe at `pbkdf2_s`, and scrypt at `scrypt_s` for N=2**10
+    (doubling with N), without stretching anything
+    """
+    def time_stretch(spec: KdfSpec) -> float:
+        if spec.kdf == PBKDF2:
+            return pbkdf2_s
+        return scrypt_s * 2**(spec.cost - MIN_SCRYPT_LOG_N)
+    monkeypatch.setattr(kdf_module, "_time_stretch", time_stretch)
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("spec", [
+    KdfSpec(PBKDF2, 0),
+    KdfSpec(PBKDF2, MAX_PBKDF2_ITERATIONS + 1),
+    KdfSpec(PBKDF2, 1000, 8, 1), # PBKDF2 has no block size, or parallelism
+    KdfSpec(SCRYPT, 0, 8, 1),
+    KdfSpec(SCRYPT, 19, 8, 1), # 512 MiB
+    KdfSpec(SCRYPT, 10, 0, 1),
+    KdfSpec(SCRYPT, 10, 33, 1),
+    KdfSpec(SCRYPT, 10, 8, 5),
+    KdfSpec(2, 1000),
+])
+def test_out_of_bounds_spec_is_rejected(spec):
+    assert not is_valid_spec(spec)
+    assert unpack_kdf_spec(pack_kdf_spec(spec)) is None
+
+def test_spec_round_trip():
+    for spec in (TEST_KDF, TEST_SCRYPT, KdfSpec(SCRYPT, 18, 8, 1)):
+        data = pack_kdf_spec(spec)
+        assert unpack_kdf_spec(data) == spec
+        assert unpack_kdf_spec(data[:KDF_SPEC.size - 1]) is None
+
+def test_file_with_out_of_bounds_spec_fails():
+    header = FileHeader(os.urandom(SALT_SIZE), os.urandom(SALT_SIZE),
+                        CHUNK_SIZE, kdf=KdfSpec(PBKDF2, 1000))
+    data = bytearray(pack_file_header(header) + os.urandom(100))
+    spec_offset = data.index(pack_kdf_spec(header.kdf))
+    data[spec_offset:spec_offset + KDF_SPEC.size] = \
+        pack_kdf_spec(KdfSpec(PBKDF2, MAX_PBKDF2_ITERATIONS + 1))
+    assert decrypt(Decryptor(password=PASSWORD), bytes(data)) is None
+
+def test_archive_salts_are_capped(psw_file):
+    # every Encryptor stretches under a fresh archive salt
+    names = [Encryptor(psw_file=psw_file, kdf=TEST_KDF).crypt_path_name("n")
+             for _ in range(MAX_ARCHIVE_SALTS + 1)]
+    decryptor = Decryptor(password=PASSWORD)
+    assert [decryptor.crypt_path_name(name) for name in names] == \
+           ["n"] * MAX_ARCHIVE_SALTS + [None]
+    # names under the salts already stretched under still decrypt
+    assert decryptor.crypt_path_name(names[0]) == "n"
+
+def test_only_the_first_spec_met_is_stretched_with(psw_file):
+    first = Encryptor(psw_file=psw_file, kdf=TEST_KDF)
+    other = Encryptor(psw_file=psw_file, kdf=KdfSpec(PBKDF2, 1001))
+    (first_data, other_data) = (encrypt(first, b"first"),
+                                encrypt(other, b"other"))
+
+    decryptor = Decryptor(password=PASSWORD)
+    assert decrypt(decryptor, first_data) == b"first"
+    assert decrypt(decryptor, other_data) is None
+    assert decryptor.crypt_path_name(other.crypt_path_name("n")) is None
+    # ... whichever spec is met first
+    decryptor = Decryptor(password=PASSWORD)
+    assert decrypt(decryptor, other_data) == b"other"
+    assert decrypt(decryptor, first_data) is None
+
+def test_scrypt_round_trip(psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE,
+                     kdf=TEST_SCRYPT)
+    plaintext = os.urandom(3 * CHUNK_SIZE + 7)
+    decryptor = mode.decryptor()
+    assert decrypt(decryptor, encrypt(mode, plaintext)) == plaintext
+    assert decryptor.crypt_path_name(mode.crypt_path_name("ñame")) == "ñame"
+
+def test_scrypt_and_pbkdf2_keys_differ(psw_file):
+    data = encrypt(Encryptor(psw_file=psw_file, kdf=TEST_SCRYPT), b"data")
+    header = bytearray(data)
+    spec_offset = header.index(pack_kdf_spec(TEST_SCRYPT))
+    header[spec_offset:spec_offset + KDF_SPEC.size] = pack_kdf_spec(TEST_KDF)
+    assert decrypt(Decryptor(password=PASSWORD), bytes(header)) is None
+
+# -----------------------------------------------------------------------------
+
+def test_pbkdf2_calibration_scales_the_probe(monkeypatch):
+    fake_stretch_times(monkeypatch, pbkdf2_s=0.01, scrypt_s=0.001)
+    # 10,000 iterations take 10ms, so 100ms fits 100,000
+    assert calibrate(PBKDF2, 100) == KdfSpec(PBKDF2, 100000)
+    assert calibrate(PBKDF2, 1) == KdfSpec(PBKDF2, MIN_PBKDF2_ITERATIONS)
+    assert calibrate(PBKDF2, 10**9) == KdfSpec(PBKDF2, MAX_PBKDF2_ITERATIONS)
+
+def test_scrypt_calibration_doubles_n(monkeypatch):
+    fake_stretch_times(monkeypatch, pbkdf2_s=0.01, scrypt_s=0.001)
+    # N=2**13 takes 8ms, within 10ms, while N=2**14 would take 16ms
+    assert calibrate(SCRYPT, 10) == KdfSpec(SCRYPT, 13, 8, 1)
+    assert calibrate(SCRYPT, 1) == TEST_SCRYPT
+    # 256 MiB, the most headers may ask for
+    assert calibrate(SCRYPT, 10**9) == KdfSpec(SCRYPT, 18, 8, 1)
+
+@pytest.mark.parametrize("kdf", [PBKDF2, SCRYPT])
+def test_calibration_is_within_bounds(kdf):
+    spec = calibrate(kdf, 1)
+    assert spec.kdf == kdf
+    assert is_valid_spec(spec)
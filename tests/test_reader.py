@@ -0,0 +1,143 @@
+"""
+Random access reads of encrypted files: seeking across chunk boundaries,
+the cache of decrypted chunks, and chunks that fail to authenticate.
+"""
+import errno
+import io
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from dircrypt.compression import CODECS
+from dircrypt.cryptor import Encryptor, FILE_HEADER_SIZE, TAG_SIZE
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.reader import open_encrypted, wrap_encrypted
+from dircrypt.routines import crypt_chunks
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+class CountingReader(io.BytesIO):
+    """Counts the reads of the encrypted file, i.e. the chunks decrypted"""
+
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.num_reads = 0
+
+    def read(self, size=-1) -> bytes:
+        self.num_reads += 1
+        return super().read(size)
+
+def encrypt(mode: Encryptor, plaintext: bytes) -> bytes:
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    assert crypt_chunks(mode.start_file(contents, crypted), contents, crypted)
+    return crypted.getvalue()
+
+def encrypt_file(mode: Encryptor, path: Path, plaintext: bytes) -> Path:
+    path.write_bytes(encrypt(mode, plaintext))
+    return path
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("codec", [None, CODECS["zlib"]])
+def test_random_access_reads(tmp_path, psw_file, codec):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, codec=codec,
+                     kdf=TEST_KDF)
+    # half compressible, so that compressed chunks vary in length
+    plaintext = bytes(4 * CHUNK_SIZE) + os.urandom(4 * CHUNK_SIZE + 7)
+    path = encrypt_file(mode, tmp_path.joinpath("f"), plaintext)
+
+    rng = random.Random(0)
+    with open_encrypted(path, mode.decryptor()) as encrypted:
+        assert encrypted.size == len(plaintext)
+        for _ in range(100):
+            (start, length) = (rng.randrange(len(plaintext)),
+                               rng.randrange(3 * CHUNK_SIZE))
+            encrypted.seek(start)
+            assert encrypted.read(length) == \
+                   plaintext[start:start + length]
+        encrypted.seek(0)
+        assert encrypted.read() == plaintext
+
+def test_seeks_across_chunk_boundaries(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    plaintext = os.urandom(3 * CHUNK_SIZE + 7)
+    path = encrypt_file(mode, tmp_path.joinpath("f"), plaintext)
+
+    with open_encrypted(path, mode.decryptor()) as encrypted:
+        encrypted.seek(CHUNK_SIZE - 10)
+        assert encrypted.read(20) == plaintext[CHUNK_SIZE - 10:
+                                               CHUNK_SIZE + 10]
+        # a read spanning every chunk
+        encrypted.seek(1)
+        assert encrypted.read(3 * CHUNK_SIZE + 6) == plaintext[1:]
+
+        assert encrypted.seek(-3, io.SEEK_END) == len(plaintext) - 3
+        assert encrypted.read(10) == plaintext[-3:]
+        assert encrypted.read(10) == b""
+        encrypted.seek(2 * CHUNK_SIZE)
+        assert encrypted.seek(-CHUNK_SIZE, io.SEEK_CUR) == CHUNK_SIZE
+        assert encrypted.read(CHUNK_SIZE) == plaintext[CHUNK_SIZE:
+                                                       2 * CHUNK_SIZE]
+        assert encrypted.tell() == 2 * CHUNK_SIZE
+
+def test_cache_evicts_least_recently_used_chunk(psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    plaintext = os.urandom(4 * CHUNK_SIZE)
+    file = CountingReader(encrypt(mode, plaintext))
+    encrypted = wrap_encrypted(file, mode.decryptor(), cache_size=2)
+    assert encrypted is not None
+
+    def read_chunk(index: int) -> int:
+        """Reads a chunk, returning the number of chunks decrypted for it"""
+        num_reads = file.num_reads
+        encrypted.seek(index * CHUNK_SIZE)
+        assert encrypted.read(CHUNK_SIZE) == \
+               plaintext[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        return file.num_reads - num_reads
+
+    # the final chunk was decrypted (and cached) when opening
+    assert read_chunk(3) == 0
+    assert read_chunk(0) == 1
+    assert read_chunk(0) == 0
+    assert read_chunk(1) == 1 # evicts 3
+    assert read_chunk(0) == 0 # used more recently than 1
+    assert read_chunk(2) == 1 # evicts 1
+    assert read_chunk(0) == 0
+    assert read_chunk(3) == 1
+    assert read_chunk(1) == 1
+
+def test_tampered_chunk_fails_to_read(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    plaintext = os.urandom(3 * CHUNK_SIZE)
+    data = bytearray(encrypt(mode, plaintext))
+    data[FILE_HEADER_SIZE + CHUNK_SIZE + TAG_SIZE + 10] ^= 0x01 # chunk 1
+    path = tmp_path.joinpath("f")
+    path.write_bytes(bytes(data))
+
+    with open_encrypted(path, mode.decryptor()) as encrypted:
+        assert encrypted.read(CHUNK_SIZE) == plaintext[:CHUNK_SIZE]
+        with pytest.raises(OSError) as error:
+            encrypted.read(CHUNK_SIZE)
+        assert error.value.errno == errno.EIO
+        encrypted.seek(2 * CHUNK_SIZE)
+        assert encrypted.read() == plaintext[2 * CHUNK_SIZE:]
+
+def test_truncated_file_fails_to_open(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    data = encrypt(mode, os.urandom(3 * CHUNK_SIZE))
+    path = tmp_path.joinpath("f")
+    path.write_bytes(data[:-(CHUNK_SIZE + TAG_SIZE)])
+    with pytest.raises(OSError):
+        open_encrypted(path, mode.decryptor())
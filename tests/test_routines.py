@@ -0,0 +1,93 @@
+"""
+Files over `SPLIT_FILE_SIZE`, whose chunk ranges are (en|de)crypted
+concurrently, and out of order.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt import __main__ as cli, routines
+from dircrypt.__main__ import main
+from dircrypt.cryptor import Encryptor, FILE_HEADER_SIZE
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.routines import (DirectoryBuilder, crypt_chunks,
+                               start_split_file, crypt_chunk_range,
+                               finish_split_file)
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+@pytest.fixture
+def small_ranges(monkeypatch) -> None:
+    """Splits files over 8 chunks, into ranges of 4 chunks"""
+    monkeypatch.setattr(cli, "SPLIT_FILE_SIZE", 8 * CHUNK_SIZE)
+    monkeypatch.setattr(routines, "RANGE_SIZE", 4 * CHUNK_SIZE)
+
+def crypt_split(builder: DirectoryBuilder, original: Path) -> Path:
+    """(En|De)crypts `original` a chunk range at a time, last range first"""
+    (crypted_file, file_cryptor, chunk_ranges) = \
+        start_split_file(builder, original)
+    assert len(chunk_ranges) > 1
+    results = [crypt_chunk_range(builder, original, crypted_file,
+                                 file_cryptor, first, last)
+               for (first, last) in reversed(chunk_ranges)]
+    assert finish_split_file(original, crypted_file, results) == crypted_file
+    return crypted_file
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.usefixtures("small_ranges")
+@pytest.mark.parametrize("size", [10 * CHUNK_SIZE, 12 * CHUNK_SIZE + 7])
+def test_split_file_matches_sequential(tmp_path, psw_file, size):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    plaintext = os.urandom(size)
+    original = tmp_path.joinpath("src", "f")
+    original.parent.mkdir()
+    original.write_bytes(plaintext)
+
+    builder = DirectoryBuilder(tmp_path, tmp_path.joinpath("enc"), mode)
+    data = crypt_split(builder, original).read_bytes()
+    header = data[:FILE_HEADER_SIZE]
+    (contents, crypted) = (io.BytesIO(plaintext), io.BytesIO())
+    assert crypt_chunks(mode.file_cryptor(header), contents, crypted)
+    assert data == header + crypted.getvalue()
+
+@pytest.mark.usefixtures("small_ranges")
+def test_split_file_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("src").mkdir()
+    plaintext = os.urandom(20 * CHUNK_SIZE + 7)
+    tmp_path.joinpath("src", "big").write_bytes(plaintext)
+    tmp_path.joinpath("src", "small").write_bytes(b"small")
+
+    num_ranges = 0
+
+    def count_range(*args) -> bool:
+        nonlocal num_ranges
+        num_ranges += 1
+        return crypt_chunk_range(*args)
+    monkeypatch.setattr(cli, "crypt_chunk_range", count_range)
+
+    # run in this process, so that the patches hold
+    main(["-e", "src", "--gen", "--as=enc", "--chunk-size=1K",
+          "--kdf-target-ms=1", "--engine=inline"])
+    assert num_ranges == 6 # of 4 chunks, for 21 chunks
+    output = next(path for path in tmp_path.joinpath("enc").iterdir()
+                  if path.is_dir())
+    main(["-d", str(output), "--with=dircrypt.password", "--as=dec",
+          "--engine=inline"])
+    # encrypted chunks are longer (by their tags), so only 3 fit a range
+    assert num_ranges == 6 + 7
+    assert tmp_path.joinpath("dec", "src", "big").read_bytes() == plaintext
+    assert tmp_path.joinpath("dec", "src", "small").read_bytes() == b"small"
@@ -0,0 +1,62 @@
+"""
+Round trips of STDIN to STDOUT (a `-` target), and decrypting streams cut
+short, whose output stops at the last authenticated chunk.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from dircrypt.cryptor import TAG_SIZE
+
+CHUNK_SIZE = 2**14 # the default --chunk-size
+PACKAGE_ROOT = Path(__file__).parent.parent
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+def dircrypt(args, stdin: bytes, cwd: Path) -> subprocess.CompletedProcess:
+    """Runs dircrypt on `stdin`, in a fresh interpreter (STDOUT is a pipe)"""
+    env = dict(os.environ, PYTHONPATH=str(PACKAGE_ROOT))
+    return subprocess.run([sys.executable, "-m", "dircrypt"] + args,
+                          input=stdin, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, cwd=str(cwd), env=env)
+
+def encrypt(psw_file: str, plaintext: bytes, cwd: Path) -> bytes:
+    run = dircrypt(["-e", "-", "--with=" + psw_file, "--kdf-target-ms=1"],
+                   plaintext, cwd)
+    assert run.returncode == 0, run.stderr
+    return run.stdout
+
+def decrypt(psw_file: str, data: bytes, cwd: Path):
+    return dircrypt(["-d", "-", "--with=" + psw_file], data, cwd)
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("size", [0, CHUNK_SIZE, 300000])
+def test_round_trip(tmp_path, psw_file, size):
+    plaintext = os.urandom(size)
+    run = decrypt(psw_file, encrypt(psw_file, plaintext, tmp_path), tmp_path)
+    assert run.returncode == 0, run.stderr
+    assert run.stdout == plaintext
+
+@pytest.mark.parametrize("cut", [100, CHUNK_SIZE + TAG_SIZE])
+def test_truncated_stream_fails_after_its_whole_chunks(tmp_path, psw_file,
+                                                      cut):
+    plaintext = os.urandom(300000)
+    data = encrypt(psw_file, plaintext, tmp_path)
+    run = decrypt(psw_file, data[:-cut], tmp_path)
+    assert run.returncode != 0
+    assert b"incomplete" in run.stderr
+
+    # everything written was authenticated, so it's a prefix of whole chunks
+    assert len(run.stdout) < len(plaintext)
+    assert len(run.stdout) % CHUNK_SIZE == 0
+    assert run.stdout == plaintext[:len(run.stdout)]
@@ -0,0 +1,89 @@
+"""
+Incremental re-encryption with --update: changed files replace their outputs
+only once they're re-encrypted, and failed files keep their previous output.
+"""
+import io
+from pathlib import Path, PurePath
+
+import pytest
+
+from dircrypt import routines
+from dircrypt.__main__ import main
+from dircrypt.cryptor import Encryptor, Decryptor
+from dircrypt.manifest import Manifest, MANIFEST_NAME
+from dircrypt.routines import crypt_chunks
+
+# cheap to stretch (updates keep the archive's KDF spec), and run in this
+# process, so that it can be patched
+ENCRYPT_ARGS = ["--kdf-target-ms=1", "--engine=inline"]
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def encrypted(tmp_path, monkeypatch) -> Path:
+    """Encrypts `src` (holding `a` and `b`) to `enc`, in `tmp_path`"""
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("src").mkdir()
+    tmp_path.joinpath("src", "a").write_bytes(b"first a")
+    tmp_path.joinpath("src", "b").write_bytes(b"first b")
+    main(["-e", "src", "--gen", "--as=enc"] + ENCRYPT_ARGS)
+    return tmp_path
+
+def update(tmp_path: Path) -> None:
+    main(["-e", "src", "--update=enc", "--with=dircrypt.password",
+          "--engine=inline"])
+
+def load_manifest(tmp_path: Path) -> Manifest:
+    output_dir = tmp_path.joinpath("enc")
+    (archive_salt, kdf) = Manifest.read_archive_kdf(output_dir)
+    mode = Encryptor(psw_file=str(tmp_path.joinpath("dircrypt.password")),
+                     archive_salt=archive_salt, kdf=kdf)
+    manifest = Manifest.load(output_dir, mode)
+    assert manifest is not None
+    return manifest
+
+def decrypted(tmp_path: Path):
+    """The plaintext of every output in the manifest, by source path"""
+    mode = Decryptor(psw_file=str(tmp_path.joinpath("dircrypt.password")))
+    plaintexts = {}
+    for (source, entry) in load_manifest(tmp_path).files.items():
+        contents = io.BytesIO()
+        with tmp_path.joinpath("enc", entry[3]).open(mode="rb") as crypted:
+            file_cryptor = mode.start_file(crypted, contents)
+            assert crypt_chunks(file_cryptor, crypted, contents)
+        plaintexts[source] = contents.getvalue()
+    return plaintexts
+
+def num_outputs(tmp_path: Path) -> int:
+    """The number of encrypted files in `enc`, but the manifest"""
+    return sum(1 for path in tmp_path.joinpath("enc").rglob("*")
+               if path.is_file() and path.name != MANIFEST_NAME)
+
+# -----------------------------------------------------------------------------
+
+def test_changed_file_replaces_its_output(encrypted):
+    encrypted.joinpath("src", "a").write_bytes(b"second a")
+    update(encrypted)
+    assert decrypted(encrypted) == {"src/a": b"second a",
+                                    "src/b": b"first b"}
+    assert num_outputs(encrypted) == 2
+
+def test_failed_file_keeps_its_previous_output(encrypted, monkeypatch):
+    old_output = load_manifest(encrypted).output_file(PurePath("src/a"))
+    encrypted.joinpath("src", "a").write_bytes(b"second a")
+
+    def fail(self, original: Path, target: Path) -> bool:
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(routines.DirectoryBuilder, "write_crypted_contents",
+                      fail)
+        update(encrypted)
+    assert load_manifest(encrypted).output_file(PurePath("src/a")) == \
+           old_output
+    assert decrypted(encrypted) == {"src/a": b"first a", "src/b": b"first b"}
+
+    # and it's retried by the next update, which then removes it
+    update(encrypted)
+    assert decrypted(encrypted) == {"src/a": b"second a",
+                                    "src/b": b"first b"}
+    assert not encrypted.joinpath("enc", old_output).exists()
@@ -0,0 +1,113 @@
+"""
+Verification of encrypted files cut short, at (and between) chunk
+boundaries.
+"""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from dircrypt.cryptor import Encryptor, TAG_SIZE
+from dircrypt.compression import CODECS
+from dircrypt.kdf import KdfSpec, PBKDF2
+from dircrypt.routines import crypt_chunks
+from dircrypt.verify import verify_file, Summary
+
+CHUNK_SIZE = 1024
+# cheap to stretch, since every test stretches a password
+TEST_KDF = KdfSpec(PBKDF2, 1000)
+
+# -----------------------------------------------------------------------------
+
+@pytest.fixture
+def psw_file(tmp_path: Path) -> str:
+    path = tmp_path.joinpath("test.password")
+    path.write_bytes(b"correct horse battery staple")
+    return str(path)
+
+def encrypt_file(mode: Encryptor, directory: Path, name: str,
+                 plaintext: bytes) -> Path:
+    """Encrypts `plaintext` to a file in `directory`, under `name` encrypted"""
+    path = directory.joinpath(mode.crypt_path_name(name))
+    contents = io.BytesIO(plaintext)
+    with path.open(mode="wb") as crypted:
+        file_cryptor = mode.start_file(contents, crypted)
+        assert crypt_chunks(file_cryptor, contents, crypted)
+    return path
+
+def verify(mode: Encryptor, path: Path):
+    return verify_file(mode.decryptor(), path, path.name)
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("codec", [None, CODECS["zlib"]])
+def test_intact_file_verifies(tmp_path, psw_file, codec):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, codec=codec,
+                     kdf=TEST_KDF)
+    path = encrypt_file(mode, tmp_path, "f", os.urandom(3 * CHUNK_SIZE))
+    report = verify(mode, path)
+    assert report.ok
+    assert report.num_chunks == 3
+
+def test_truncated_at_chunk_boundary(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    path = encrypt_file(mode, tmp_path, "f", os.urandom(3 * CHUNK_SIZE))
+    os.truncate(str(path), path.stat().st_size - (CHUNK_SIZE + TAG_SIZE))
+
+    report = verify(mode, path)
+    assert not report.ok
+    assert report.bad_chunks == []
+    assert report.error == "truncated after 2 chunks"
+
+def test_compressed_truncated_at_frame_boundary(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE,
+                     codec=CODECS["zlib"], kdf=TEST_KDF)
+    path = encrypt_file(mode, tmp_path, "f", bytes(3 * CHUNK_SIZE))
+    data = path.read_bytes()
+    file_cryptor = mode.decryptor().start_file(io.BytesIO(data),
+                                               io.BytesIO())
+    # drop the last frame: `length | chunk`
+    offset = file_cryptor.read_offset
+    for _ in range(2):
+        offset += 4 + int.from_bytes(data[offset:offset + 4], "big")
+    path.write_bytes(data[:offset])
+
+    report = verify(mode, path)
+    assert not report.ok
+    assert report.error == "truncated after 2 chunks"
+
+def test_empty_file_missing_its_final_chunk(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    path = encrypt_file(mode, tmp_path, "f", b"")
+    assert verify(mode, path).ok
+    os.truncate(str(path), path.stat().st_size - TAG_SIZE) # the empty chunk
+
+    report = verify(mode, path)
+    assert not report.ok
+    assert report.error == "truncated after 0 chunks"
+
+def test_truncated_mid_chunk(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    path = encrypt_file(mode, tmp_path, "f", os.urandom(3 * CHUNK_SIZE))
+    os.truncate(str(path), path.stat().st_size - 100)
+
+    report = verify(mode, path)
+    assert not report.ok
+    assert report.bad_chunks == [2]
+
+def test_summary_keeps_only_failures(tmp_path, psw_file):
+    mode = Encryptor(psw_file=psw_file, chunk_size=CHUNK_SIZE, kdf=TEST_KDF)
+    summary = Summary()
+    for name in ("a", "b"):
+        path = encrypt_file(mode, tmp_path, name, os.urandom(2 * CHUNK_SIZE))
+        summary.add(verify(mode, path))
+    os.truncate(str(path), path.stat().st_size - 100)
+    summary.add(verify(mode, path))
+
+    assert [report.path for report in summary.failures] == [path.name]
+    report = summary.report(tmp_path, 0, [])
+    assert not report["ok"]
+    assert (report["files"], report["chunks"]) == (3, 6)
+    assert report["bad_files"] == [{"path": path.name, "bad_chunks": [1],
+                                    "error": None}]